@@ -9,7 +9,6 @@ import os
 import sys
 import logging
 from datetime import date
-from time import sleep
 import sentry_sdk
 from sentry_sdk.integrations.flask import FlaskIntegration
 
@@ -56,7 +55,7 @@ GROUP_NOTIFICATIONS = ["When someone posts a Decaff ride",
                        "When someone posts a Gravel ride",
                        "When someone posts a TWR ride"]
 
-# Global Flash Message
+# Global Flash Message, the default until one is set in the dB (see subs_site_flags.global_flash())
 GLOBAL_FLASH = None
 
 
@@ -232,8 +231,6 @@ def delete_file_if_exists(filename):
     if os.path.exists(filename):
         try:
             os.remove(filename)
-            # We need this as remove seems to keep the file locked for a short period
-            sleep(0.5)
             return True
         except Exception as e:
             app.logger.debug(f"delete_file_if_exists(): Failed to delete existing file '{filename}', "
@@ -0,0 +1,57 @@
+from sqlalchemy import text
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.repositories.gpx_repository import GpxModel, GpxRepository
+from core.subs_gpx_cache import gpx_track
+from core.subs_gpx_matching import update_route_footprint
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Schema changes
+# -------------------------------------------------------------------------------------------------------------- #
+
+SQL = [
+    "ALTER TABLE elsr.gpx ADD COLUMN IF NOT EXISTS min_lat double precision",
+    "ALTER TABLE elsr.gpx ADD COLUMN IF NOT EXISTS max_lat double precision",
+    "ALTER TABLE elsr.gpx ADD COLUMN IF NOT EXISTS min_lon double precision",
+    "ALTER TABLE elsr.gpx ADD COLUMN IF NOT EXISTS max_lon double precision",
+    "ALTER TABLE elsr.gpx ADD COLUMN IF NOT EXISTS cells text",
+]
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Add GpxModel bounding box / cells and backfill them from the GPX files
+# -------------------------------------------------------------------------------------------------------------- #
+
+def migrate() -> None:
+    """
+    Safe to run more than once.
+    Run with: python -m core.database.migrations.m001_gpx_footprint
+    """
+    with app.app_context():
+        for sql in SQL:
+            db.session.execute(text(sql))
+        db.session.commit()
+
+    gpxes: list[GpxModel] = GpxRepository.all_gpxes()
+    for gpx in gpxes:
+        track = gpx_track(gpx.filename)
+        if track and update_route_footprint(gpx.id, track):
+            print(f"Updated footprint for gpx_id = '{gpx.id}' ({gpx.name}).")
+        else:
+            print(f"Failed to update footprint for gpx_id = '{gpx.id}' ({gpx.name}).")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,76 @@
+import json
+from typing import Any
+from sqlalchemy import text
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Schema changes
+# -------------------------------------------------------------------------------------------------------------- #
+
+SQL = [
+    "CREATE TABLE IF NOT EXISTS elsr.gpx_cafes ("
+    "   gpx_id integer NOT NULL,"
+    "   cafe_id integer NOT NULL,"
+    "   dist_km double precision NOT NULL,"
+    "   range_km double precision NOT NULL,"
+    "   PRIMARY KEY (gpx_id, cafe_id)"
+    ")",
+    "CREATE INDEX IF NOT EXISTS ix_gpx_cafes_cafe_id ON elsr.gpx_cafes (cafe_id)",
+]
+
+UPSERT = "INSERT INTO elsr.gpx_cafes (gpx_id, cafe_id, dist_km, range_km) " \
+         "VALUES (:gpx_id, :cafe_id, :dist_km, :range_km) " \
+         "ON CONFLICT (gpx_id, cafe_id) DO UPDATE SET dist_km = EXCLUDED.dist_km, range_km = EXCLUDED.range_km"
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Create the gpx_cafes link table and backfill it from the old GpxModel.cafes_passed JSON strings
+# -------------------------------------------------------------------------------------------------------------- #
+
+def migrate() -> None:
+    """
+    Safe to run more than once, everything happens in one transaction.
+    Run with: python -m core.database.migrations.m002_gpx_cafe_links
+    """
+    with app.app_context():
+        try:
+            for sql in SQL:
+                db.session.execute(text(sql))
+
+            rows: list[dict[str, Any]] = []
+            for gpx_id, cafes_passed in db.session.execute(text("SELECT id, cafes_passed FROM elsr.gpx")):
+                try:
+                    cafes_json = json.loads(cafes_passed)
+                except Exception:
+                    print(f"Can't parse cafes_passed for gpx_id = '{gpx_id}', skipping.")
+                    continue
+
+                for cafe in cafes_json:
+                    rows.append({"gpx_id": gpx_id,
+                                 "cafe_id": int(cafe["cafe_id"]),
+                                 "dist_km": cafe["dist_km"],
+                                 "range_km": cafe["range_km"]})
+
+            # Don't link to cafes which have since been deleted
+            cafe_ids: set[int] = {row[0] for row in db.session.execute(text("SELECT id FROM elsr.cafes"))}
+            rows = [row for row in rows if row["cafe_id"] in cafe_ids]
+
+            if rows:
+                db.session.execute(text(UPSERT), rows)
+            db.session.commit()
+            print(f"Backfilled {len(rows)} gpx to cafe links.")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"Migration failed, error code '{e.args}'.")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,55 @@
+from sqlalchemy import text
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Schema changes
+# -------------------------------------------------------------------------------------------------------------- #
+
+SQL = [
+    "CREATE TABLE IF NOT EXISTS elsr.jobs ("
+    "   id serial PRIMARY KEY,"
+    "   kind varchar(20) NOT NULL,"
+    "   gpx_id integer,"
+    "   calendar_id integer,"
+    "   status varchar(10) NOT NULL,"
+    "   attempts integer NOT NULL DEFAULT 0,"
+    "   error varchar(500),"
+    "   created integer,"
+    "   updated integer,"
+    "   run_after integer"
+    ")",
+    "CREATE INDEX IF NOT EXISTS ix_jobs_status_id ON elsr.jobs (status, id)",
+    "CREATE INDEX IF NOT EXISTS ix_jobs_gpx_id ON elsr.jobs (gpx_id)",
+]
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Create the jobs table for the background worker
+# -------------------------------------------------------------------------------------------------------------- #
+
+def migrate() -> None:
+    """
+    Safe to run more than once.
+    Run with: python -m core.database.migrations.m003_jobs
+    """
+    with app.app_context():
+        try:
+            for sql in SQL:
+                db.session.execute(text(sql))
+            db.session.commit()
+            print("Created jobs table.")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"Migration failed, error code '{e.args}'.")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,48 @@
+from sqlalchemy import text
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Schema changes
+# -------------------------------------------------------------------------------------------------------------- #
+
+SQL = [
+    "CREATE INDEX IF NOT EXISTS ix_gpx_name_id ON elsr.gpx (name, id)",
+    "CREATE INDEX IF NOT EXISTS ix_gpx_length_km_id ON elsr.gpx (length_km, id)",
+    "CREATE INDEX IF NOT EXISTS ix_gpx_ascent_m_id ON elsr.gpx (ascent_m, id)",
+    "CREATE INDEX IF NOT EXISTS ix_gpx_type ON elsr.gpx (type)",
+    "CREATE INDEX IF NOT EXISTS ix_gpx_direction ON elsr.gpx (direction)",
+    "CREATE INDEX IF NOT EXISTS ix_gpx_public ON elsr.gpx (public)",
+    "CREATE INDEX IF NOT EXISTS ix_gpx_email ON elsr.gpx (email)",
+]
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Add the indexes used by the route search
+# -------------------------------------------------------------------------------------------------------------- #
+
+def migrate() -> None:
+    """
+    Safe to run more than once.
+    Run with: python -m core.database.migrations.m004_gpx_search_indexes
+    """
+    with app.app_context():
+        try:
+            for sql in SQL:
+                db.session.execute(text(sql))
+            db.session.commit()
+            print("Created route search indexes.")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"Migration failed, error code '{e.args}'.")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,58 @@
+from sqlalchemy import text
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.repositories.gpx_repository import GpxModel, GpxRepository
+from core.subs_route_store import stored_track
+from core.subs_gpx_fingerprint import update_route_fingerprint
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Schema changes
+# -------------------------------------------------------------------------------------------------------------- #
+
+SQL = [
+    "CREATE TABLE IF NOT EXISTS elsr.gpx_shingles ("
+    "   shingle bigint NOT NULL,"
+    "   gpx_id integer NOT NULL,"
+    "   PRIMARY KEY (shingle, gpx_id)"
+    ")",
+    "CREATE INDEX IF NOT EXISTS ix_gpx_shingles_gpx_id ON elsr.gpx_shingles (gpx_id)",
+]
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Create the gpx_shingles table and fingerprint every existing route
+# -------------------------------------------------------------------------------------------------------------- #
+
+def migrate() -> None:
+    """
+    Safe to run more than once.
+    Run with: python -m core.database.migrations.m005_gpx_shingles
+    """
+    with app.app_context():
+        for sql in SQL:
+            db.session.execute(text(sql))
+        db.session.commit()
+
+    gpxes: list[GpxModel] = GpxRepository.all_gpxes()
+    for gpx in gpxes:
+        track = stored_track(gpx.id, gpx.filename)
+        if track and len(track) > 0 and update_route_fingerprint(gpx.id, track):
+            print(f"Fingerprinted gpx_id = '{gpx.id}' ({gpx.name}).")
+        else:
+            print(f"Failed to fingerprint gpx_id = '{gpx.id}' ({gpx.name}).")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,64 @@
+from sqlalchemy import text
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.repositories.gpx_repository import GpxModel, GpxRepository
+from core.subs_gpx_edit import current_gpx_version
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Schema changes
+# -------------------------------------------------------------------------------------------------------------- #
+
+SQL = [
+    "CREATE TABLE IF NOT EXISTS elsr.gpx_versions ("
+    "   id serial PRIMARY KEY,"
+    "   gpx_id integer NOT NULL,"
+    "   blob varchar(64) NOT NULL,"
+    "   start integer NOT NULL,"
+    "   \"end\" integer NOT NULL,"
+    "   parent_id integer,"
+    "   action varchar(20) NOT NULL,"
+    "   created integer NOT NULL"
+    ")",
+    "CREATE INDEX IF NOT EXISTS ix_gpx_versions_gpx_id ON elsr.gpx_versions (gpx_id)",
+    "CREATE INDEX IF NOT EXISTS ix_gpx_versions_blob ON elsr.gpx_versions (blob)",
+    "ALTER TABLE elsr.gpx ADD COLUMN IF NOT EXISTS version_id integer",
+]
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Create the gpx_versions table and give every existing route its first version
+# -------------------------------------------------------------------------------------------------------------- #
+
+def migrate() -> None:
+    """
+    Safe to run more than once, routes which already have a version are left alone.
+    Run with: python -m core.database.migrations.m006_gpx_versions
+    """
+    with app.app_context():
+        for sql in SQL:
+            db.session.execute(text(sql))
+        db.session.commit()
+
+    gpxes: list[GpxModel] = GpxRepository.all_gpxes()
+    for gpx in gpxes:
+        version = current_gpx_version(gpx)
+        if version:
+            print(f"gpx_id = '{gpx.id}' ({gpx.name}) is at version_id = '{version.id}', blob '{version.blob}'.")
+        else:
+            print(f"Failed to version gpx_id = '{gpx.id}' ({gpx.name}).")
+
+
+if __name__ == "__main__":
+    migrate()
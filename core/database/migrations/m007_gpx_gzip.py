@@ -0,0 +1,35 @@
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.repositories.gpx_repository import GpxModel, GpxRepository
+from core.subs_gpx_edit import gpx_file_lock
+from core.subs_gpx_storage import compress_gpx, gpx_exists
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Gzip every route's GPX file
+# -------------------------------------------------------------------------------------------------------------- #
+
+def migrate() -> None:
+    """
+    No schema changes, just swaps each plain "gpx_42.gpx" for "gpx_42.gpx.gz". The site reads either, so this
+    can run while it's up. Safe to run more than once.
+    Run with: python -m core.database.migrations.m007_gpx_gzip
+    """
+    gpxes: list[GpxModel] = GpxRepository.all_gpxes()
+    for gpx in gpxes:
+        if not gpx_exists(gpx.filename):
+            print(f"Missing GPX file for gpx_id = '{gpx.id}' ({gpx.name}).")
+            continue
+
+        try:
+            with gpx_file_lock(gpx.filename):
+                if compress_gpx(gpx.filename):
+                    print(f"Compressed gpx_id = '{gpx.id}' ({gpx.name}).")
+        except Exception as e:
+            print(f"Failed to compress gpx_id = '{gpx.id}' ({gpx.name}), error code was '{e.args}'.")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,75 @@
+import os
+from sqlalchemy import text
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db, CONFIG_FOLDER
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Schema changes
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Where the counts used to live, in CONFIG_FOLDER. NB Not imported from subs_google_maps, as that reads the new
+# table as soon as it's imported.
+MAP_COUNT_FILENAME = "map_counts.csv"
+
+SQL = [
+    "CREATE TABLE IF NOT EXISTS elsr.map_counts ("
+    "   day varchar(8) PRIMARY KEY,"
+    "   count integer NOT NULL"
+    ")",
+]
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Move the map load counts from map_counts.csv into the dB
+# -------------------------------------------------------------------------------------------------------------- #
+
+def read_csv_counts(filename: str) -> dict[str, int]:
+    """
+    :param filename:                    The old map_counts.csv, lines of "20231111,1234"
+    :return:                            Count for each day (added up, in case a day appears twice)
+    """
+    counts: dict[str, int] = {}
+    with open(filename, 'r') as file:
+        for line in file:
+            try:
+                day, count = line.strip().split(',')[0:2]
+                counts[day.strip()] = counts.get(day.strip(), 0) + int(count)
+            except ValueError:
+                pass
+    return counts
+
+
+def migrate() -> None:
+    """
+    Safe to run more than once, days already in the dB are left alone.
+    Run with: python -m core.database.migrations.m008_map_counts
+    """
+    filename = os.path.join(CONFIG_FOLDER, os.path.basename(MAP_COUNT_FILENAME))
+    counts = read_csv_counts(filename) if os.path.exists(filename) else {}
+
+    with app.app_context():
+        try:
+            for sql in SQL:
+                db.session.execute(text(sql))
+
+            for day, count in counts.items():
+                db.session.execute(text("INSERT INTO elsr.map_counts (day, count) VALUES (:day, :count) "
+                                        "ON CONFLICT (day) DO NOTHING"),
+                                   {"day": day, "count": count})
+
+            db.session.commit()
+            print(f"Created map_counts table, copied {len(counts)} days from '{filename}'.")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"Migration failed, error code '{e.args}'.")
+
+
+if __name__ == "__main__":
+    migrate()
@@ -0,0 +1,63 @@
+import os
+from sqlalchemy import text
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db, CONFIG_FOLDER
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Schema changes
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Where the maps on / off switch used to live, in CONFIG_FOLDER
+MAP_STATUS_FILENAME = "map_status.txt"
+
+SQL = [
+    "CREATE SEQUENCE IF NOT EXISTS elsr.site_flags_version_seq",
+    "CREATE TABLE IF NOT EXISTS elsr.site_flags ("
+    "   name varchar(50) PRIMARY KEY,"
+    "   value text NOT NULL,"
+    "   version bigint NOT NULL"
+    ")",
+]
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Move the maps status from map_status.txt into the dB
+# -------------------------------------------------------------------------------------------------------------- #
+
+def migrate() -> None:
+    """
+    Safe to run more than once, a flag already in the dB is left alone.
+    Run with: python -m core.database.migrations.m009_site_flags
+    """
+    filename = os.path.join(CONFIG_FOLDER, os.path.basename(MAP_STATUS_FILENAME))
+    map_status = "False"
+    if os.path.exists(filename):
+        with open(filename, 'r') as file:
+            map_status = "True" if file.readline().strip() == "True" else "False"
+
+    with app.app_context():
+        try:
+            for sql in SQL:
+                db.session.execute(text(sql))
+
+            db.session.execute(text("INSERT INTO elsr.site_flags (name, value, version) "
+                                    "VALUES ('maps_enabled', :value, nextval('elsr.site_flags_version_seq')) "
+                                    "ON CONFLICT (name) DO NOTHING"),
+                               {"value": map_status})
+
+            db.session.commit()
+            print(f"Created site_flags table, maps_enabled = '{map_status}' from '{filename}'.")
+
+        except Exception as e:
+            db.session.rollback()
+            print(f"Migration failed, error code '{e.args}'.")
+
+
+if __name__ == "__main__":
+    migrate()
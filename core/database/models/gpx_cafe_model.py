@@ -0,0 +1,43 @@
+# -------------------------------------------------------------------------------------------------------------- #
+# Import db object from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Define GPX <-> Cafe link Model Class
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class GpxCafeModel(db.Model):  # type: ignore
+    __tablename__ = 'gpx_cafes'
+    __table_args__ = (
+        # NB The primary key (gpx_id, cafe_id) already indexes gpx_id, this one is for looking up by cafe
+        db.Index('ix_gpx_cafes_cafe_id', 'cafe_id'),
+        {'schema': 'elsr'},
+    )
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Define the table
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    # One row per cafe a route passes
+    gpx_id: int = db.Column(db.Integer, primary_key=True)
+    cafe_id: int = db.Column(db.Integer, primary_key=True)
+
+    # How close the route gets to the cafe
+    dist_km: float = db.Column(db.Float, nullable=False)
+
+    # How far along the route the cafe is
+    range_km: float = db.Column(db.Float, nullable=False)
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Repr
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    def __repr__(self) -> str:
+        return f'<GpxCafe gpx_id={self.gpx_id}, cafe_id={self.cafe_id}>'
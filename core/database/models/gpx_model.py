@@ -17,7 +17,17 @@ from core import db
 
 class GpxModel(db.Model):  # type: ignore
     __tablename__ = 'gpx'
-    __table_args__ = {'schema': 'elsr'}
+    __table_args__ = (
+        # For the route search, the sortable columns include id so keyset pagination can use them directly
+        db.Index('ix_gpx_name_id', 'name', 'id'),
+        db.Index('ix_gpx_length_km_id', 'length_km', 'id'),
+        db.Index('ix_gpx_ascent_m_id', 'ascent_m', 'id'),
+        db.Index('ix_gpx_type', 'type'),
+        db.Index('ix_gpx_direction', 'direction'),
+        db.Index('ix_gpx_public', 'public'),
+        db.Index('ix_gpx_email', 'email'),
+        {'schema': 'elsr'},
+    )
 
     # ---------------------------------------------------------------------------------------------------------- #
     # Define the table
@@ -36,7 +46,8 @@ class GpxModel(db.Model):  # type: ignore
     length_km: float = db.Column(db.Float, nullable=False)
     ascent_m: float = db.Column(db.Float, nullable=False)
 
-    # This will be a JSON of cafe details for cafes passed
+    # Legacy JSON of cafe details for cafes passed, no longer read or updated (see GpxCafeModel), but it's
+    # NOT NULL so new rows still get "[]"
     # eg [
     #      {"cafe_id": 1, "dist_km": 0.1, "range_km": 70},
     #      {"cafe_id": 2, "dist_km": 0.2, "range_km": 30}
@@ -64,6 +75,18 @@ class GpxModel(db.Model):  # type: ignore
     # Clockwise, Anticlockwise or N/A
     direction: str = db.Column(db.Text)
 
+    # Bounding box of the route, so we can skip routes which can't pass a cafe without opening the file
+    min_lat: float = db.Column(db.Float)
+    max_lat: float = db.Column(db.Float)
+    min_lon: float = db.Column(db.Float)
+    max_lon: float = db.Column(db.Float)
+
+    # JSON list of the coarse grid cells the route passes through eg '["2342:45", "2342:46"]'
+    cells: str = db.Column(db.Text)
+
+    # Current GpxVersionModel, the GPX file is always a copy of this version's points
+    version_id: int = db.Column(db.Integer)
+
     # ---------------------------------------------------------------------------------------------------------- #
     # Repr
     # ---------------------------------------------------------------------------------------------------------- #
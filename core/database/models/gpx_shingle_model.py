@@ -0,0 +1,39 @@
+# -------------------------------------------------------------------------------------------------------------- #
+# Import db object from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Define GPX Shingle Model Class
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class GpxShingleModel(db.Model):  # type: ignore
+    __tablename__ = 'gpx_shingles'
+    __table_args__ = (
+        # NB The primary key (shingle, gpx_id) is the lookup, this one is for replacing / deleting a route's shingles
+        db.Index('ix_gpx_shingles_gpx_id', 'gpx_id'),
+        {'schema': 'elsr'},
+    )
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Define the table
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    # Hash of a run of grid cells the route passes through, see subs_gpx_fingerprint.route_shingles()
+    shingle: int = db.Column(db.BigInteger, primary_key=True)
+
+    # One row per shingle per route
+    gpx_id: int = db.Column(db.Integer, primary_key=True)
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Repr
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    def __repr__(self) -> str:
+        return f'<GpxShingle gpx_id={self.gpx_id}, shingle={self.shingle}>'
@@ -0,0 +1,65 @@
+# -------------------------------------------------------------------------------------------------------------- #
+# Import db object from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# What made each version
+VERSION_UPLOAD = "upload"
+VERSION_CUT_START = "cut_start"
+VERSION_CUT_END = "cut_end"
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Define GPX Version Model Class
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class GpxVersionModel(db.Model):  # type: ignore
+    __tablename__ = 'gpx_versions'
+    __table_args__ = (
+        db.Index('ix_gpx_versions_gpx_id', 'gpx_id'),
+        db.Index('ix_gpx_versions_blob', 'blob'),
+        {'schema': 'elsr'},
+    )
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Define the table
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    # Primary reference
+    id: int = db.Column(db.Integer, primary_key=True)
+
+    # Route this is a version of, GpxModel.version_id points at the current one
+    gpx_id: int = db.Column(db.Integer, nullable=False)
+
+    # SHA-256 of the points, see subs_gpx_blobs. Blobs never change, so versions and routes can share them.
+    blob: str = db.Column(db.String(64), nullable=False)
+
+    # This version of the route is points[start:end] of the blob
+    start: int = db.Column(db.Integer, nullable=False)
+    end: int = db.Column(db.Integer, nullable=False)
+
+    # The version this was edited from, which is what undo goes back to
+    parent_id: int = db.Column(db.Integer)
+
+    # What made this version eg VERSION_CUT_START
+    action: str = db.Column(db.String(20), nullable=False)
+
+    # Unix time
+    created: int = db.Column(db.Integer, nullable=False)
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Repr
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    def __repr__(self) -> str:
+        return f'<GpxVersion id={self.id}, gpx_id={self.gpx_id}, {self.action} [{self.start}:{self.end}]>'
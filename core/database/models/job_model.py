@@ -0,0 +1,75 @@
+# -------------------------------------------------------------------------------------------------------------- #
+# Import db object from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Kinds of job
+JOB_GPX_CAFES = "gpx_cafes"
+JOB_RIDE_EMAILS = "ride_emails"
+JOB_HEATMAP = "heatmap"
+
+# Life cycle of a job
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Define Job Model Class
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class JobModel(db.Model):  # type: ignore
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        # Workers look for the oldest queued job, route pages look for the latest job for their GPX
+        db.Index('ix_jobs_status_id', 'status', 'id'),
+        db.Index('ix_jobs_gpx_id', 'gpx_id'),
+        {'schema': 'elsr'},
+    )
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Define the table
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    id: int = db.Column(db.Integer, primary_key=True)
+
+    # What to do, eg JOB_GPX_CAFES
+    kind: str = db.Column(db.String(20), nullable=False)
+
+    # What to do it to, either can be None depending on the kind of job
+    gpx_id: int = db.Column(db.Integer)
+    calendar_id: int = db.Column(db.Integer)
+
+    # JOB_QUEUED, JOB_RUNNING, JOB_DONE or JOB_FAILED
+    status: str = db.Column(db.String(10), nullable=False)
+
+    # How many times a worker has picked it up
+    attempts: int = db.Column(db.Integer, nullable=False, default=0)
+
+    # Why the last attempt failed
+    error: str = db.Column(db.String(500))
+
+    # Use Unix epoch time (rounded to an Int)
+    created: int = db.Column(db.Integer)
+    updated: int = db.Column(db.Integer)
+
+    # Don't run before this time, used to back off between retries
+    run_after: int = db.Column(db.Integer)
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Repr
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    def __repr__(self) -> str:
+        return f'<Job {self.id} "{self.kind}" {self.status}>'
@@ -0,0 +1,37 @@
+# -------------------------------------------------------------------------------------------------------------- #
+# Import db object from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Define Map Count Model Class
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class MapCountModel(db.Model):  # type: ignore
+    __tablename__ = 'map_counts'
+    __table_args__ = (
+        {'schema': 'elsr'},
+    )
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Define the table
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    # One row per day, in the format "20231111" so they sort in date order
+    day: str = db.Column(db.String(8), primary_key=True)
+
+    # Number of Google map loads that day
+    count: int = db.Column(db.Integer, nullable=False)
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Repr
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    def __repr__(self) -> str:
+        return f'<MapCount {self.day}: {self.count}>'
@@ -0,0 +1,48 @@
+# -------------------------------------------------------------------------------------------------------------- #
+# Import db object from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Every write takes the next number from this, so max(version) tells a worker if anything has changed
+SITE_FLAG_VERSION_SEQUENCE = "elsr.site_flags_version_seq"
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Define Site Flag Model Class
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class SiteFlagModel(db.Model):  # type: ignore
+    __tablename__ = 'site_flags'
+    __table_args__ = (
+        {'schema': 'elsr'},
+    )
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Define the table
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    # eg "maps_enabled"
+    name: str = db.Column(db.String(50), primary_key=True)
+
+    # Stored as a string, it's up to the caller what goes in it (eg "True" or some JSON)
+    value: str = db.Column(db.Text, nullable=False)
+
+    # From SITE_FLAG_VERSION_SEQUENCE, bumped on every write
+    version: int = db.Column(db.BigInteger, nullable=False)
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Repr
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    def __repr__(self) -> str:
+        return f'<SiteFlag {self.name}: {self.value} (v{self.version})>'
@@ -1,6 +1,6 @@
 from datetime import date
-import json
 from typing import Any
+from sqlalchemy import func
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -9,6 +9,7 @@ from typing import Any
 
 from core import db, app
 from core.database.models.cafe_model import CafeModel
+from core.database.models.gpx_cafe_model import GpxCafeModel
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -190,6 +191,20 @@ class CafeRepository:
             # Will return nothing if id is invalid
             return cafe
 
+    @staticmethod
+    def all_by_ids(ids: list[int]) -> dict[int, CafeModel]:
+        """
+        Look up a set of cafes in one query, rather than one_by_id() for each of them.
+        :param ids:                     Cafe IDs (duplicates and None are fine eg a ride to a new cafe)
+        :return:                        {id: cafe}, NB unknown cafes just aren't in it
+        """
+        ids = list({item_id for item_id in ids if item_id is not None})
+        if not ids:
+            return {}
+        with app.app_context():
+            cafes = CafeModel.query.filter(CafeModel.id.in_(ids)).all()  # type: ignore
+            return {cafe.id: cafe for cafe in cafes}
+
     @staticmethod
     def one_by_name(name: str) -> CafeModel | None:
         with app.app_context():
@@ -203,6 +218,19 @@ class CafeRepository:
             cafes = CafeModel.query.filter_by(added_email=email).all()
             return cafes
 
+    @staticmethod
+    def location_signature() -> tuple[Any, ...]:
+        """
+        Cheap summary of all the cafe locations (count, max id, sum of lat and lon). If any cafe is added, moved or
+        deleted, this changes, so it can be used to tell if a cached copy of the cafe locations is out of date.
+        :return:            Tuple of the four aggregates.
+        """
+        with app.app_context():
+            return tuple(db.session.query(func.count(CafeModel.id),
+                                          func.max(CafeModel.id),
+                                          func.sum(CafeModel.lat),
+                                          func.sum(CafeModel.lon)).one())
+
     # -------------------------------------------------------------------------------------------------------------- #
     # Other
     # -------------------------------------------------------------------------------------------------------------- #
@@ -218,65 +246,45 @@ class CafeRepository:
     # Properties
     # -------------------------------------------------------------------------------------------------------------- #
     @staticmethod
-    def cafes_passed_by_gpx(cafes_passed: str) -> list[dict[str, Any]]:
+    def cafes_passed_by_gpx(gpx_id: int) -> list[dict[str, Any]]:
         """
-        Convert the cafes_passed JSON string from the GPX database into a list of dictionaries for jinja to use in the gpx_details.html template.
-        :param cafes_passed:                This is the string from gpx.cafes_passed which is a JSON string, comprising
-                                            a list of dictionaries of the form:
-                                            {"cafe_id": int, "dist_km": float, "range_km": float}
+        Look up the cafes a route passes (from the gpx_cafes link table) as a list of dictionaries for jinja to use
+        in the gpx_details.html template.
+        :param gpx_id:                      ID of the route
         :return:                            Return a sorted list of dictionaries for jinja to use to display cafe details.
                                             The list if sorted by range and the dictionary format is:
                                             'id':           An identifier for the café, typically an integer.
                                             'name':         The name of the café, typically a string.
                                             'lat':          Latitude coordinate of the café, typically a float.
                                             'lon':          Longitude coordinate of the café, typically a float.
-                                            'dist_km':      The distance of the café in kilometers, which can be a float or `None` if no data is available.
-                                            'range_km':     The range of the café in kilometers, which can be a float or `None` if no data is available.
+                                            'dist_km':      The distance of the café in kilometers.
+                                            'range_km':     The range of the café in kilometers.
                                             'status':       The active status of the café, typically a boolean (`True` or `False`).
         """
         # ----------------------------------------------------------- #
-        # Validate cafes_passed JSON string
-        # ----------------------------------------------------------- #
-        try:
-            cafes_json: list[dict[str, Any]] = json.loads(cafes_passed)
-        except Exception:
-            # Failed to parse JSON for some reason
-            return []
-
-        if not cafes_json:
-            # No cafes
-            return []
-
-        # ----------------------------------------------------------- #
-        # Get a list of IDs
+        # One join, already sorted by range
         # ----------------------------------------------------------- #
-        cafe_ids: list[int] = [dct["cafe_id"] for dct in cafes_json]
-
-        # ----------------------------------------------------------- #
-        # Get all cafes from those IDs
-        # ----------------------------------------------------------- #
-        if cafe_ids:
-            with app.app_context():
-                cafes: list[CafeModel] = CafeModel.query.filter(CafeModel.id.in_(cafe_ids)).all()  # type: ignore
+        with app.app_context():
+            rows = db.session.query(CafeModel, GpxCafeModel) \
+                             .join(GpxCafeModel, GpxCafeModel.cafe_id == CafeModel.id) \
+                             .filter(GpxCafeModel.gpx_id == gpx_id) \
+                             .order_by(GpxCafeModel.range_km) \
+                             .all()
 
         # ----------------------------------------------------------- #
         # Build our return list of cafe info
         # ----------------------------------------------------------- #
         cafe_list: list[dict[str, Any]] = []
-        for cafe in cafes:
-            cafe_json: dict[str, Any] | None = next((dct for dct in cafes_json if dct["cafe_id"] == cafe.id), None)
+        for cafe, link in rows:
             cafe_summary: dict[str, Any] = {
                 'id': cafe.id,
                 'name': cafe.name,
                 'lat': cafe.lat,
                 'lon': cafe.lon,
-                'dist_km': cafe_json['dist_km'] if cafe_json else None,
-                'range_km': cafe_json['range_km'] if cafe_json else None,
+                'dist_km': link.dist_km,
+                'range_km': link.range_km,
                 'status': cafe.active,
             }
             cafe_list.append(cafe_summary)
 
-        # ----------------------------------------------------------- #
-        # Sort by range
-        # ----------------------------------------------------------- #
-        return sorted(cafe_list, key=lambda x: x['range_km'])
+        return cafe_list
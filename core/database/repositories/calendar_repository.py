@@ -1,5 +1,6 @@
 from datetime import datetime, timedelta, date
 import time
+from sqlalchemy import or_, case
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -77,22 +78,48 @@ class CalendarRepository:
     # -------------------------------------------------------------------------------------------------------------- #
     @staticmethod
     def mark_email_sent(ride_id: int) -> bool:
+        """
+        Flag that we've sent (or are about to send) the email alerts for a ride. This is a single conditional
+        UPDATE, so if a job is retried, or two workers get the same ride, only one of them gets True back.
+        :param ride_id:                 Ride
+        :return:                        True if we set the flag, False if it was already set (or the dB failed)
+        """
         with app.app_context():
-            ride = CalendarModel.query.filter_by(id=ride_id).first()
-            if ride:
-                # Modify
-                try:
-                    ride.sent_email = "True"
-                    db.session.commit()
-                    return True
+            try:
+                count = CalendarModel.query.filter(CalendarModel.id == ride_id,
+                                                   or_(CalendarModel.sent_email == None,
+                                                       CalendarModel.sent_email != "True")) \
+                                           .update({"sent_email": "True"})
+                db.session.commit()
+                return count == 1
 
-                except Exception as e:
-                    db.session.rollback()
-                    app.logger.error(f"db_calendar: Failed to set email sent for ride_id = '{ride.id}', "
-                                     f"error code '{e.args}'.")
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_calendar: Failed to set email sent for ride_id = '{ride_id}', "
+                                 f"error code '{e.args}'.")
 
         return False
 
+    @staticmethod
+    def move_rides_to_gpx(old_gpx_id: int, new_gpx_id: int) -> bool:
+        """
+        Point every ride using one route at another, eg when an uploader swaps their copy for an existing route.
+        :param old_gpx_id:              Route the rides use now
+        :param new_gpx_id:              Route they should use
+        :return:                        True if it worked
+        """
+        with app.app_context():
+            try:
+                CalendarModel.query.filter_by(gpx_id=old_gpx_id).update({"gpx_id": new_gpx_id})
+                db.session.commit()
+                return True
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_calendar: Failed to move rides from gpx_id = '{old_gpx_id}' to "
+                                 f"gpx_id = '{new_gpx_id}', error code '{e.args}'.")
+                return False
+
     # -------------------------------------------------------------------------------------------------------------- #
     # Delete
     # -------------------------------------------------------------------------------------------------------------- #
@@ -134,13 +161,25 @@ class CalendarRepository:
     # Return all events for a specific day
     @staticmethod
     def all_calendar_date(ride_date: str) -> list[CalendarModel]:
+        return CalendarRepository.all_calendar_dates([ride_date])
+
+    @staticmethod
+    def all_calendar_dates(ride_dates: list[str]) -> list[CalendarModel]:
+        """
+        All the rides on a set of days in a single query eg a whole weekend.
+        :param ride_dates:                  Dates in the format "DDMMYYYY"
+        :return:                            Rides ordered by group (as GROUP_CHOICES) so they are ordered on the
+                                            webpage, NB rides in any other group are left out
+        """
+        # GROUP_CHOICES order, done in SQL
+        group_order = case({group: index for index, group in enumerate(GROUP_CHOICES)}, value=CalendarModel.group)
+
         with app.app_context():
-            rides = []
-            # We want them ordered by group so they are ordered on the webpage
-            for group in GROUP_CHOICES:
-                ride_set = CalendarModel.query.filter_by(date=ride_date).filter_by(group=group).all()
-                for ride in ride_set:
-                    rides.append(ride)
+            on_those_days = CalendarModel.date.in_(ride_dates)  # type: ignore
+            in_a_group = CalendarModel.group.in_(GROUP_CHOICES)  # type: ignore
+            rides = CalendarModel.query.filter(on_those_days) \
+                .filter(in_a_group) \
+                .order_by(group_order, CalendarModel.id).all()
             return rides
 
     @staticmethod
@@ -1,16 +1,24 @@
 from datetime import date
 import json
-from sqlalchemy import func, cast, Integer
-from sqlalchemy.dialects.postgresql import JSON
+import os
+import time
+from typing import Any
+from sqlalchemy import func, cast, select, tuple_, Integer
+from sqlalchemy.dialects.postgresql import JSON, insert
 
 
 # -------------------------------------------------------------------------------------------------------------- #
 # Import our own classes etc
 # -------------------------------------------------------------------------------------------------------------- #
 
-from core import app, db, GRAVEL_CHOICE
+from core import app, db, GRAVEL_CHOICE, GPX_UPLOAD_FOLDER_ABS
 from core.subs_gpx_direction import gpx_direction
+from core.subs_route_index import route_segment_index
 from core.database.models.gpx_model import GpxModel
+from core.database.models.gpx_cafe_model import GpxCafeModel
+from core.database.models.gpx_shingle_model import GpxShingleModel
+from core.database.models.gpx_version_model import GpxVersionModel
+from core.database.models.cafe_model import CafeModel
 from core.database.models.user_model import UserModel
 
 
@@ -25,6 +33,22 @@ TYPES = [TYPE_ROAD,
          TYPE_GRAVEL,
          "MTB"]
 
+# What track_direction() can return
+DIRECTIONS = ["CW", "CCW", "Not Circular"]
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants used for the route search
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Columns we can sort by, each has an index on (column, id) for keyset pagination
+SEARCH_SORT_COLUMNS = {'name': GpxModel.name,
+                       'length_km': GpxModel.length_km,
+                       'ascent_m': GpxModel.ascent_m,
+                       'id': GpxModel.id}
+SEARCH_PAGE_SIZE = 25
+SEARCH_MAX_PAGE_SIZE = 100
+
 
 # -------------------------------------------------------------------------------------------------------------- #
 # -------------------------------------------------------------------------------------------------------------- #
@@ -59,6 +83,39 @@ class GpxRepository:
                                  f"error code '{e.args}'.")
                 return None
             
+    @staticmethod
+    def add_gpx_with_cafes(new_gpx: GpxModel, cafes: list[tuple[int, float, float]]) -> GpxModel | None:
+        """
+        Add a fully analysed route and the cafes it passes in one transaction.
+        :param new_gpx:                     Route, with everything but id and filename filled in
+        :param cafes:                       List of (cafe_id, dist_to_cafe_km, dist_along_route_km)
+        :return:                            The route (with id and filename set) or None if it failed
+        """
+        # Update some details
+        new_gpx.date = date.today().strftime("%d%m%Y")
+
+        with app.app_context():
+            try:
+                # Need the id before we can name the file
+                db.session.add(new_gpx)
+                db.session.flush()
+                new_gpx.filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, f"gpx_{new_gpx.id}.gpx")
+
+                db.session.add_all([GpxCafeModel(gpx_id=new_gpx.id,
+                                                 cafe_id=cafe_id,
+                                                 dist_km=round(dist_to_cafe_km, 1),
+                                                 range_km=round(dist_along_route_km, 1))
+                                    for cafe_id, dist_to_cafe_km, dist_along_route_km in cafes])
+                db.session.commit()
+                db.session.refresh(new_gpx)
+                return new_gpx
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_gpx: Failed to add GPX '{new_gpx.name}', "
+                                 f"error code '{e.args}'.")
+                return None
+
     # -------------------------------------------------------------------------------------------------------------- #
     # Modify
     # -------------------------------------------------------------------------------------------------------------- #
@@ -113,112 +170,264 @@ class GpxRepository:
     @staticmethod
     def clear_cafe_list(gpx_id: int) -> bool:
         with app.app_context():
-            gpx = GpxModel.query.filter_by(id=gpx_id).first()
-            if gpx:
-                try:
-                    # Note, the cafes_passed is a JSON string, not a list!
-                    gpx.cafes_passed = "[]"
-                    db.session.commit()
-                    return True
+            try:
+                GpxCafeModel.query.filter_by(gpx_id=gpx_id).delete()
+                db.session.commit()
+                return True
 
-                except Exception as e:
-                    db.session.rollback()
-                    app.logger.error(f"db_gpx: Failed to clear cafe list for gpx_id = '{gpx.id}', "
-                                     f"error code '{e.args}'.")
-                    return False
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_gpx: Failed to clear cafe list for gpx_id = '{gpx_id}', "
+                                 f"error code '{e.args}'.")
+                return False
 
-        return False
+    @staticmethod
+    def update_cafe_list(gpx_id: int, cafe_id: int, dist_to_cafe_km: float, dist_along_route_km: float) -> bool:
+        with app.app_context():
+            try:
+                # Single row upsert, so we never have to read back the rest of the route's cafes
+                statement = insert(GpxCafeModel).values(gpx_id=gpx_id,
+                                                        cafe_id=cafe_id,
+                                                        dist_km=round(dist_to_cafe_km, 1),
+                                                        range_km=round(dist_along_route_km, 1))
+                statement = statement.on_conflict_do_update(
+                    index_elements=[GpxCafeModel.gpx_id, GpxCafeModel.cafe_id],
+                    set_={"dist_km": statement.excluded.dist_km,
+                          "range_km": statement.excluded.range_km})
+                db.session.execute(statement)
+                db.session.commit()
+                return True
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_gpx: Failed to update cafe list for gpx_id = '{gpx_id}', "
+                                 f"error code '{e.args}'.")
+                return False
 
     @staticmethod
-    def update_cafe_list(gpx_id: int, cafe_id: int, dist_to_cafe_km: float, dist_along_route_km: float):
+    def set_cafe_list(gpx_id: int, cafes: list[tuple[int, float, float]]) -> bool:
+        """
+        Replace all the cafes a route passes in one transaction.
+        :param gpx_id:                      ID of the route
+        :param cafes:                       List of (cafe_id, dist_to_cafe_km, dist_along_route_km)
+        :return:                            True if it worked
+        """
         with app.app_context():
-            gpx = GpxModel.query.filter_by(id=gpx_id).first()
-            if gpx:
-                try:
-                    # Get the list of cafes passed
-                    # eg [  {"cafe_id": 1, "dist_km": 0.1, "range_km": 70},
-                    #       {"cafe_id": 2, "dist_km": 0.2, "range_km": 30}
-                    #    ]
-                    cafes_json = json.loads(gpx.cafes_passed)
-                    updated = False
-
-                    for cafe in cafes_json:
-                        if cafe['cafe_id'] == cafe_id:
-                            cafe['dist_km'] = round(dist_to_cafe_km, 1)
-                            cafe['range_km'] = round(dist_along_route_km, 1)
-                            updated = True
-
-                    if not updated:
-                        # Tag on the end
-                        cafes_json.append({
-                            "cafe_id":  cafe_id,
-                            "dist_km":  round(dist_to_cafe_km, 1),
-                            "range_km": round(dist_along_route_km, 1)
-                        })
-
-                    # Push back to gpx
-                    gpx.cafes_passed = json.dumps(cafes_json)
+            try:
+                GpxCafeModel.query.filter_by(gpx_id=gpx_id).delete()
+                db.session.add_all([GpxCafeModel(gpx_id=gpx_id,
+                                                 cafe_id=cafe_id,
+                                                 dist_km=round(dist_to_cafe_km, 1),
+                                                 range_km=round(dist_along_route_km, 1))
+                                    for cafe_id, dist_to_cafe_km, dist_along_route_km in cafes])
+                db.session.commit()
+                return True
 
-                    # Update dB
-                    db.session.commit()
-                    return True
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_gpx: Failed to set cafe list for gpx_id = '{gpx_id}', "
+                                 f"error code '{e.args}'.")
+                return False
 
-                except Exception as e:
-                    db.session.rollback()
-                    app.logger.error(f"db_gpx: Failed to update cafe list for gpx_id = '{gpx.id}', "
-                                     f"error code '{e.args}'.")
-                    return False
+    @staticmethod
+    def set_shingles(gpx_id: int, shingles: list[int]) -> bool:
+        """
+        Replace a route's fingerprint in one transaction.
+        :param gpx_id:                      ID of the route
+        :param shingles:                    From subs_gpx_fingerprint.route_shingles()
+        :return:                            True if it worked
+        """
+        with app.app_context():
+            try:
+                GpxShingleModel.query.filter_by(gpx_id=gpx_id).delete()
+                if shingles:
+                    db.session.execute(insert(GpxShingleModel),
+                                       [{"shingle": shingle, "gpx_id": gpx_id} for shingle in shingles])
+                db.session.commit()
+                return True
 
-        return False
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_gpx: Failed to set shingles for gpx_id = '{gpx_id}', "
+                                 f"error code '{e.args}'.")
+                return False
+
+    @staticmethod
+    def add_version(gpx_id: int, blob: str, start: int, end: int, parent_id: int | None,
+                    action: str) -> GpxVersionModel | None:
+        """
+        Add a new version of a route and make it the current one, in one transaction.
+        :param gpx_id:                      ID of the route
+        :param blob:                        Hash of the points, see subs_gpx_blobs
+        :param start:                       This version is points[start:end] of the blob
+        :param end:                         This version is points[start:end] of the blob
+        :param parent_id:                   Version it was edited from (None for an upload)
+        :param action:                      What made it eg VERSION_CUT_START
+        :return:                            The new version or None if it failed
+        """
+        version = GpxVersionModel(gpx_id=gpx_id, blob=blob, start=start, end=end, parent_id=parent_id,
+                                  action=action, created=int(time.time()))
+        with app.app_context():
+            try:
+                db.session.add(version)
+                db.session.flush()
+                GpxModel.query.filter_by(id=gpx_id).update({"version_id": version.id})
+                db.session.commit()
+                db.session.refresh(version)
+                return version
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_gpx: Failed to add version for gpx_id = '{gpx_id}', "
+                                 f"error code '{e.args}'.")
+                return None
+
+    @staticmethod
+    def set_version(gpx_id: int, version_id: int) -> bool:
+        """
+        Point a route at one of its existing versions, eg for undo.
+        :param gpx_id:                      ID of the route
+        :param version_id:                  One of its versions
+        :return:                            True if it worked
+        """
+        with app.app_context():
+            try:
+                count = GpxModel.query.filter_by(id=gpx_id).update({"version_id": version_id})
+                db.session.commit()
+                return count == 1
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_gpx: Failed to set version_id = '{version_id}' for gpx_id = '{gpx_id}', "
+                                 f"error code '{e.args}'.")
+                return False
+
+    @staticmethod
+    def apply_cafe_link_changes(gpx_ids: list[int], removed: list[tuple[int, int]],
+                                upserts: list[tuple[int, int, float, float]]) -> bool:
+        """
+        Used by the bulk re-analysis, applies just what changed for the routes it checked, in one transaction.
+        Anything else (eg a route uploaded while it was running) is left alone.
+        :param gpx_ids:                     Routes which were re-analysed, nothing else is touched
+        :param removed:                     List of (gpx_id, cafe_id) which no longer match
+        :param upserts:                     List of (gpx_id, cafe_id, dist_to_cafe_km, dist_along_route_km) which
+                                            are new or have moved
+        :return:                            True if it worked
+        """
+        analysed = set(gpx_ids)
+        removed = [(gpx_id, cafe_id) for gpx_id, cafe_id in removed if gpx_id in analysed]
+        upserts = [link for link in upserts if link[0] in analysed]
+
+        with app.app_context():
+            try:
+                # Routes deleted while we were working them out don't get their links back
+                rows = db.session.query(GpxModel.id).filter(GpxModel.id.in_(analysed)).all()  # type: ignore
+                existing = {row.id for row in rows}
+                upserts = [link for link in upserts if link[0] in existing]
+
+                if removed:
+                    GpxCafeModel.query.filter(tuple_(GpxCafeModel.gpx_id, GpxCafeModel.cafe_id).in_(removed)) \
+                                      .delete(synchronize_session=False)
+
+                if upserts:
+                    statement = insert(GpxCafeModel).values([{"gpx_id": gpx_id,
+                                                              "cafe_id": cafe_id,
+                                                              "dist_km": round(dist_to_cafe_km, 1),
+                                                              "range_km": round(dist_along_route_km, 1)}
+                                                             for gpx_id, cafe_id, dist_to_cafe_km, dist_along_route_km
+                                                             in upserts])
+                    statement = statement.on_conflict_do_update(
+                        index_elements=[GpxCafeModel.gpx_id, GpxCafeModel.cafe_id],
+                        set_={"dist_km": statement.excluded.dist_km,
+                              "range_km": statement.excluded.range_km})
+                    db.session.execute(statement)
+
+                # Recount the cafes we touched from the table itself, so we include everyone else's links too
+                cafe_ids = {cafe_id for _, cafe_id in removed} | {cafe_id for _, cafe_id, _, _ in upserts}
+                if cafe_ids:
+                    num_routes = select(func.count(GpxCafeModel.gpx_id)) \
+                                 .where(GpxCafeModel.cafe_id == CafeModel.id) \
+                                 .scalar_subquery()
+                    cafes = CafeModel.query.filter(CafeModel.id.in_(cafe_ids))  # type: ignore
+                    cafes.update({"num_routes_passing": num_routes}, synchronize_session=False)
+
+                db.session.commit()
+                return True
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_gpx: Failed to apply cafe link changes, error code '{e.args}'.")
+                return False
 
     @staticmethod
     def remove_cafe_from_cafes_passed(gpx_id: int, cafe_id: int) -> bool:
         with app.app_context():
-            gpx = GpxModel.query.filter_by(id=gpx_id).first()
-            if gpx:
-                try:
-                    # Get the list of cafes passed
-                    # eg [  {"cafe_id": 1, "dist_km": 0.1, "range_km": 70},
-                    #       {"cafe_id": 2, "dist_km": 0.2, "range_km":30}
-                    #    ]
-                    cafes_json = json.loads(gpx.cafes_passed)
+            try:
+                GpxCafeModel.query.filter_by(gpx_id=gpx_id, cafe_id=cafe_id).delete()
+                db.session.commit()
+                return True
 
-                    for cafe in cafes_json:
-                        if cafe['cafe_id'] == cafe_id:
-                            # Need to remove this entry
-                            cafes_json.remove(cafe)
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_gpx: Failed to update cafe list for gpx_id = '{gpx_id}', "
+                                 f"error code '{e.args}'.")
+                return False
 
-                    # Push back to gpx
-                    gpx.cafes_passed = json.dumps(cafes_json)
+    @staticmethod
+    def remove_cafe_from_all_gpxes(cafe_id: int) -> bool:
+        with app.app_context():
+            try:
+                GpxCafeModel.query.filter_by(cafe_id=cafe_id).delete()
+                db.session.commit()
+                return True
 
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_gpx: Failed to remove cafe_id = '{cafe_id}' from all routes, "
+                                 f"error code '{e.args}'.")
+                return False
+
+    @staticmethod
+    def update_stats(gpx_id: int, length_km: float, ascent_m: float) -> bool:
+        with app.app_context():
+            gpx = GpxModel.query.filter_by(id=gpx_id).first()
+            if gpx:
+                try:
+                    # Update route stats
+                    gpx.length_km = round(length_km, 1)
+                    gpx.ascent_m = round(ascent_m, 1)
                     # Update dB
                     db.session.commit()
                     return True
 
                 except Exception as e:
                     db.session.rollback()
-                    app.logger.error(f"db_gpx: Failed to update cafe list for gpx_id = '{gpx.id}', "
+                    app.logger.error(f"db_gpx: Failed to update stats for gpx_id = '{gpx.id}', "
                                      f"error code '{e.args}'.")
                     return False
 
-        return False
+            return False
 
     @staticmethod
-    def update_stats(gpx_id: int, length_km: float, ascent_m: float) -> bool:
+    def update_footprint(gpx_id: int, min_lat: float, max_lat: float, min_lon: float, max_lon: float,
+                         cells: str) -> bool:
         with app.app_context():
             gpx = GpxModel.query.filter_by(id=gpx_id).first()
             if gpx:
                 try:
-                    # Update route stats
-                    gpx.length_km = round(length_km, 1)
-                    gpx.ascent_m = round(ascent_m, 1)
+                    # Update bounding box and coarse cells
+                    gpx.min_lat = min_lat
+                    gpx.max_lat = max_lat
+                    gpx.min_lon = min_lon
+                    gpx.max_lon = max_lon
+                    gpx.cells = cells
                     # Update dB
                     db.session.commit()
                     return True
 
                 except Exception as e:
                     db.session.rollback()
-                    app.logger.error(f"db_gpx: Failed to update stats for gpx_id = '{gpx.id}', "
+                    app.logger.error(f"db_gpx: Failed to update footprint for gpx_id = '{gpx.id}', "
                                      f"error code '{e.args}'.")
                     return False
 
@@ -268,6 +477,9 @@ class GpxRepository:
             if gpx:
                 # Delete the GPX file
                 try:
+                    GpxCafeModel.query.filter_by(gpx_id=gpx_id).delete()
+                    GpxShingleModel.query.filter_by(gpx_id=gpx_id).delete()
+                    GpxVersionModel.query.filter_by(gpx_id=gpx_id).delete()
                     db.session.delete(gpx)
                     db.session.commit()
                     return True
@@ -325,6 +537,71 @@ class GpxRepository:
             gpx = GpxModel.query.filter_by(id=id).first()
             return gpx
 
+    @staticmethod
+    def all_by_ids(ids: list[int]) -> dict[int, GpxModel]:
+        """
+        Look up a set of routes in one query, rather than one_by_id() for each of them.
+        :param ids:                     Route IDs (duplicates and None are fine)
+        :return:                        {id: route}, NB missing (deleted) routes just aren't in it
+        """
+        ids = list({item_id for item_id in ids if item_id is not None})
+        if not ids:
+            return {}
+        with app.app_context():
+            gpxes = GpxModel.query.filter(GpxModel.id.in_(ids)).all()  # type: ignore
+            return {gpx.id: gpx for gpx in gpxes}
+
+    @staticmethod
+    def cafes_passed(gpx_id: int) -> list[GpxCafeModel]:
+        with app.app_context():
+            links = GpxCafeModel.query.filter_by(gpx_id=gpx_id).order_by(GpxCafeModel.range_km).all()
+            return links
+
+    @staticmethod
+    def all_cafe_links() -> list[tuple[int, int, float, float]]:
+        with app.app_context():
+            rows = db.session.query(GpxCafeModel.gpx_id, GpxCafeModel.cafe_id,
+                                    GpxCafeModel.dist_km, GpxCafeModel.range_km).all()
+            return [tuple(row) for row in rows]
+
+    @staticmethod
+    def cafe_passed(gpx_id: int, cafe_id: int) -> GpxCafeModel | None:
+        with app.app_context():
+            link = GpxCafeModel.query.filter_by(gpx_id=gpx_id, cafe_id=cafe_id).first()
+            return link
+
+    @staticmethod
+    def cafe_links(gpx_ids: list[int]) -> dict[tuple[int, int], GpxCafeModel]:
+        """
+        Every cafe passed by a set of routes in one query, rather than cafe_passed() for each of them.
+        :param gpx_ids:                 Route IDs
+        :return:                        {(gpx_id, cafe_id): link}
+        """
+        gpx_ids = list(set(gpx_ids))
+        if not gpx_ids:
+            return {}
+        with app.app_context():
+            links = GpxCafeModel.query.filter(GpxCafeModel.gpx_id.in_(gpx_ids)).all()  # type: ignore
+            return {(link.gpx_id, link.cafe_id): link for link in links}
+
+    @staticmethod
+    def gpx_ids_passing_cafe(cafe_id: int) -> set[int]:
+        with app.app_context():
+            rows = db.session.query(GpxCafeModel.gpx_id).filter_by(cafe_id=cafe_id).all()
+            return {row.gpx_id for row in rows}
+
+    @staticmethod
+    def one_version(gpx_id: int, version_id: int | None) -> GpxVersionModel | None:
+        with app.app_context():
+            version = GpxVersionModel.query.filter_by(id=version_id, gpx_id=gpx_id).first()
+            return version
+
+    @staticmethod
+    def all_version_blobs() -> set[str]:
+        with app.app_context():
+            rows = db.session.query(GpxVersionModel.blob).distinct().all()
+            return {row.blob for row in rows}
+
     # -------------------------------------------------------------------------------------------------------------- #
     # Other
     # -------------------------------------------------------------------------------------------------------------- #
@@ -339,37 +616,254 @@ class GpxRepository:
     # -------------------------------------------------------------------------------------------------------------- #
     # Class method
     # -------------------------------------------------------------------------------------------------------------- #
+    @staticmethod
+    def visible_to(user: UserModel) -> Any:
+        """
+        SQL filter for the routes a user is allowed to see.
+        :param user:                        User's ORM (used to work out permissions)
+        :return:                            SQLAlchemy filter expression
+        """
+        # Tortuous logic as current_user won't have '.email' until authenticated....
+        if user.is_authenticated:
+            return (GpxModel.public == True) | (GpxModel.email == user.email)
+        return GpxModel.public == True
+
     @classmethod
     def find_all_gpx_passing_cafe(cls, cafe_id: int, user: UserModel) -> list[GpxModel]:
         """
-        Scan all the GPX files and see how many pass this cafe based on the GPXModel.cafes_passed
-        JSON field.
+        Find all the GPX files which pass this cafe using the gpx_cafes link table.
         :param cafe_id:                     Index of the cafe in question.
         :param user:                        User's ORM (used to work out permissions)
         :return:                            List of GPXes which pass this cafe (but with gpx.cafes_passed modified).
         """
-        # We return a list of GPXes which pass this cafe
-        passing_gpx = []
-        for gpx in cls.all_gpxes():
-
-            # Tortuous logic as current_user won't have '.email' until authenticated....
-            if gpx.public:
-                can_see = True
-            elif not user.is_authenticated:
-                can_see = False
-            elif user.email == gpx.email:
-                can_see = True
+        with app.app_context():
+            rows = db.session.query(GpxModel, GpxCafeModel) \
+                             .join(GpxCafeModel, GpxCafeModel.gpx_id == GpxModel.id) \
+                             .filter(GpxCafeModel.cafe_id == cafe_id) \
+                             .filter(cls.visible_to(user)) \
+                             .all()
+
+            # We return a list of GPXes which pass this cafe
+            passing_gpx = []
+            for gpx, link in rows:
+                # Alter the GPX object to just have one cafe passed as this is all the
+                # requesting webpage needs to know (it only cares about one cafe)
+                db.session.expunge(gpx)
+                gpx.cafes_passed = {"cafe_id": link.cafe_id, "dist_km": link.dist_km, "range_km": link.range_km}
+                passing_gpx.append(gpx)
+
+            return passing_gpx
+
+    @classmethod
+    def search(cls, user: UserModel, min_km: float | None = None, max_km: float | None = None,
+               min_ascent: float | None = None, max_ascent: float | None = None, route_type: str | None = None,
+               direction: str | None = None, cafe_id: int | None = None, author_id: int | None = None,
+               q: str | None = None, sort: str = 'name', descending: bool = False, after: list[Any] | None = None,
+               before: list[Any] | None = None,
+               limit: int = SEARCH_PAGE_SIZE) -> tuple[list[Any], list[Any] | None, list[Any] | None]:
+        """
+        Faceted route search with keyset pagination, only returning the columns the route list needs.
+        :param user:                        User's ORM (used to work out permissions)
+        :param min_km:                      Shortest route, or None
+        :param max_km:                      Longest route, or None
+        :param min_ascent:                  Least climbing, or None
+        :param max_ascent:                  Most climbing, or None
+        :param route_type:                  One of TYPES, or None
+        :param direction:                   One of DIRECTIONS, or None
+        :param cafe_id:                     Only routes passing this cafe, or None
+        :param author_id:                   Only routes uploaded by this user, or None
+        :param q:                           Only routes with this in their name (any case), or None
+        :param sort:                        Key of SEARCH_SORT_COLUMNS
+        :param descending:                  Sort backwards
+        :param after:                       Cursor for the next page, ie [sort value, id] of the last row we sent
+        :param before:                      Cursor for the previous page, ie [sort value, id] of the first row we
+                                            sent (ignored if we have after)
+        :param limit:                       Page size
+        :return:                            (rows, cursor for the next page or None if this is the last page,
+                                            cursor for the previous page or None if this is the first page)
+        """
+        sort_column = SEARCH_SORT_COLUMNS.get(sort, GpxModel.name)
+        limit = max(1, min(limit, SEARCH_MAX_PAGE_SIZE))
+
+        with app.app_context():
+            query = db.session.query(GpxModel.id, GpxModel.name, GpxModel.length_km, GpxModel.ascent_m,
+                                     GpxModel.type, GpxModel.direction, GpxModel.public, GpxModel.filename,
+                                     func.coalesce(UserModel.name, "Unknown").label('user_name')) \
+                              .outerjoin(UserModel, UserModel.email == GpxModel.email)
+
+            # ----------------------------------------------------------- #
+            # Permissions, Admins see everything
+            # ----------------------------------------------------------- #
+            if not (user.is_authenticated and user.admin):
+                query = query.filter(cls.visible_to(user))
+
+            # ----------------------------------------------------------- #
+            # Facets
+            # ----------------------------------------------------------- #
+            if min_km is not None:
+                query = query.filter(GpxModel.length_km >= min_km)
+            if max_km is not None:
+                query = query.filter(GpxModel.length_km <= max_km)
+            if min_ascent is not None:
+                query = query.filter(GpxModel.ascent_m >= min_ascent)
+            if max_ascent is not None:
+                query = query.filter(GpxModel.ascent_m <= max_ascent)
+            if route_type:
+                query = query.filter(GpxModel.type == route_type)
+            if direction:
+                query = query.filter(GpxModel.direction == direction)
+            if author_id is not None:
+                query = query.filter(UserModel.id == author_id)
+            if cafe_id is not None:
+                query = query.join(GpxCafeModel, GpxCafeModel.gpx_id == GpxModel.id) \
+                             .filter(GpxCafeModel.cafe_id == cafe_id)
+            if q:
+                # NB Escape the LIKE wildcards, so "100%" means exactly that
+                pattern = q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                query = query.filter(GpxModel.name.ilike(f"%{pattern}%", escape="\\"))  # type: ignore
+
+            # ----------------------------------------------------------- #
+            # Keyset pagination, carry on from the last row we sent
+            # ----------------------------------------------------------- #
+            # Going back a page is the same query run backwards from the first row we sent, then flipped over
+            backwards = not after and bool(before)
+            cursor = after if after else before
+            if cursor:
+                if descending != backwards:
+                    query = query.filter(tuple_(sort_column, GpxModel.id) < tuple_(cursor[0], cursor[1]))
+                else:
+                    query = query.filter(tuple_(sort_column, GpxModel.id) > tuple_(cursor[0], cursor[1]))
+
+            if descending != backwards:
+                query = query.order_by(sort_column.desc(), GpxModel.id.desc())  # type: ignore
             else:
-                can_see = False
+                query = query.order_by(sort_column, GpxModel.id)
+
+            # Ask for one extra row, so we know if there's another page
+            rows = query.limit(limit + 1).all()
 
-            if can_see:
-                cafes_json = json.loads(gpx.cafes_passed)
-                for cafe in cafes_json:
-                    if cafe['cafe_id'] == cafe_id:
-                        # Alter the GPX object to just have one cafe passed as this is all the
-                        # requesting webpage needs to know (it only cares about one cafe)
-                        gpx.cafes_passed = cafe
-                        passing_gpx.append(gpx)
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if backwards:
+            rows.reverse()
+        if not rows:
+            return rows, None, None
 
-        return passing_gpx
+        def row_cursor(row: Any) -> list[Any]:
+            return [getattr(row, sort if sort in SEARCH_SORT_COLUMNS else 'name'), row.id]
 
+        if backwards:
+            # We came from the page after this one, so there is one
+            return rows, row_cursor(rows[-1]), row_cursor(rows[0]) if more else None
+        return rows, row_cursor(rows[-1]) if more else None, row_cursor(rows[0]) if cursor else None
+
+    @staticmethod
+    def similar_gpx_ids(shingles: list[int], length_km: float, length_tolerance: float, min_similarity: float,
+                        skip_gpx_id: int | None = None) -> list[tuple[int, float]]:
+        """
+        Use the shingle index to find routes which share most of their fingerprint with this one. Only looks up
+        the shingles we have, so the cost depends on the size of this route, not the number of routes.
+        :param shingles:                    Fingerprint of the route we're checking
+        :param length_km:                   Its length
+        :param length_tolerance:            Candidates must be within this fraction of length_km
+        :param min_similarity:              Minimum Jaccard index of the two sets of shingles
+        :param skip_gpx_id:                 Don't return this route (ie the one we're checking)
+        :return:                            List of (gpx_id, similarity), most similar first
+        """
+        if not shingles:
+            return []
+
+        with app.app_context():
+            # How many shingles each route of about the right length shares with us
+            min_km = length_km * (1 - length_tolerance)
+            max_km = length_km * (1 + length_tolerance)
+            our_shingles = GpxShingleModel.shingle.in_(shingles)  # type: ignore
+            about_right_length = GpxModel.length_km.between(min_km, max_km)  # type: ignore
+            shared = db.session.query(GpxShingleModel.gpx_id, func.count()) \
+                               .join(GpxModel, GpxModel.id == GpxShingleModel.gpx_id) \
+                               .filter(our_shingles) \
+                               .filter(about_right_length) \
+                               .group_by(GpxShingleModel.gpx_id) \
+                               .having(func.count() >= min_similarity * len(shingles)) \
+                               .all()
+            shared = {gpx_id: count for gpx_id, count in shared if gpx_id != skip_gpx_id}
+            if not shared:
+                return []
+
+            # And how big their own fingerprints are
+            candidates = GpxShingleModel.gpx_id.in_(list(shared.keys()))  # type: ignore
+            sizes = db.session.query(GpxShingleModel.gpx_id, func.count()) \
+                              .filter(candidates) \
+                              .group_by(GpxShingleModel.gpx_id) \
+                              .all()
+
+        similar: list[tuple[int, float]] = []
+        for gpx_id, size in sizes:
+            similarity = shared[gpx_id] / (len(shingles) + size - shared[gpx_id])
+            if similarity >= min_similarity:
+                similar.append((gpx_id, similarity))
+
+        return sorted(similar, key=lambda item: item[1], reverse=True)
+
+    @classmethod
+    def _ranked_gpxes(cls, ranked: list[tuple[int, float]], user: UserModel, limit: int) -> list[GpxModel]:
+        """
+        Load the routes for a list of (gpx_id, dist_km), keeping the order and dropping any the user can't see.
+        """
+        if not ranked:
+            return []
+        dist_by_id: dict[int, float] = dict(ranked)
+
+        with app.app_context():
+            gpx_ids = list(dist_by_id.keys())
+            gpxes = GpxModel.query.filter(GpxModel.id.in_(gpx_ids)).filter(cls.visible_to(user)).all()  # type: ignore
+            for gpx in gpxes:
+                db.session.expunge(gpx)
+                gpx.dist_km = round(dist_by_id[gpx.id], 2)
+
+        gpxes.sort(key=lambda gpx: gpx.dist_km)
+        return gpxes[:limit]
+
+    @classmethod
+    def find_all_gpx_near_point(cls, lat: float, lon: float, radius_km: float, user: UserModel,
+                                limit: int = 50) -> list[GpxModel]:
+        """
+        Find the routes which pass within radius_km of a point, using the route segment index (no GPX files opened).
+        :param lat:                         Latitude of the point
+        :param lon:                         Longitude of the point
+        :param radius_km:                   How close the route has to get
+        :param user:                        User's ORM (used to work out permissions)
+        :param limit:                       Most routes to return
+        :return:                            List of GPXes, closest first, with gpx.dist_km added
+        """
+        return cls._ranked_gpxes(route_segment_index().routes_near(lat, lon, radius_km), user, limit)
+
+    @classmethod
+    def find_all_gpx_in_box(cls, min_lat: float, max_lat: float, min_lon: float, max_lon: float, user: UserModel,
+                            limit: int = 50) -> list[GpxModel]:
+        """
+        Find the routes which cross a bounding box, using the route segment index (no GPX files opened).
+        :param min_lat:                     South edge
+        :param max_lat:                     North edge
+        :param min_lon:                     West edge
+        :param max_lon:                     East edge
+        :param user:                        User's ORM (used to work out permissions)
+        :param limit:                       Most routes to return
+        :return:                            List of GPXes, closest to the middle of the box first, with gpx.dist_km added
+        """
+        return cls._ranked_gpxes(route_segment_index().routes_in_box(min_lat, max_lat, min_lon, max_lon), user, limit)
+
+    @classmethod
+    def count_gpx_passing_cafes(cls, user: UserModel) -> dict[int, int]:
+        """
+        How many routes (that this user can see) pass each cafe, in one grouped query.
+        :param user:                        User's ORM (used to work out permissions)
+        :return:                            Dict of cafe_id -> number of routes, cafes with no routes are missing
+        """
+        with app.app_context():
+            rows = db.session.query(GpxCafeModel.cafe_id, func.count(GpxCafeModel.gpx_id)) \
+                             .join(GpxModel, GpxCafeModel.gpx_id == GpxModel.id) \
+                             .filter(cls.visible_to(user)) \
+                             .group_by(GpxCafeModel.cafe_id) \
+                             .all()
+            return {cafe_id: count for cafe_id, count in rows}
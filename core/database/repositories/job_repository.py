@@ -0,0 +1,169 @@
+import time
+from sqlalchemy import or_
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db
+from core.database.models.job_model import JobModel, JOB_GPX_CAFES, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Give up on a job after this many goes
+JOB_MAX_ATTEMPTS = 3
+
+# Wait this long before retrying, multiplied by the number of attempts so far
+JOB_RETRY_DELAY_SECS = 60
+
+# A running job which hasn't finished in this long belonged to a worker which died
+JOB_STALE_SECS = 15 * 60
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Define Job Repository Class
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class JobRepository:
+
+    # -------------------------------------------------------------------------------------------------------------- #
+    # Create
+    # -------------------------------------------------------------------------------------------------------------- #
+    @staticmethod
+    def add_job(kind: str, gpx_id: int | None = None, calendar_id: int | None = None) -> bool:
+        now = int(time.time())
+        new_job = JobModel(kind=kind, gpx_id=gpx_id, calendar_id=calendar_id, status=JOB_QUEUED,
+                           attempts=0, created=now, updated=now, run_after=now)
+
+        with app.app_context():
+            try:
+                db.session.add(new_job)
+                db.session.commit()
+                return True
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_jobs: Failed to add job '{kind}', gpx_id = '{gpx_id}', "
+                                 f"calendar_id = '{calendar_id}', error code '{e.args}'.")
+                return False
+
+    # -------------------------------------------------------------------------------------------------------------- #
+    # Worker side
+    # -------------------------------------------------------------------------------------------------------------- #
+    @staticmethod
+    def claim_next_job() -> JobModel | None:
+        """
+        Take the oldest job which is ready to run and mark it as running. Rows are locked with SKIP LOCKED, so
+        any number of workers can poll the table without ever picking up the same job.
+        :return:                        The job (detached from the session) or None if there's nothing to do
+        """
+        now = int(time.time())
+        with app.app_context():
+            try:
+                job = JobModel.query.filter(JobModel.status == JOB_QUEUED,
+                                            or_(JobModel.run_after == None, JobModel.run_after <= now)) \
+                                    .order_by(JobModel.id) \
+                                    .with_for_update(skip_locked=True) \
+                                    .first()
+                if not job:
+                    db.session.rollback()
+                    return None
+
+                job.status = JOB_RUNNING
+                job.attempts = (job.attempts or 0) + 1
+                job.updated = now
+                db.session.commit()
+                db.session.refresh(job)
+                db.session.expunge(job)
+                return job
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_jobs: Failed to claim a job, error code '{e.args}'.")
+                return None
+
+    @staticmethod
+    def mark_done(job_id: int) -> bool:
+        with app.app_context():
+            try:
+                JobModel.query.filter_by(id=job_id).update({"status": JOB_DONE, "error": None,
+                                                            "updated": int(time.time())})
+                db.session.commit()
+                return True
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_jobs: Failed to mark job_id = '{job_id}' as done, error code '{e.args}'.")
+                return False
+
+    @staticmethod
+    def mark_failed(job_id: int, error: str) -> bool:
+        """
+        Record a failed attempt. The job goes back in the queue (after a delay) unless it's used up its attempts.
+        :param job_id:                  Job which failed
+        :param error:                   What went wrong
+        :return:                        True if we updated the job
+        """
+        now = int(time.time())
+        with app.app_context():
+            job = JobModel.query.filter_by(id=job_id).first()
+            if job:
+                try:
+                    if job.attempts >= JOB_MAX_ATTEMPTS:
+                        job.status = JOB_FAILED
+                    else:
+                        job.status = JOB_QUEUED
+                        job.run_after = now + JOB_RETRY_DELAY_SECS * job.attempts
+                    job.error = error[:500]
+                    job.updated = now
+                    db.session.commit()
+                    return True
+
+                except Exception as e:
+                    db.session.rollback()
+                    app.logger.error(f"db_jobs: Failed to mark job_id = '{job_id}' as failed, error code '{e.args}'.")
+
+        return False
+
+    @staticmethod
+    def requeue_stale_jobs() -> int:
+        """
+        Put back any job left running by a worker which crashed or was killed mid job.
+        :return:                        Number of jobs put back in the queue
+        """
+        with app.app_context():
+            try:
+                count = JobModel.query.filter(JobModel.status == JOB_RUNNING,
+                                              JobModel.updated < int(time.time()) - JOB_STALE_SECS) \
+                                      .update({"status": JOB_QUEUED})
+                db.session.commit()
+                return count
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_jobs: Failed to requeue stale jobs, error code '{e.args}'.")
+                return 0
+
+    # -------------------------------------------------------------------------------------------------------------- #
+    # Status
+    # -------------------------------------------------------------------------------------------------------------- #
+    @staticmethod
+    def gpx_cafes_status(gpx_id: int) -> str | None:
+        """
+        Status of the most recent cafe analysis for a route, so the route page can say it's still being done.
+        :param gpx_id:                  Route
+        :return:                        JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED or None if never queued
+        """
+        with app.app_context():
+            job = JobModel.query.filter_by(gpx_id=gpx_id, kind=JOB_GPX_CAFES).order_by(JobModel.id.desc()).first()  # type: ignore
+            if job:
+                return job.status
+        return None
@@ -0,0 +1,67 @@
+from sqlalchemy.dialects.postgresql import insert
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db
+from core.database.models.map_count_model import MapCountModel
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Define Map Count Repository Class
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class MapCountRepository:
+
+    # -------------------------------------------------------------------------------------------------------------- #
+    # Update
+    # -------------------------------------------------------------------------------------------------------------- #
+    @staticmethod
+    def add_loads(day: str, count: int) -> int | None:
+        """
+        Add to a day's count in a single statement, so any number of workers can add at once without losing any.
+        :param day:                     Date as "20231111"
+        :param count:                   Number of map loads to add
+        :return:                        The day's new total, or None if it failed
+        """
+        with app.app_context():
+            try:
+                # INSERT ... ON CONFLICT DO UPDATE SET count = map_counts.count + excluded.count
+                statement = insert(MapCountModel).values(day=day, count=count)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[MapCountModel.day],
+                    set_={"count": MapCountModel.count + statement.excluded.count}) \
+                    .returning(MapCountModel.count)
+                total = db.session.execute(statement).scalar()
+                db.session.commit()
+                return total
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_map_counts: Failed to add {count} map loads for '{day}', "
+                                 f"error code '{e.args}'.")
+                return None
+
+    # -------------------------------------------------------------------------------------------------------------- #
+    # Search
+    # -------------------------------------------------------------------------------------------------------------- #
+    @staticmethod
+    def one_day(day: str) -> int:
+        with app.app_context():
+            row = MapCountModel.query.filter_by(day=day).first()
+            return row.count if row else 0
+
+    @staticmethod
+    def since(day: str) -> list[MapCountModel]:
+        """
+        :param day:                     First day we want, as "20231111"
+        :return:                        One row per day, oldest first (a range scan of the primary key)
+        """
+        with app.app_context():
+            return MapCountModel.query.filter(MapCountModel.day >= day).order_by(MapCountModel.day).all()
@@ -0,0 +1,80 @@
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db
+from core.database.models.site_flag_model import SiteFlagModel, SITE_FLAG_VERSION_SEQUENCE
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Define Site Flag Repository Class
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class SiteFlagRepository:
+
+    # -------------------------------------------------------------------------------------------------------------- #
+    # Update
+    # -------------------------------------------------------------------------------------------------------------- #
+    @staticmethod
+    def set_flag(name: str, value: str) -> bool:
+        """
+        Create or overwrite a flag, giving it a new version number so every worker knows to reload.
+        :param name:                    eg "maps_enabled"
+        :param value:                   New value
+        :return:                        True if it worked
+        """
+        with app.app_context():
+            try:
+                # INSERT ... ON CONFLICT DO UPDATE, with a fresh version either way
+                statement = insert(SiteFlagModel).values(name=name, value=value,
+                                                         version=func.nextval(SITE_FLAG_VERSION_SEQUENCE))
+                statement = statement.on_conflict_do_update(
+                    index_elements=[SiteFlagModel.name],
+                    set_={"value": statement.excluded.value, "version": statement.excluded.version})
+                db.session.execute(statement)
+                db.session.commit()
+                return True
+
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_site_flags: Failed to set '{name}' to '{value}', error code '{e.args}'.")
+                return False
+
+    # -------------------------------------------------------------------------------------------------------------- #
+    # Search
+    # -------------------------------------------------------------------------------------------------------------- #
+    # NB These are called from every page which checks a flag, so a dB problem mustn't take the page down with it,
+    # the caller just keeps using what it already has.
+    @staticmethod
+    def latest_version() -> int | None:
+        """
+        :return:                        Highest version of any flag (0 if there aren't any), None if it failed
+        """
+        with app.app_context():
+            try:
+                return db.session.query(func.max(SiteFlagModel.version)).scalar() or 0
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_site_flags: Failed to read latest version, error code '{e.args}'.")
+                return None
+
+    @staticmethod
+    def all_flags() -> dict[str, str] | None:
+        """
+        :return:                        Every flag as {name: value}, None if it failed
+        """
+        with app.app_context():
+            try:
+                return {flag.name: flag.value for flag in SiteFlagModel.query.all()}
+            except Exception as e:
+                db.session.rollback()
+                app.logger.error(f"db_site_flags: Failed to read flags, error code '{e.args}'.")
+                return None
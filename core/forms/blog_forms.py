@@ -11,6 +11,7 @@ from datetime import datetime
 # -------------------------------------------------------------------------------------------------------------- #
 
 from core import GPX_UPLOAD_FOLDER_ABS
+from core.subs_gpx_storage import gpx_exists
 from core.database.repositories.user_repository import UserModel, UserRepository
 from core.database.repositories.gpx_repository import GpxRepository
 from core.database.repositories.cafe_repository import CafeRepository
@@ -72,7 +73,7 @@ def create_blogs_form(admin: bool):
             filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
             # Route must be public and double check we have an actual GPX file on tap....
             if gpx.public \
-                    and os.path.exists(filename):
+                    and gpx_exists(filename):
                 gpx_choices.append(gpx.combo_string)
 
         # ----------------------------------------------------------- #
@@ -11,6 +11,7 @@ from datetime import datetime
 # -------------------------------------------------------------------------------------------------------------- #
 
 from core import GPX_UPLOAD_FOLDER_ABS
+from core.subs_gpx_storage import gpx_exists
 from core.database.repositories.cafe_repository import CafeRepository
 from core.database.repositories.gpx_repository import GpxRepository
 from core.database.repositories.user_repository import UserModel, UserRepository
@@ -93,7 +94,7 @@ def create_ride_form(admin: bool, gpx_id=None):
         for gpx in gpxes:
             filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
             # Route must be public and double check we have an actual GPX file on tap....
-            if (gpx.public and os.path.exists(filename)) \
+            if (gpx.public and gpx_exists(filename)) \
                     or gpx.id == gpx_id:
                 gpx_choices.append(gpx.combo_string)
 
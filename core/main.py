@@ -16,6 +16,9 @@ from core import db, app
 from core.database.models.user_model import UserModel
 from core.database.models.cafe_model import CafeModel
 from core.database.models.gpx_model import GpxModel
+from core.database.models.gpx_cafe_model import GpxCafeModel
+from core.database.models.gpx_shingle_model import GpxShingleModel
+from core.database.models.gpx_version_model import GpxVersionModel
 from core.database.models.calendar_model import CalendarModel
 from core.database.models.social_model import SocialModel
 from core.database.models.classified_model import ClassifiedModel
@@ -24,6 +27,9 @@ from core.database.models.cafe_comment_model import CafeCommentModel
 from core.database.models.event_model import EventModel
 from core.database.models.poll_model import PollModel
 from core.database.models.blog_model import BlogModel
+from core.database.models.job_model import JobModel
+from core.database.models.map_count_model import MapCountModel
+from core.database.models.site_flag_model import SiteFlagModel
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -87,6 +93,15 @@ with app.app_context():
     num_gpx = db.session.query(func.count(GpxModel.id)).scalar()
     print(f"Found {num_gpx} gpx in the dB")
 
+    num_gpx_cafes = db.session.query(func.count(GpxCafeModel.gpx_id)).scalar()
+    print(f"Found {num_gpx_cafes} gpx to cafe links in the dB")
+
+    num_gpx_shingles = db.session.query(func.count(GpxShingleModel.gpx_id)).scalar()
+    print(f"Found {num_gpx_shingles} gpx fingerprint shingles in the dB")
+
+    num_gpx_versions = db.session.query(func.count(GpxVersionModel.id)).scalar()
+    print(f"Found {num_gpx_versions} gpx versions in the dB")
+
     num_calendar = db.session.query(func.count(CalendarModel.id)).scalar()
     print(f"Found {num_calendar} calendar entries in the dB")
 
@@ -111,6 +126,15 @@ with app.app_context():
     num_blogs = db.session.query(func.count(BlogModel.id)).scalar()
     print(f"Found {num_blogs} blogs in the dB")
 
+    num_jobs = db.session.query(func.count(JobModel.id)).scalar()
+    print(f"Found {num_jobs} background jobs in the dB")
+
+    num_map_counts = db.session.query(func.count(MapCountModel.day)).scalar()
+    print(f"Found {num_map_counts} days of map counts in the dB")
+
+    num_site_flags = db.session.query(func.count(SiteFlagModel.name)).scalar()
+    print(f"Found {num_site_flags} site flags in the dB")
+
 
 # -------------------------------------------------------------------------------------------------------------- #
 # -------------------------------------------------------------------------------------------------------------- #
@@ -26,6 +26,7 @@ from core.database.repositories.social_repository import SocialRepository, SOCIA
 from core.subs_email import send_message_notification_email, email_ride_alert_summary
 from core.subs_sms import send_sms, get_twilio_balance
 from core.subs_google_maps import maps_enabled, get_current_map_count, map_limit_by_day, graph_map_counts
+from core.subs_site_flags import global_flash
 from core.database.repositories.blog_repository import BlogRepository as Blog
 from core.database.repositories.classified_repository import ClassifiedRepository
 from core.database.repositories.cafe_comment_repository import CafeCommentRepository
@@ -251,6 +252,11 @@ def admin_page() -> Response | str:
     # Get graph dataset of map counts
     dataset = graph_map_counts()
 
+    # ----------------------------------------------------------- #
+    # Message shown to everyone on the home and weekend pages
+    # ----------------------------------------------------------- #
+    global_flash_message = global_flash()
+
     # ----------------------------------------------------------- #
     # Server stats
     # ----------------------------------------------------------- #
@@ -306,7 +312,7 @@ def admin_page() -> Response | str:
                            map_count=map_count, map_cost_ukp=map_cost_ukp, map_limit=map_limit,
                            files=files, free_per=free_per, untrusted_users=untrusted_users, classifieds=classifieds,
                            dataset=dataset, live_site=live_site(), anchor=anchor, email_alerts=email_alerts,
-                           comments=comments)
+                           comments=comments, global_flash_message=global_flash_message)
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -17,10 +17,19 @@ from core import app
 from core.database.repositories.user_repository import UserModel, UserRepository
 from core.database.repositories.event_repository import EventRepository
 from core.subs_google_maps import maps_enabled, set_enable_maps, set_disable_maps, boost_map_limit
+from core.subs_site_flags import set_global_flash
 
 from core.decorators.user_decorators import admin_only, update_last_seen, login_required
 
 
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# It's a one line banner, not a blog post
+GLOBAL_FLASH_MAX_LENGTH = 500
+
+
 # -------------------------------------------------------------------------------------------------------------- #
 # -------------------------------------------------------------------------------------------------------------- #
 # -------------------------------------------------------------------------------------------------------------- #
@@ -220,3 +229,69 @@ def boost_maps() -> Response | str:
 
     # Back to user page
     return redirect(url_for('admin_page', user_id=current_user.id))  # type: ignore
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Set (or clear) the message flashed to everyone on the home and weekend pages
+# -------------------------------------------------------------------------------------------------------------- #
+
+@app.route('/set_global_flash', methods=['POST'])
+@login_required
+@admin_only
+@update_last_seen
+def set_global_flash_message() -> Response | str:
+    # ----------------------------------------------------------- #
+    # Get details from the page
+    # ----------------------------------------------------------- #
+    try:
+        password = request.form['password']
+    except exceptions.BadRequestKeyError:
+        password = None
+
+    # Blank message means stop showing one
+    message: str = request.form.get('message', "").strip()[:GLOBAL_FLASH_MAX_LENGTH]
+
+    # Stop 400 error for blank string as very confusing (it's not missing, it's blank)
+    if password == "":
+        password = " "
+
+    # ----------------------------------------------------------- #
+    # Get user's IP
+    # ----------------------------------------------------------- #
+    if request.headers.getlist("X-Forwarded-For"):
+        user_ip: str | None = request.headers.getlist("X-Forwarded-For")[0]
+    else:
+        user_ip = request.remote_addr
+
+    # ----------------------------------------------------------- #
+    #  Need user
+    # ----------------------------------------------------------- #
+    user: UserModel | None = UserRepository.one_by_id(current_user.id)
+    if not user:
+        app.logger.debug(f"set_global_flash_message(): Invalid user current_user.id = '{current_user.id}'!")
+        EventRepository.log_event("Global Flash Fail", f"Invalid user current_user.id = '{current_user.id}'.")
+        abort(404)
+
+    # ----------------------------------------------------------- #
+    #  Validate against current_user's (admins) password
+    # ----------------------------------------------------------- #
+    if not UserRepository.validate_password(current_user, password, user_ip):
+        app.logger.debug(f"set_global_flash_message(): Incorrect password for '{current_user.email}'!")
+        EventRepository.log_event("Global Flash Fail", f"Incorrect password for '{current_user.email}'!")
+        flash(f"Incorrect password for '{current_user.name}'.")
+        return redirect(url_for('admin_page', user_id=current_user.id))  # type: ignore
+
+    # ----------------------------------------------------------- #
+    #  Set it (for every worker)
+    # ----------------------------------------------------------- #
+    if set_global_flash(message or None):
+        app.logger.debug(f"set_global_flash_message(): Global flash set to '{message}' by '{current_user.email}'.")
+        EventRepository.log_event("Global Flash Success", f"Global flash set to '{message}' by '{current_user.email}'.")
+        flash("Site message updated" if message else "Site message cleared")
+    else:
+        app.logger.debug(f"set_global_flash_message(): Failed to set global flash, '{current_user.email}'.")
+        EventRepository.log_event("Global Flash Fail", f"Failed to set global flash, '{current_user.email}'.")
+        flash("Sorry, something went wrong")
+
+    # Back to user page
+    return redirect(url_for('admin_page', user_id=current_user.id))  # type: ignore
@@ -27,6 +27,7 @@ from core.decorators.user_decorators import update_last_seen, logout_barred_user
 from core.forms.cafe_forms import CreateCafeForm
 
 from core.subs_gpx import check_new_cafe_with_all_gpxes, remove_cafe_from_all_gpxes
+from core.subs_gpx_matching import rebuild_cafe_index
 from core.subs_google_maps import ELSR_HOME, MAP_BOUNDS, google_maps_api_key, count_map_loads
 from core.subs_cafe_photos import update_cafe_photo, CAFE_FOLDER
 
@@ -162,6 +163,8 @@ def new_cafe() -> Response | str:
         # ----------------------------------------------------------- #
         app.logger.debug(f"new_cafe(): calling check_new_cafe_with_all_gpxes for '{new_cafe.name}'. ")
         flash(f"All GPX routes are being updated with distance to {new_cafe.name}.")
+        # New cafe needs to be in the spatial index used for matching new routes
+        rebuild_cafe_index()
         # Update the routes in the background
         Thread(target=check_new_cafe_with_all_gpxes, args=(new_cafe,)).start()
 
@@ -316,6 +319,8 @@ def edit_cafe() -> Response | str:
             # Need to update all GPXes with new cafe location
             app.logger.debug(f"edit_cafe(): Cafe has moved {round(dist_km, 1)} km, so need to update GPXes.")
             flash(f"All GPX routes are being updated with distance to {updated_cafe.name}.")
+            # Cafe needs to move in the spatial index used for matching new routes
+            rebuild_cafe_index()
             # Update the routes in the background, so page reloads quickly
             Thread(target=check_new_cafe_with_all_gpxes, args=(updated_cafe,)).start()
         else:
@@ -558,6 +563,8 @@ def delete_cafe() -> Response | str:
         app.logger.debug(f"delete_cafe(): Successfully deleted the cafe, id = '{cafe.id}'.")
         EventRepository.log_event("Delete Cafe Success", f"Successfully deleted the cafe, id = '{cafe.id}'.")
         flash("Cafe deleted.")
+        # Drop it from the spatial index used for matching new routes
+        rebuild_cafe_index()
     else:
         # Should never get here, but....
         app.logger.debug(f"delete_cafe(): Failed to delete the cafe, id = '{cafe.id}'.")
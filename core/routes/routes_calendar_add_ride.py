@@ -2,9 +2,7 @@ from flask import render_template, url_for, request, flash, redirect, abort, Res
 from flask_login import current_user
 from werkzeug import exceptions
 from datetime import datetime, time
-import json
 import os
-from threading import Thread
 from typing import Dict
 
 
@@ -12,7 +10,7 @@ from typing import Dict
 # Import app from __init__.py
 # -------------------------------------------------------------------------------------------------------------- #
 
-from core import app, current_year, delete_file_if_exists, live_site, GRAVEL_CHOICE
+from core import app, current_year, live_site, GRAVEL_CHOICE, GPX_UPLOAD_FOLDER_ABS
 
 # -------------------------------------------------------------------------------------------------------------- #
 # Import our three database classes and associated forms, decorators etc
@@ -32,9 +30,10 @@ from core.forms.calendar_forms import create_ride_form
 
 from core.decorators.user_decorators import update_last_seen, logout_barred_user, login_required, rw_required
 
-from core.subs_gpx import allowed_file, GPX_UPLOAD_FOLDER_ABS
-from core.subs_gpx_edit import strip_excess_info_from_gpx
-from core.subs_email import send_ride_notification_emails
+from core.subs_gpx import allowed_file
+from core.subs_gpx_edit import ingest_gpx_upload
+from core.subs_gpx_storage import gpx_exists
+from core.subs_jobs import queue_ride_emails
 from core.subs_dates import get_date_from_url
 
 
@@ -134,17 +133,13 @@ def handle_gpx_upload(form, calendar_entry: CalendarModel) -> Dict[str, bool | G
     gpx: GpxModel = GpxModel()
     gpx.name = form.destination.data.split('(')[0] if form.destination.data != NEW_CAFE else form.new_destination.data
     gpx.email = current_user.email
-    gpx.cafes_passed = "[]"
-    gpx.ascent_m = 0
-    gpx.length_km = 0
-    gpx.filename = "tmp"
     gpx.type = TYPE_GRAVEL if form.group.data == GRAVEL_CHOICE else TYPE_ROAD
 
     # ----------------------------------------------------------- #
-    # Add GPX to database
+    # Read the upload once, clean it up and add it to the dB
     # ----------------------------------------------------------- #
-    gpx = GpxRepository.add_gpx(gpx)
-    if not gpx:
+    added_gpx = ingest_gpx_upload(file, gpx)
+    if not added_gpx:
         app.logger.debug(f"handle_gpx_upload: Failed to add GPX to the database!")
         EventRepository.log_event("Add ride Fail", "Failed to add GPX to the database!")
         flash("Sorry, something went wrong!")
@@ -152,56 +147,12 @@ def handle_gpx_upload(form, calendar_entry: CalendarModel) -> Dict[str, bool | G
                                                            ride=calendar_entry, live_site=live_site(), DEFAULT_START_TIMES=DEFAULT_START_TIMES,
                                                            MEETING_OTHER=MEETING_OTHER, NEW_CAFE=NEW_CAFE, UPLOAD_ROUTE=UPLOAD_ROUTE)}
 
-    # ----------------------------------------------------------- #
-    # Determine where to store the file
-    # ----------------------------------------------------------- #
-    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, f"gpx_{gpx.id}.gpx")
-    app.logger.debug(f"handle_gpx_upload: Filename will be = '{filename}'.")
-
-    # ----------------------------------------------------------- #
-    # Delete existing file if it exists
-    # ----------------------------------------------------------- #
-    if not delete_file_if_exists(filename):
-        flash("Sorry, something went wrong!")
-        return {"success": False, "error": render_template("calendar_add_ride.html", year=current_year, form=form,
-                                                           ride=calendar_entry, live_site=live_site(), DEFAULT_START_TIMES=DEFAULT_START_TIMES,
-                                                           MEETING_OTHER=MEETING_OTHER, NEW_CAFE=NEW_CAFE, UPLOAD_ROUTE=UPLOAD_ROUTE)}
-
-    # ----------------------------------------------------------- #
-    # Save the GPX file
-    # ----------------------------------------------------------- #
-    try:
-        file.save(filename)
-    except Exception as e:
-        app.logger.debug(f"handle_gpx_upload: Failed to save '{filename}', error: {e.args}.")
-        EventRepository.log_event("Add ride Fail", f"Failed to save '{filename}', error: {e.args}.")
-        flash("Sorry, something went wrong!")
-        return {"success": False, "error": render_template("calendar_add_ride.html", year=current_year, form=form,
-                                                           ride=calendar_entry, live_site=live_site(), DEFAULT_START_TIMES=DEFAULT_START_TIMES,
-                                                           MEETING_OTHER=MEETING_OTHER, NEW_CAFE=NEW_CAFE, UPLOAD_ROUTE=UPLOAD_ROUTE)}
-
-    # ----------------------------------------------------------- #
-    # Update filename in the GPX object
-    # ----------------------------------------------------------- #
-    if not GpxRepository.update_filename(gpx.id, filename):
-        app.logger.debug(f"handle_gpx_upload: Failed to update filename in the database for gpx_id='{gpx.id}'.")
-        EventRepository.log_event("Add ride Fail", f"Failed to update filename in the database for gpx_id='{gpx.id}'.")
-        flash("Sorry, something went wrong!")
-        return {"success": False, "error": render_template("calendar_add_ride.html", year=current_year, form=form,
-                                                           ride=calendar_entry, live_site=live_site(), DEFAULT_START_TIMES=DEFAULT_START_TIMES,
-                                                           MEETING_OTHER=MEETING_OTHER, NEW_CAFE=NEW_CAFE, UPLOAD_ROUTE=UPLOAD_ROUTE)}
-
-    # ----------------------------------------------------------- #
-    # Clean up the file
-    # ----------------------------------------------------------- #
-    strip_excess_info_from_gpx(filename, gpx.id, f"ELSR: {gpx.name}")
-
     # ----------------------------------------------------------- #
     # Success
     # ----------------------------------------------------------- #
-    app.logger.debug(f"handle_gpx_upload: Successfully handled upload for GPX ID = {gpx.id}.")
-    EventRepository.log_event("Add ride Success", f"New GPX uploaded: gpx_id={gpx.id}, name=({gpx.name}).")
-    return {"success": True, "gpx": gpx}
+    app.logger.debug(f"handle_gpx_upload: Successfully handled upload for GPX ID = {added_gpx.id}.")
+    EventRepository.log_event("Add ride Success", f"New GPX uploaded: gpx_id={added_gpx.id}, name=({added_gpx.name}).")
+    return {"success": True, "gpx": added_gpx}
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -324,7 +275,7 @@ def add_ride() -> Response | str:
 
         # Check if GPX file exists
         filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
-        if not os.path.exists(filename):
+        if not gpx_exists(filename):
             flash(f"Warning the GPX '{gpx.name}' file is MISSING! You can't use this route!")
 
     else:
@@ -401,12 +352,7 @@ def add_ride() -> Response | str:
 
         # 4: Check route passes cafe (if both from comboboxes)
         if gpx and cafe:
-            match: bool = False
-            # gpx.cafes_passed is a json.dumps string, so need to convert back
-            for cafe_passed in json.loads(gpx.cafes_passed):
-                if int(cafe_passed["cafe_id"]) == cafe.id:
-                    match = True
-            if not match:
+            if not GpxRepository.cafe_passed(gpx.id, cafe.id):
                 # Doesn't look like we pass that cafe!
                 flash(f"That GPX route doesn't pass {cafe.name}!")
                 return render_template("calendar_add_ride.html", year=current_year, form=form, ride=calendar_entry,
@@ -500,6 +446,11 @@ def add_ride() -> Response | str:
             else:
                 flash("Ride added to Calendar!")
 
+            # Did they just upload a route we already have? If so offer them the existing one instead
+            if getattr(gpx, 'duplicates', None):
+                return redirect(url_for('gpx_duplicate', gpx_id=gpx.id,
+                                        return_path=f"{url_for('weekend', date=start_date_str)}"))  # type: ignore
+
             # Do they need to edit the just uploaded GPX file to make it public?
             if not gpx.public:
                 # Forward them to the edit_route page to edit it and make it public
@@ -508,7 +459,7 @@ def add_ride() -> Response | str:
                                         return_path=f"{url_for('weekend', date=start_date_str)}"))  # type: ignore
             else:
                 # Send all the email notifications now as ride us public
-                Thread(target=send_ride_notification_emails, args=(calendar_entry,)).start()
+                queue_ride_emails(calendar_entry.id)
                 # Go to Calendar page for this ride's date
                 return redirect(url_for('weekend', date=start_date_str))  # type: ignore
         else:
@@ -24,6 +24,7 @@ from core.decorators.user_decorators import update_last_seen
 
 from core.database.repositories.cafe_repository import OPEN_CAFE_COLOUR
 from core.subs_graphjs import get_elevation_data
+from core.subs_gpx_storage import gpx_exists
 from core.subs_google_maps import polyline_json, google_maps_api_key, MAP_BOUNDS, count_map_loads
 from core.database.repositories.event_repository import EventRepository
 
@@ -94,7 +95,7 @@ def chaingang() -> Response | str:
     filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, CHAINGANG_GPX_FILENAME)
 
     # Check it exists before we try and parse it etc
-    if not os.path.exists(filename):
+    if not gpx_exists(filename):
         # Should never happen, but may as well handle it cleanly
         flash("Sorry, we seem to have lost that GPX file!")
         flash("Somebody should probably fire the web developer...")
@@ -11,7 +11,7 @@ from threading import Thread
 # Import app from __init__.py
 # -------------------------------------------------------------------------------------------------------------- #
 
-from core import app, current_year, live_site, GLOBAL_FLASH
+from core import app, current_year, live_site
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -29,6 +29,7 @@ from core.database.repositories.cafe_repository import CafeModel, CafeRepository
 from core.database.repositories.user_repository import UserModel, UserRepository
 from core.subs_google_maps import google_maps_api_key, ELSR_HOME, MAP_BOUNDS, count_map_loads
 from core.subs_email import contact_form_email
+from core.subs_site_flags import global_flash
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -108,8 +109,9 @@ def home() -> Response | str:
     count_map_loads(1)
 
     # Temporary alert for change of meeting point
-    if GLOBAL_FLASH:
-        flash(GLOBAL_FLASH)
+    flash_message = global_flash()
+    if flash_message:
+        flash(flash_message)
 
     # Render home page
     return render_template("main_home.html", year=current_year, cafes=cafe_marker, live_site=live_site(),
@@ -1,8 +1,11 @@
-from flask import render_template, redirect, url_for, flash, request, abort, send_from_directory, Response, make_response
+from flask import render_template, redirect, url_for, flash, request, abort, send_file, Response, make_response
 from flask_login import current_user
 from werkzeug import exceptions
+import gzip
+import io
 import os
 from threading import Thread
+from typing import Any, Mapping
 import json
 
 
@@ -10,18 +13,21 @@ import json
 # Import app from __init__.py
 # -------------------------------------------------------------------------------------------------------------- #
 
-from core import app, GPX_UPLOAD_FOLDER_ABS, current_year, delete_file_if_exists, is_mobile, live_site
+from core import app, GPX_UPLOAD_FOLDER_ABS, current_year, is_mobile, live_site, int_or_none
 
 # -------------------------------------------------------------------------------------------------------------- #
 # Import our three database classes and associated forms, decorators etc
 # -------------------------------------------------------------------------------------------------------------- #
 
 from core.database.repositories.user_repository import UserModel, UserRepository
-from core.database.repositories.gpx_repository import GpxModel, GpxRepository
+from core.database.repositories.gpx_repository import GpxModel, GpxRepository, TYPES, DIRECTIONS, \
+                                                     SEARCH_SORT_COLUMNS, SEARCH_PAGE_SIZE
 from core.database.repositories.cafe_repository import CafeRepository
 from core.database.repositories.event_repository import EventRepository
 from core.database.repositories.message_repository import MessageModel, MessageRepository, ADMIN_EMAIL
 from core.database.repositories.calendar_repository import CalendarRepository
+from core.database.repositories.job_repository import JobRepository
+from core.database.models.job_model import JOB_QUEUED, JOB_RUNNING, JOB_FAILED
 
 from core.database.jinja.user_jinja import get_user_name
 
@@ -30,8 +36,18 @@ from core.forms.gpx_forms import UploadGPXForm
 
 from core.subs_gpx import allowed_file
 from core.subs_google_maps import polyline_json, markers_for_cafes_native, MAP_BOUNDS, google_maps_api_key, \
-                                  count_map_loads
-from core.subs_gpx_edit import check_route_name, strip_excess_info_from_gpx
+                                  count_map_loads, redeem_map_load_token
+from core.subs_gpx_edit import ingest_gpx_upload, gpx_file_lock
+from core.subs_gpx_download import download_gpx, delete_download_gpx
+from core.subs_gpx_thumbnail import route_thumbnail, delete_route_thumbnails
+from core.subs_heatmap import heatmap_tile, LAYER_ALL
+from core.subs_gpx_polyline import delete_route_polyline
+from core.subs_gpx_blobs import prune_blobs
+from core.subs_gpx_storage import gpx_exists, delete_gpx_file
+from core.subs_route_store import remove_stored_route, stored_track
+from core.subs_gpx_fingerprint import find_duplicate_routes
+from core.subs_jobs import queue_ride_emails, queue_heatmap_update
+from core.subs_route_index import MAX_SEARCH_RADIUS_KM
 from core.subs_graphjs import get_elevation_data, get_cafe_heights_from_gpx
 from core.subs_email import send_message_notification_email
 from core.subs_sms import alert_admin_via_sms
@@ -39,6 +55,27 @@ from core.subs_sms import alert_admin_via_sms
 from core.decorators.user_decorators import update_last_seen, logout_barred_user, login_required, rw_required
 
 
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# How far from a point /routes_near looks if it isn't told
+DEFAULT_NEAR_RADIUS_KM = 2
+
+# What we tell the browser a download is
+GPX_MIMETYPE = "application/gpx+xml"
+
+# How long browsers can keep a heatmap tile before checking it's still current
+HEATMAP_TILE_MAX_AGE_SECS = 60 * 60
+
+# URL parameters which narrow down the route list (as opposed to sorting / paging it)
+SEARCH_FILTER_ARGS = ['q', 'min_km', 'max_km', 'min_ascent', 'max_ascent', 'type', 'direction', 'cafe_id',
+                      'author_id']
+
+# Longest name search we bother with
+SEARCH_MAX_QUERY_LENGTH = 100
+
+
 # -------------------------------------------------------------------------------------------------------------- #
 # -------------------------------------------------------------------------------------------------------------- #
 # -------------------------------------------------------------------------------------------------------------- #
@@ -47,6 +84,108 @@ from core.decorators.user_decorators import update_last_seen, logout_barred_user
 # -------------------------------------------------------------------------------------------------------------- #
 # -------------------------------------------------------------------------------------------------------------- #
 
+def float_or_none(value: str | None) -> float | None:
+    try:
+        return float(value)  # type: ignore
+    except Exception:
+        return None
+
+
+def search_args(args: Mapping[str, str]) -> dict[str, Any]:
+    """
+    Turn the URL parameters for /routes or /routes/search into arguments for GpxRepository.search(). Anything
+    we don't understand is ignored, rather than being an error, as people will edit these URLs by hand.
+    :param args:                        request.args
+    :return:                            Dictionary of keyword arguments
+    """
+    sort: str = args.get('sort', 'name')
+    if sort not in SEARCH_SORT_COLUMNS:
+        sort = 'name'
+
+    # The cursors are the JSON [sort value, id] of the last route on the previous page (after), or the first
+    # route on the next page (before)
+    def cursor(name: str) -> list[Any] | None:
+        try:
+            value = json.loads(args.get(name, ''))
+        except ValueError:
+            return None
+        if not isinstance(value, list) or \
+                len(value) != 2 or \
+                not isinstance(value[1], int) or \
+                not isinstance(value[0], str if sort == 'name' else (int, float)):
+            return None
+        return value
+
+    return {'q': args.get('q', '').strip()[:SEARCH_MAX_QUERY_LENGTH] or None,
+            'min_km': float_or_none(args.get('min_km')),
+            'max_km': float_or_none(args.get('max_km')),
+            'min_ascent': float_or_none(args.get('min_ascent')),
+            'max_ascent': float_or_none(args.get('max_ascent')),
+            'route_type': args.get('type') if args.get('type') in TYPES else None,
+            'direction': args.get('direction') if args.get('direction') in DIRECTIONS else None,
+            'cafe_id': int_or_none(args.get('cafe_id')),
+            'author_id': int_or_none(args.get('author_id')),
+            'sort': sort,
+            'descending': args.get('order') == 'desc',
+            'after': cursor('after'),
+            'before': cursor('before'),
+            'limit': int_or_none(args.get('limit')) or SEARCH_PAGE_SIZE}
+
+
+def delete_route_files(gpx_id: int, gpx_filename: str) -> None:
+    """
+    Remove a deleted route's GPX file and everything we built from it.
+    :param gpx_id:                      ID of the route
+    :param gpx_filename:                Its GPX filename
+    :return:                            n/a
+    """
+    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx_filename))
+    try:
+        # Wait for any edit in progress, so it can't put the file back after we've gone
+        with gpx_file_lock(filename):
+            delete_gpx_file(filename)
+        app.logger.debug(f"delete_route_files(): File '{filename}' deleted from directory.")
+    except Exception as e:
+        app.logger.debug(f"delete_route_files(): Failed to delete GPX file '{filename}', error code was '{e.args}'.")
+        EventRepository.log_event("GPX Delete Fail", f"Failed to delete GPX file '{filename}', "
+                                                     f"error code was {e.args}, gpx_id = {gpx_id}!")
+
+    delete_route_polyline(filename)
+    delete_download_gpx(gpx_id)
+    delete_route_thumbnails(gpx_id)
+    remove_stored_route(gpx_id)
+    queue_heatmap_update(gpx_id)
+
+    # Its points may be shared with another route, so only remove blobs nothing refers to any more
+    prune_blobs(GpxRepository.all_version_blobs())
+
+
+def send_gpx_download(filename: str, key: str, download_name: str) -> Response:
+    """
+    Send a prebuilt download (which is stored gzipped). Anyone who accepts gzip (ie every browser) gets the
+    stored bytes as is, with Content-Encoding: gzip, anyone else gets it unzipped on the fly.
+    NB conditional=True means a repeat download with a matching ETag / Last-Modified just gets a 304.
+    :param filename:                    From download_gpx()
+    :param key:                         From download_gpx()
+    :param download_name:               The filename the user will see
+    :return:                            Response
+    """
+    if request.accept_encodings.quality('gzip') > 0:
+        # Different bytes, so a different ETag to the unzipped version
+        response = send_file(filename, mimetype=GPX_MIMETYPE, as_attachment=True, download_name=download_name,
+                             etag=f"{key}-gzip", conditional=True)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        with gzip.open(filename, 'rb') as file_ref:
+            data = file_ref.read()
+        response = send_file(io.BytesIO(data), mimetype=GPX_MIMETYPE, as_attachment=True,
+                             download_name=download_name, etag=key, last_modified=os.path.getmtime(filename),
+                             conditional=True)
+
+    response.vary.add('Accept-Encoding')
+    return response
+
+
 def download_count(gpx):
     # Add counts
     if gpx.downloads:
@@ -75,29 +214,19 @@ def download_count(gpx):
 @update_last_seen
 def gpx_list() -> Response | str:
     # ----------------------------------------------------------- #
-    # Grab all our routes
+    # Run the search in the dB, one page at a time
     # ----------------------------------------------------------- #
-    gpxes: list[GpxModel] = GpxRepository.all_gpxes()
+    search = search_args(request.args)
+    gpxes, next_after, prev_before = GpxRepository.search(current_user, **search)
 
     # ----------------------------------------------------------- #
-    # Grab all our users
+    # Check we have the files for the routes on this page
     # ----------------------------------------------------------- #
-    users: list[UserRepository] = UserRepository.all_users()
-
-    # Double check we have all the files present
     missing_files: list[int] = []
-
-    # ----------------------------------------------------------- #
-    # Look through GPXes looking for missing files and converting users
-    # ----------------------------------------------------------- #
     for gpx in gpxes:
-
-        gpx.user_name = next((user.name for user in users if user.email == gpx.email), "Unkown")
-
         # Absolute path name
         filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
-        # Check the file is actually there, before we try and parse it etc
-        if not os.path.exists(filename):
+        if not gpx_exists(filename):
             missing_files.append(gpx.id)
 
     # Need different path for Admin
@@ -108,6 +237,15 @@ def gpx_list() -> Response | str:
     else:
         admin = False
 
+    # ----------------------------------------------------------- #
+    # Names for the cafe / author facets, if we have them
+    # ----------------------------------------------------------- #
+    cafe = CafeRepository.one_by_id(search['cafe_id']) if search['cafe_id'] is not None else None
+    author = UserRepository.one_by_id(search['author_id']) if search['author_id'] is not None else None
+
+    # The filters, as URL parameters, so the page links can keep them
+    filters = {key: value for key, value in request.args.items() if key in SEARCH_FILTER_ARGS and value}
+
     # ----------------------------------------------------------- #
     # Render page
     # ----------------------------------------------------------- #
@@ -116,7 +254,34 @@ def gpx_list() -> Response | str:
             flash(f"We are missing the GPX file for route {missing}!")
 
     return render_template("gpx_list.html", year=current_year, gpxes=gpxes, mobile=is_mobile(), live_site=live_site(),
-                           missing_files=missing_files)
+                           missing_files=missing_files, filters=filters, search=search, TYPES=TYPES,
+                           DIRECTIONS=DIRECTIONS, cafe=cafe, author=author,
+                           next_after=json.dumps(next_after) if next_after else None,
+                           prev_before=json.dumps(prev_before) if prev_before else None)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Route search (JSON)
+# -------------------------------------------------------------------------------------------------------------- #
+
+@app.route('/routes/search', methods=['GET'])
+@update_last_seen
+def gpx_search() -> Response | dict[str, Any]:
+    # Same parameters as /routes, eg /routes/search?q=ely&min_km=80&max_km=120&type=Road&sort=ascent_m
+    gpxes, next_after, prev_before = GpxRepository.search(current_user, **search_args(request.args))
+
+    # Flask turns this into JSON for us
+    return {'routes': [{'id': gpx.id,
+                        'name': gpx.name,
+                        'length_km': gpx.length_km,
+                        'ascent_m': gpx.ascent_m,
+                        'type': gpx.type,
+                        'direction': gpx.direction,
+                        'public': gpx.public,
+                        'user_name': gpx.user_name,
+                        'url': url_for('gpx_details', gpx_id=gpx.id)} for gpx in gpxes],
+            'after': next_after,
+            'before': prev_before}
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -137,6 +302,142 @@ def gpx_top10() -> Response | str:
     return render_template("gpx_top10.html", year=current_year, gpxes=gpxes, mobile=is_mobile(), live_site=live_site())
 
 
+# -------------------------------------------------------------------------------------------------------------- #
+# Static map of a route (PNG)
+# -------------------------------------------------------------------------------------------------------------- #
+
+# NB No @update_last_seen, as a page of routes loads a page of these
+@app.route('/route_thumbnail/<int:gpx_id>', methods=['GET'])
+def gpx_thumbnail(gpx_id: int) -> Response:
+    # ----------------------------------------------------------- #
+    # Check params are valid
+    # ----------------------------------------------------------- #
+    gpx = GpxRepository.one_by_id(gpx_id)
+    if not gpx:
+        app.logger.debug(f"gpx_thumbnail(): Failed to locate GPX with gpx_id = '{gpx_id}'.")
+        return abort(404)
+
+    # ----------------------------------------------------------- #
+    # Restrict access, same rules as gpx_details()
+    # ----------------------------------------------------------- #
+    if not gpx.public:
+        if not current_user.is_authenticated or \
+                (current_user.email != gpx.email and not current_user.admin):
+            app.logger.debug(f"gpx_thumbnail(): Refusing permission to see hidden route '{gpx_id}'.")
+            return abort(403)
+
+    # ----------------------------------------------------------- #
+    # Drawn once per version of the route
+    # ----------------------------------------------------------- #
+    thumbnail = route_thumbnail(gpx)
+    if not thumbnail:
+        return abort(404)
+    filename, key = thumbnail
+
+    # Browsers can keep it, but must check the ETag, as it changes when the route is edited
+    response = send_file(filename, mimetype="image/png", etag=key, conditional=True)
+    response.cache_control.no_cache = True
+    if not gpx.public:
+        response.cache_control.private = True
+    return response
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Heatmap of every public route (PNG map tiles)
+# -------------------------------------------------------------------------------------------------------------- #
+
+# NB No @update_last_seen, as every map with the heatmap on loads dozens of these
+@app.route('/heatmap_tile', methods=['GET'])
+def gpx_heatmap_tile() -> Response:
+    # ----------------------------------------------------------- #
+    # Get details from the page
+    # ----------------------------------------------------------- #
+    layer = request.args.get('layer', LAYER_ALL)
+    zoom = int_or_none(request.args.get('zoom', None))
+    x = int_or_none(request.args.get('x', None))
+    y = int_or_none(request.args.get('y', None))
+
+    if zoom is None \
+            or x is None \
+            or y is None:
+        return abort(400)
+
+    # ----------------------------------------------------------- #
+    # Built from public routes only, so anyone can see them
+    # ----------------------------------------------------------- #
+    # Lots of these are empty, or off the edge of the map, which the map just leaves blank
+    filename = heatmap_tile(layer, zoom, x, y)
+    if not filename:
+        return abort(404)
+
+    # They only change when a route does, so browsers can keep them for a while
+    return send_file(filename, mimetype="image/png", conditional=True, max_age=HEATMAP_TILE_MAX_AGE_SECS)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Someone tapped a static map to load the real one
+# -------------------------------------------------------------------------------------------------------------- #
+
+@app.route('/map_load', methods=['POST'])
+def map_load() -> Response:
+    # Google bills us for this load, so it counts towards today's limit, same as a page with a map on it
+    # NB Only with a token from the page the map is on, so you can't just POST here over and over
+    if not redeem_map_load_token(request.form.get('token')):
+        app.logger.debug("map_load(): Ignoring map load with a bad or used token.")
+        return make_response("", 400)
+
+    count_map_loads(1)
+    return make_response("", 204)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Routes passing near a point, or through a box (JSON)
+# -------------------------------------------------------------------------------------------------------------- #
+
+@app.route('/routes_near', methods=['GET'])
+@update_last_seen
+def gpx_near() -> Response | dict[str, Any]:
+    # ----------------------------------------------------------- #
+    # Get details from the page
+    # ----------------------------------------------------------- #
+    # Either /routes_near?lat=52.2&lon=0.1&radius_km=2
+    # or     /routes_near?min_lat=52.1&max_lat=52.3&min_lon=0.0&max_lon=0.2
+    try:
+        args = {key: float(value) for key, value in request.args.items()
+                if key in ['lat', 'lon', 'radius_km', 'min_lat', 'max_lat', 'min_lon', 'max_lon']}
+    except ValueError:
+        app.logger.debug(f"gpx_near(): Passed non numeric parameters '{request.args}'.")
+        return abort(400)
+
+    # ----------------------------------------------------------- #
+    # Query the route index
+    # ----------------------------------------------------------- #
+    if 'lat' in args and 'lon' in args:
+        radius_km = min(args.get('radius_km', DEFAULT_NEAR_RADIUS_KM), MAX_SEARCH_RADIUS_KM)
+        gpxes = GpxRepository.find_all_gpx_near_point(args['lat'], args['lon'], radius_km, current_user)
+
+    elif all(key in args for key in ['min_lat', 'max_lat', 'min_lon', 'max_lon']):
+        if args['min_lat'] > args['max_lat'] or \
+                args['min_lon'] > args['max_lon']:
+            app.logger.debug(f"gpx_near(): Passed inside out box '{request.args}'.")
+            return abort(400)
+        gpxes = GpxRepository.find_all_gpx_in_box(args['min_lat'], args['max_lat'], args['min_lon'], args['max_lon'],
+                                                  current_user)
+
+    else:
+        app.logger.debug(f"gpx_near(): Missing parameters '{request.args}'.")
+        return abort(400)
+
+    # Flask turns this into JSON for us
+    return {'routes': [{'id': gpx.id,
+                        'name': gpx.name,
+                        'type': gpx.type,
+                        'length_km': gpx.length_km,
+                        'ascent_m': gpx.ascent_m,
+                        'dist_km': gpx.dist_km,
+                        'url': url_for('gpx_details', gpx_id=gpx.id)} for gpx in gpxes]}
+
+
 # -------------------------------------------------------------------------------------------------------------- #
 # Display a single GPX file
 # -------------------------------------------------------------------------------------------------------------- #
@@ -179,7 +480,7 @@ def gpx_details(gpx_id: int) -> Response | str:
     # Get info for webpage
     # ----------------------------------------------------------- #
     author = UserRepository.one_by_email(gpx.email).name
-    cafe_list = CafeRepository.cafes_passed_by_gpx(gpx.cafes_passed)
+    cafe_list = CafeRepository.cafes_passed_by_gpx(gpx.id)
 
     # ----------------------------------------------------------- #
     # Double check GPX file actually exists
@@ -189,7 +490,7 @@ def gpx_details(gpx_id: int) -> Response | str:
     filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
 
     # Check the file is actually there, before we try and parse it etc
-    if not os.path.exists(filename):
+    if not gpx_exists(filename):
         # Should never happen, but may as well handle it cleanly
 
         # Need different path for Admin
@@ -226,11 +527,11 @@ def gpx_details(gpx_id: int) -> Response | str:
     # ----------------------------------------------------------- #
     # Need path as weird Google proprietary JSON string thing
     # ----------------------------------------------------------- #
-    if os.path.exists(filename):
+    if gpx_exists(filename):
         polyline = polyline_json(filename)
     else:
         polyline = {
-            'polyline': [],
+            'polyline': "",
             'midlat': 52.2,
             'midlon': 0.13,
         }
@@ -243,9 +544,9 @@ def gpx_details(gpx_id: int) -> Response | str:
     # ----------------------------------------------------------- #
     # Get elevation data
     # ----------------------------------------------------------- #
-    if os.path.exists(filename):
+    if gpx_exists(filename):
         elevation_data = get_elevation_data(filename)
-        cafe_elevation_data = get_cafe_heights_from_gpx(cafe_list, elevation_data)
+        cafe_elevation_data = get_cafe_heights_from_gpx(cafe_list, filename)
     else:
         elevation_data = []
         cafe_elevation_data = []
@@ -256,6 +557,11 @@ def gpx_details(gpx_id: int) -> Response | str:
     # If the route in attached to a ride in the Calendar, then they can't hide it as it would break the ride
     rides = CalendarRepository.all_rides_gpx_id(gpx.id)
 
+    # ----------------------------------------------------------- #
+    # Is the background worker still matching it to cafes?
+    # ----------------------------------------------------------- #
+    cafe_job_status = JobRepository.gpx_cafes_status(gpx.id)
+
     # ----------------------------------------------------------- #
     # Num downloads
     # ----------------------------------------------------------- #
@@ -267,15 +573,16 @@ def gpx_details(gpx_id: int) -> Response | str:
     if not gpx.public:
         flash("This route is not public yet!")
 
-    # Keep count of Google Map Loads
-    count_map_loads(1)
+    # NB Everyone gets the thumbnail and only loads the Google map (and counts it, see map_load()) if they tap on it
 
     # Render in main index template
     return render_template("gpx_details.html", gpx=gpx, year=current_year, cafe_markers=cafe_markers,
                            author=author, cafe_list=cafe_list, elevation_data=elevation_data,
                            cafe_elevation_data=cafe_elevation_data, GOOGLE_MAPS_API_KEY=google_maps_api_key(),
                            polyline=polyline['polyline'], midlat=polyline['midlat'], midlon=polyline['midlon'],
-                           MAP_BOUNDS=MAP_BOUNDS, rides=rides, live_site=live_site())
+                           MAP_BOUNDS=MAP_BOUNDS, rides=rides, live_site=live_site(),
+                           cafe_job_status=cafe_job_status, JOB_QUEUED=JOB_QUEUED, JOB_RUNNING=JOB_RUNNING,
+                           JOB_FAILED=JOB_FAILED)
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -329,65 +636,32 @@ def new_route() -> Response | str:
                 return render_template("gpx_add.html", year=current_year, form=form, live_site=live_site())
 
             # Create a new GPX object
-            # We do this first as we need the id in order to create
-            # the filename for the GPX file when we upload it
             gpx: GpxModel = GpxModel()
             gpx.name = form.name.data
             gpx.email = current_user.email
-            gpx.cafes_passed = "[]"
-            gpx.ascent_m = 0
-            gpx.length_km = 0
-            gpx.filename = "tmp"
             gpx.type = form.type.data
             gpx.details = form.details.data
             gpx.public = False
 
-            # Add to the dB
-            gpx = GpxRepository.add_gpx(gpx)  # type: ignore
-            if gpx:
-                # Success, added GPX to dB
-                app.logger.debug(f"new_route(): GPX added to dB, id = '{gpx.id}'.")
-                EventRepository.log_event(f"New GPX Success", f" GPX added to dB, gpx.id = '{gpx.id}'.")
-            else:
-                # Failed to create new dB entry
+            # Read the upload once, clean it up and add it to the dB along with the cafes it passes
+            gpx = ingest_gpx_upload(file, gpx)  # type: ignore
+            if not gpx:
                 app.logger.debug(f"new_route(): Failed to add gpx to the dB!")
                 EventRepository.log_event(f"New GPX Fail", f"Failed to add gpx to the dB!")
                 flash("Sorry, something went wrong!")
                 return render_template("gpx_add.html", year=current_year, form=form, live_site=live_site())
 
-            # This is where we will store it
-            filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, f"gpx_{gpx.id}.gpx")
-            app.logger.debug(f"new_route(): Filename will be = '{filename}'.")
-
-            # Make sure this doesn't already exist
-            if not delete_file_if_exists(filename):
-                # Failed to delete existing file (func will generate error trace)
-                flash("Sorry, something went wrong!")
-                return render_template("gpx_add.html", year=current_year, form=form, live_site=live_site())
-
-            # Upload the GPX file
-            try:
-                file.save(filename)
-            except Exception as e:
-                app.logger.debug(f"new_route(): Failed to upload/save '{filename}', error code was {e.args}.")
-                EventRepository.log_event(f"New GPX Fail", f"Failed to upload/save '{filename}', error code was {e.args}.")
-                flash("Sorry, something went wrong!")
-                return render_template("gpx_add.html", year=current_year, form=form, live_site=live_site())
-
-            # Update gpx object with filename
-            if not GpxRepository.update_filename(gpx.id, filename):
-                app.logger.debug(f"new_route(): Failed to update filename in the dB for gpx_id='{gpx.id}'.")
-                EventRepository.log_event(f"New GPX Fail", f"Failed to update filename in the dB for gpx_id='{gpx.id}'.")
-                flash("Sorry, something went wrong!")
-                return render_template("gpx_add.html", year=current_year, form=form, live_site=live_site())
-
-            # Strip all excess data from the file
+            # We only keep lat, lon and elevation
             flash("Any HR or Power data has been removed.")
-            strip_excess_info_from_gpx(filename, gpx.id, f"ELSR: {gpx.name}")
 
-            # Forward to edit route as that's the next step
             app.logger.debug(f"new_route(): New GPX added, gpx_id = '{gpx.id}', ({gpx.name}).")
             EventRepository.log_event(f"New GPX Success", f"New GPX added, gpx_id = '{gpx.id}', ({gpx.name}).")
+
+            # Offer them an existing route, if it looks like we already have it
+            if gpx.duplicates:
+                return redirect(url_for('gpx_duplicate', gpx_id=gpx.id))  # type: ignore
+
+            # Forward to edit route as that's the next step
             return redirect(url_for('edit_route', gpx_id=gpx.id))   # type: ignore
 
     elif request.method == 'POST':
@@ -406,6 +680,91 @@ def new_route() -> Response | str:
     return render_template("gpx_add.html", year=current_year, form=form, live_site=live_site())
 
 
+# -------------------------------------------------------------------------------------------------------------- #
+# Offer an existing route instead of a just uploaded copy
+# -------------------------------------------------------------------------------------------------------------- #
+
+@app.route('/route_duplicate/<int:gpx_id>', methods=['GET', 'POST'])
+@logout_barred_user
+@login_required
+@update_last_seen
+@rw_required
+def gpx_duplicate(gpx_id: int) -> Response | str:
+    # ----------------------------------------------------------- #
+    # Get details from the page
+    # ----------------------------------------------------------- #
+    return_path = request.args.get('return_path', None)
+
+    # ----------------------------------------------------------- #
+    # Check params are valid
+    # ----------------------------------------------------------- #
+    gpx = GpxRepository.one_by_id(gpx_id)
+    if not gpx:
+        app.logger.debug(f"gpx_duplicate(): Failed to locate GPX with gpx_id = '{gpx_id}'.")
+        EventRepository.log_event("GPX Duplicate Fail", f"Failed to locate GPX with gpx_id = '{gpx_id}'.")
+        return abort(404)
+
+    # ----------------------------------------------------------- #
+    # Restrict access to Admin or Author
+    # ----------------------------------------------------------- #
+    if current_user.email != gpx.email \
+            and not current_user.admin:
+        app.logger.debug(f"gpx_duplicate(): Refusing permission for '{current_user.email}', gpx_id = '{gpx_id}'.")
+        EventRepository.log_event("GPX Duplicate Fail", f"Refusing permission for '{current_user.email}', "
+                                                        f"gpx_id = '{gpx_id}'.")
+        return abort(403)
+
+    # ----------------------------------------------------------- #
+    # GET - show them the routes which look the same
+    # ----------------------------------------------------------- #
+    if request.method == 'GET':
+        track = stored_track(gpx.id, gpx.filename)
+        duplicates = find_duplicate_routes(gpx, track) if track else []
+        if not duplicates:
+            return redirect(url_for('edit_route', gpx_id=gpx.id, return_path=return_path))  # type: ignore
+        return render_template("gpx_duplicate.html", year=current_year, gpx=gpx, duplicates=duplicates,
+                               return_path=return_path, live_site=live_site())
+
+    # ----------------------------------------------------------- #
+    # POST - they've picked an existing route
+    # ----------------------------------------------------------- #
+    existing_id = int_or_none(request.form.get('existing_id', None))
+    existing = GpxRepository.one_by_id(existing_id) if existing_id else None
+    if not existing \
+            or existing.id == gpx.id \
+            or not (existing.public or existing.email == gpx.email):
+        app.logger.debug(f"gpx_duplicate(): Invalid existing_id = '{request.form.get('existing_id', None)}'.")
+        EventRepository.log_event("GPX Duplicate Fail", f"Invalid existing_id = "
+                                                        f"'{request.form.get('existing_id', None)}'.")
+        return abort(400)
+
+    # Move any rides across first, so nothing is ever left pointing at a deleted route
+    if not CalendarRepository.move_rides_to_gpx(gpx.id, existing.id) \
+            or not GpxRepository.delete_gpx(gpx.id):
+        app.logger.debug(f"gpx_duplicate(): Failed to swap gpx_id = '{gpx.id}' for gpx_id = '{existing.id}'.")
+        EventRepository.log_event("GPX Duplicate Fail", f"Failed to swap gpx_id = '{gpx.id}' for "
+                                                        f"gpx_id = '{existing.id}'.")
+        flash("Sorry, something went wrong!")
+        return redirect(url_for('edit_route', gpx_id=gpx.id, return_path=return_path))  # type: ignore
+
+    delete_route_files(gpx.id, gpx.filename)
+
+    # Rides were waiting on their route being published, if this one already is they can go out now
+    if existing.public:
+        for ride in CalendarRepository.all_rides_gpx_id(existing.id):
+            if ride.sent_email != "True":
+                queue_ride_emails(ride.id)
+
+    app.logger.debug(f"gpx_duplicate(): Replaced gpx_id = '{gpx.id}' with gpx_id = '{existing.id}'.")
+    EventRepository.log_event("GPX Duplicate Success", f"Replaced gpx_id = '{gpx.id}' with gpx_id = '{existing.id}'.")
+    flash(f"Your upload has been replaced with '{existing.name}'.")
+
+    if return_path and \
+            return_path != "None":
+        return redirect(return_path)  # type: ignore
+    return redirect(url_for('gpx_details', gpx_id=existing.id))  # type: ignore
+
+
 # -------------------------------------------------------------------------------------------------------------- #
 # Delete a GPX route
 # -------------------------------------------------------------------------------------------------------------- #
@@ -502,16 +861,9 @@ def route_delete() -> Response | str:
         return redirect(url_for('gpx_list'))  # type: ignore
 
     # ----------------------------------------------------------- #
-    # Delete #2: Remove GPX file itself
+    # Delete #2: Remove GPX file itself, and the files we built from it
     # ----------------------------------------------------------- #
-    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
-    try:
-        os.remove(filename)
-        app.logger.debug(f"route_delete(): File '{filename}' deleted from directory.")
-    except Exception as e:
-        app.logger.debug(f"route_delete(): Failed to delete GPX file '{filename}', error code was '{e.args}'.")
-        EventRepository.log_event("GPX Delete Fail", f"Failed to delete GPX file '{filename}', "
-                                             f"error code was {e.args}, gpx_id = {gpx_id}!")
+    delete_route_files(gpx.id, gpx.filename)
 
     # Back to GPX list page
     return redirect(url_for('gpx_list'))  # type: ignore
@@ -615,7 +967,7 @@ def route_download(gpx_id: int) -> Response | str:
     # Check GPX file exists
     # ----------------------------------------------------------- #
     filename: str = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
-    if not os.path.exists(filename):
+    if not gpx_exists(filename):
         # Should never get here, but..
         app.logger.debug(f"route_download(): Failed to locate filename = '{filename}', gpx_id = '{gpx_id}'.")
         EventRepository.log_event("GPX Download Fail", f"Failed to locate filename = '{filename}', gpx_id = '{gpx_id}'.")
@@ -634,9 +986,15 @@ def route_download(gpx_id: int) -> Response | str:
         return abort(404)
 
     # ----------------------------------------------------------- #
-    # Update the GPX file with the correct name (in case it's changed)
+    # Get the downloadable copy (with the current name)
     # ----------------------------------------------------------- #
-    check_route_name(gpx=gpx)
+    download = download_gpx(gpx)
+    if not download:
+        app.logger.debug(f"route_download(): Failed to build download for gpx_id = '{gpx_id}'.")
+        EventRepository.log_event("GPX Download Fail", f"Failed to build download for gpx_id = '{gpx_id}'.")
+        flash("Sorry, we couldn't create a GPX file for that route!")
+        return redirect(url_for('gpx_details', gpx_id=gpx_id))  # type: ignore
+    download_filename, download_key = download
 
     # ----------------------------------------------------------- #
     # Update count
@@ -654,9 +1012,7 @@ def route_download(gpx_id: int) -> Response | str:
                      f"filename = '{filename}'.")
     EventRepository.log_event("GPX Downloaded", f"Serving GPX gpx_id = '{gpx_id}' to '{current_user.email}', "
                                         f"filename = ({gpx.name}).")
-    return send_from_directory(directory=GPX_UPLOAD_FOLDER_ABS,
-                               path=os.path.basename(gpx.filename),
-                               download_name=download_name)
+    return send_gpx_download(download_filename, download_key, download_name)
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -730,7 +1086,7 @@ def gpx_download2() -> Response | str:
     # ----------------------------------------------------------- #
     filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
 
-    if not os.path.exists(filename):
+    if not gpx_exists(filename):
         # Should never get here, but..
         app.logger.debug(f"gpx_download2(): Failed to locate filename = '{filename}', gpx_id = '{gpx_id}'.")
         EventRepository.log_event("gpx_download2 Fail", f"Failed to locate filename = '{filename}', gpx_id = '{gpx_id}'.")
@@ -749,9 +1105,15 @@ def gpx_download2() -> Response | str:
         return abort(404)
 
     # ----------------------------------------------------------- #
-    # Update the GPX file with the correct name (in case it's changed)
+    # Get the downloadable copy (with the current name)
     # ----------------------------------------------------------- #
-    check_route_name(gpx)
+    download = download_gpx(gpx)
+    if not download:
+        app.logger.debug(f"gpx_download2(): Failed to build download for gpx_id = '{gpx_id}'.")
+        EventRepository.log_event("gpx_download2 Fail", f"Failed to build download for gpx_id = '{gpx_id}'.")
+        flash("Sorry, we couldn't create a GPX file for that route!")
+        return redirect(url_for('gpx_details', gpx_id=gpx_id))  # type: ignore
+    download_filename, download_key = download
 
     # ----------------------------------------------------------- #
     # Update count
@@ -769,8 +1131,6 @@ def gpx_download2() -> Response | str:
                      f"filename = '{filename}'.")
     EventRepository.log_event("gpx_download2", f"Serving GPX gpx_id = '{gpx_id}' to '{user.email}', "
                                        f"filename = ({gpx.name}).")
-    return send_from_directory(directory=GPX_UPLOAD_FOLDER_ABS,
-                               path=os.path.basename(gpx.filename),
-                               download_name=download_name)
+    return send_gpx_download(download_filename, download_key, download_name)
 
 
@@ -1,7 +1,6 @@
 from flask import render_template, redirect, url_for, flash, request, abort, Response
 from flask_login import current_user
 import os
-from threading import Thread
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -19,9 +18,10 @@ from core.database.repositories.user_repository import UserModel, UserRepository
 from core.database.repositories.gpx_repository import GpxRepository
 from core.forms.gpx_forms import create_rename_gpx_form
 from core.database.repositories.event_repository import EventRepository
-from core.subs_gpx import check_new_gpx_with_all_cafes
-from core.subs_google_maps import start_and_end_maps_native_gm, MAP_BOUNDS, google_maps_api_key, count_map_loads
-from core.subs_gpx_edit import cut_start_gpx, cut_end_gpx
+from core.subs_jobs import queue_gpx_analysis, queue_heatmap_update
+from core.subs_google_maps import start_and_end_maps_native_gm, MAP_BOUNDS, google_maps_api_key
+from core.subs_gpx_edit import cut_start_gpx, cut_end_gpx, undo_gpx_edit, can_undo_gpx_edit
+from core.subs_gpx_storage import gpx_exists
 from core.database.repositories.calendar_repository import CalendarRepository
 
 from core.decorators.user_decorators import update_last_seen, logout_barred_user, login_required, rw_required
@@ -76,7 +76,7 @@ def edit_route() -> Response | str:
     filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
 
     # Check the file is actually there, before we try and parse it etc
-    if not os.path.exists(filename):
+    if not gpx_exists(filename):
         app.logger.debug(f"edit_route(): Failed to locate GPX file for gpx_id = '{gpx_id}'.")
         EventRepository.log_event("Edit GPX Fail", f"Failed to locate GPX file for gpx_id = '{gpx_id}'.")
         flash(f"We seem to have lost the GPX file for route #{gpx_id} ({gpx.name})!")
@@ -135,6 +135,8 @@ def edit_route() -> Response | str:
                 app.logger.debug(f"edit_route(): Successfully updated GPX '{gpx.id}'.")
                 EventRepository.log_event("Edit GPX Success", f"Successfully updated GPX '{gpx_id}'.")
                 flash("Details have been updated!")
+                # Gravel routes have their own heatmap layer
+                queue_heatmap_update(gpx.id)
             else:
                 # Should never get here, but...
                 app.logger.debug(f"edit_route(): Failed to update GPX '{gpx.id}'.")
@@ -167,14 +169,13 @@ def edit_route() -> Response | str:
             user: UserModel | None = UserRepository.one_by_email(gpx.email)
             form.owner.data = f"{user.name} ({user.id})"
 
-    # Keep count of Google Map Loads
-    count_map_loads(1)
+    # NB The maps only load (and get counted, see map_load()) when they tap on them
 
     # Render the page
     return render_template("gpx_edit.html", year=current_year, gpx=gpx, GOOGLE_MAPS_API_KEY=google_maps_api_key(),
                            MAP_BOUNDS=MAP_BOUNDS, start_markers=maps[0], start_map_coords=maps[1],
                            end_markers=maps[2], end_map_coords=maps[3], return_path=return_path, form=form,
-                           live_site=live_site())
+                           can_undo=can_undo_gpx_edit(gpx), live_site=live_site())
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -236,7 +237,9 @@ def gpx_cut_start() -> Response | str:
     # ----------------------------------------------------------- #
     # Cut start of route
     # ----------------------------------------------------------- #
-    cut_start_gpx(gpx.filename, index)
+    if not cut_start_gpx(gpx, index):
+        flash("Sorry, something went wrong!")
+        return redirect(url_for('edit_route', gpx_id=gpx_id, return_path=return_path))  # type: ignore
 
     # ----------------------------------------------------------- #
     # Update GPX for cafes
@@ -244,7 +247,8 @@ def gpx_cut_start() -> Response | str:
     if GpxRepository.clear_cafe_list(gpx_id):
         # Go ahead and update the list
         flash("Nearby cafe list is being been updated.")
-        Thread(target=check_new_gpx_with_all_cafes, args=(gpx_id, None, )).start()
+        queue_gpx_analysis(gpx_id)
+        queue_heatmap_update(gpx_id)
 
     else:
         # Should never happen, but...
@@ -315,7 +319,9 @@ def gpx_cut_end() -> Response | str:
     # ----------------------------------------------------------- #
     # Cut end of route
     # ----------------------------------------------------------- #
-    cut_end_gpx(gpx.filename, index)
+    if not cut_end_gpx(gpx, index):
+        flash("Sorry, something went wrong!")
+        return redirect(url_for('edit_route', gpx_id=gpx_id, return_path=return_path))  # type: ignore
 
     # ----------------------------------------------------------- #
     # Update GPX for cafes
@@ -323,7 +329,8 @@ def gpx_cut_end() -> Response | str:
     if GpxRepository.clear_cafe_list(gpx_id):
         # Go ahead and update the list
         flash("Nearby cafe list is being updated...")
-        Thread(target=check_new_gpx_with_all_cafes, args=(gpx_id, None, )).start()
+        queue_gpx_analysis(gpx_id)
+        queue_heatmap_update(gpx_id)
     else:
         # Should never get here, but..
         app.logger.debug(f"gpx_cut_end(): Gpx().clear_cafe_list() failed for gpx_id = '{gpx_id}'.")
@@ -334,6 +341,78 @@ def gpx_cut_end() -> Response | str:
     return redirect(url_for('edit_route', gpx_id=gpx_id, return_path=return_path))  # type: ignore
 
 
+# -------------------------------------------------------------------------------------------------------------- #
+# Undo the last crop of a GPX
+# -------------------------------------------------------------------------------------------------------------- #
+
+@app.route('/gpx_undo_edit', methods=['POST'])
+@logout_barred_user
+@login_required
+@update_last_seen
+@rw_required
+def gpx_undo_edit() -> Response | str:
+    # ----------------------------------------------------------- #
+    # Get details from the page
+    # ----------------------------------------------------------- #
+    gpx_id = request.args.get('gpx_id', None)
+    # return_path is optional
+    return_path = request.args.get('return_path', None)
+
+    # ----------------------------------------------------------- #
+    # Handle missing parameters
+    # ----------------------------------------------------------- #
+    if not gpx_id:
+        app.logger.debug(f"gpx_undo_edit(): Missing gpx_id!")
+        EventRepository.log_event("GPX Undo Fail", f"Missing gpx_id!")
+        return abort(400)
+
+    # ----------------------------------------------------------- #
+    # Check params are valid
+    # ----------------------------------------------------------- #
+    gpx = GpxRepository.one_by_id(gpx_id)
+
+    if not gpx:
+        app.logger.debug(f"gpx_undo_edit(): Failed to locate GPX with gpx_id = '{gpx_id}'.")
+        EventRepository.log_event("GPX Undo Fail", f"Failed to locate GPX with gpx_id = '{gpx_id}'.")
+        return abort(404)
+
+    # ----------------------------------------------------------- #
+    # Restrict access to Admin and Author
+    # ----------------------------------------------------------- #
+    # Rules:
+    # 1. Must be admin or the current author
+    # 2. Must not be barred (NB Admins cannot be barred)
+    if current_user.email != gpx.email \
+            and not current_user.admin:
+        # Failed authentication
+        app.logger.debug(f"gpx_undo_edit(): Refusing permission for '{current_user.email}' and route '{gpx_id}'.")
+        EventRepository.log_event("GPX Undo Fail", f"Refusing permission for {current_user.email}, gpx_id = '{gpx_id}'.")
+        return abort(403)
+
+    # ----------------------------------------------------------- #
+    # Back to the previous version
+    # ----------------------------------------------------------- #
+    if not undo_gpx_edit(gpx.id):
+        flash("Sorry, there's nothing to undo!")
+        return redirect(url_for('edit_route', gpx_id=gpx_id, return_path=return_path))  # type: ignore
+
+    # ----------------------------------------------------------- #
+    # Update GPX for cafes
+    # ----------------------------------------------------------- #
+    if GpxRepository.clear_cafe_list(gpx_id):
+        flash("Your last edit has been undone, nearby cafe list is being updated...")
+        queue_gpx_analysis(gpx_id)
+        queue_heatmap_update(gpx_id)
+    else:
+        # Should never get here, but..
+        app.logger.debug(f"gpx_undo_edit(): Gpx().clear_cafe_list() failed for gpx_id = '{gpx_id}'.")
+        EventRepository.log_event("GPX Undo Fail", f"Gpx().clear_cafe_list() failed for gpx_id = '{gpx_id}'.")
+        flash("Sorry, something went wrong!")
+
+    # Back to the edit page
+    return redirect(url_for('edit_route', gpx_id=gpx_id, return_path=return_path))  # type: ignore
+
+
 # -------------------------------------------------------------------------------------------------------------- #
 # Make a route public
 # -------------------------------------------------------------------------------------------------------------- #
@@ -419,7 +498,8 @@ def publish_route() -> Response | str:
     # Add new existing nearby cafe list
     # ----------------------------------------------------------- #
     flash("Nearby cafe list is being updated.")
-    Thread(target=check_new_gpx_with_all_cafes, args=(gpx_id, calendar_id)).start()
+    queue_gpx_analysis(gpx_id, calendar_id)
+    queue_heatmap_update(gpx_id)
 
     # Decide where to go next...
     if return_path and \
@@ -488,6 +568,7 @@ def hide_route() -> Response | str:
         app.logger.debug(f"hide_route(): Route hidden gpx_id = '{gpx_id}'.")
         EventRepository.log_event("Hide GPX Success", f"Route hidden gpx_id = '{gpx_id}'.")
         flash("Route has been hidden.")
+        queue_heatmap_update(gpx_id)
     else:
         # Should never happen, but...
         app.logger.debug(f"hide_route(): Gpx().hide() failed for gpx_id = '{gpx_id}'.")
@@ -1,7 +1,5 @@
 from flask import render_template, flash, Response
 from flask_login import current_user
-import gpxpy
-import gpxpy.gpx
 import os
 import mpu
 
@@ -21,6 +19,8 @@ from core.subs_google_maps import google_maps_api_key, MAP_BOUNDS, count_map_loa
                                   create_polyline_set, MAX_NUM_GPX_PER_GRAPH
 from core.database.repositories.gpx_repository import GpxRepository
 from core.subs_gpx import ELSR_LAT, ELSR_LON
+from core.subs_gpx_storage import gpx_exists
+from core.subs_gpx_cache import gpx_track
 
 from core.decorators.user_decorators import update_last_seen
 
@@ -82,7 +82,7 @@ def gravel_all() -> Response | str:
         filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
 
         # Check the file is actually there, before we try and parse it etc
-        if not os.path.exists(filename):
+        if not gpx_exists(filename):
             missing_files.append(gpx.id)
 
     # Need different path for Admin
@@ -104,7 +104,7 @@ def gravel_all() -> Response | str:
 
     # Warn if we skipped any
     if len(gpxes) >= MAX_NUM_GPX_PER_GRAPH:
-        warning = f"NB: Only showing first {MAX_NUM_GPX_PER_GRAPH} routes on map."
+        warning = f"NB: Only showing first {MAX_NUM_GPX_PER_GRAPH} routes on map, the shading shows all the rest."
     else:
         warning = None
 
@@ -149,7 +149,7 @@ def gravel_ldt() -> Response | str:
         filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
 
         # Check the file is actually there, before we try and parse it etc
-        if not os.path.exists(filename):
+        if not gpx_exists(filename):
             missing_files.append(gpx.id)
 
     # Need different path for Admin
@@ -171,7 +171,7 @@ def gravel_ldt() -> Response | str:
 
     # Warn if we skipped any
     if len(gpxes) >= MAX_NUM_GPX_PER_GRAPH:
-        warning = f"NB: Only showing first {MAX_NUM_GPX_PER_GRAPH} routes on map."
+        warning = f"NB: Only showing first {MAX_NUM_GPX_PER_GRAPH} routes on map, the shading shows all the rest."
     else:
         warning = None
 
@@ -212,13 +212,13 @@ def gravel_local() -> Response | str:
         filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
 
         # Check GPX file actually exists
-        if os.path.exists(filename):
+        if gpx_exists(filename):
 
-            # Open the file
-            with open(filename, 'r') as file_ref:
-                gpx_file = gpxpy.parse(file_ref)
-                start_lat = gpx_file.tracks[0].segments[0].points[0].latitude
-                start_lon = gpx_file.tracks[0].segments[0].points[0].longitude
+            # Parsed points come from the cache
+            track = gpx_track(filename)
+            if track and len(track) > 0:
+                start_lat = float(track.lat[0])
+                start_lon = float(track.lon[0])
                 range_km = mpu.haversine_distance((start_lat, start_lon), (ELSR_LAT, ELSR_LON))
                 if range_km < LOCAL_MAX_KM:
                     local_gpxes.append(gpx)
@@ -232,7 +232,7 @@ def gravel_local() -> Response | str:
         filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
 
         # Check the file is actually there, before we try and parse it etc
-        if not os.path.exists(filename):
+        if not gpx_exists(filename):
             missing_files.append(gpx.id)
 
     # Need different path for Admin
@@ -254,7 +254,7 @@ def gravel_local() -> Response | str:
 
     # Warn if we skipped any
     if len(local_gpxes) >= MAX_NUM_GPX_PER_GRAPH:
-        warning = f"NB: Only showing first {MAX_NUM_GPX_PER_GRAPH} routes on map."
+        warning = f"NB: Only showing first {MAX_NUM_GPX_PER_GRAPH} routes on map, the shading shows all the rest."
     else:
         warning = None
 
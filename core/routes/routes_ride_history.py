@@ -18,7 +18,7 @@ from core.database.repositories.gpx_repository import GpxModel, GpxRepository
 from core.database.repositories.cafe_repository import CafeModel, CafeRepository, OPEN_CAFE_COLOUR, CLOSED_CAFE_COLOUR
 
 from core.subs_google_maps import create_polyline_set, MAX_NUM_GPX_PER_GRAPH, MAP_BOUNDS, \
-                                  google_maps_api_key, count_map_loads
+                                  google_maps_api_key, map_thumbnails
 
 from core.decorators.user_decorators import update_last_seen, logout_barred_user
 
@@ -108,10 +108,10 @@ def ride_history(group: str) -> Response | str:
         warning = None
 
     # ----------------------------------------------------------- #
-    # Add to map counts
+    # Thumbnails to show until they tap on the map
     # ----------------------------------------------------------- #
-    if polylines['polylines']:
-        count_map_loads(1)
+    # NB The map only loads (and gets counted, see map_load()) when they tap on it
+    map_images = map_thumbnails(gpxes)
 
     # ----------------------------------------------------------- #
     # Render the page
@@ -120,4 +120,5 @@ def ride_history(group: str) -> Response | str:
     return render_template("calendar_group.html", year=current_year, group_name=group_name, rides=group_rides,
                            GOOGLE_MAPS_API_KEY=google_maps_api_key(), warning=warning,
                            MAP_BOUNDS=MAP_BOUNDS, gpxes=gpxes, cafes=cafe_markers, live_site=live_site(),
-                           polylines=polylines['polylines'], midlat=polylines['midlat'], midlon=polylines['midlon'])
+                           map_images=map_images, polylines=polylines['polylines'], midlat=polylines['midlat'],
+                           midlon=polylines['midlon'])
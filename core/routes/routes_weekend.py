@@ -7,14 +7,14 @@ import os
 # Import app from __init__.py
 # -------------------------------------------------------------------------------------------------------------- #
 
-from core import app, current_year, live_site, GLOBAL_FLASH
+from core import app, current_year, live_site, GPX_UPLOAD_FOLDER_ABS
 
 # -------------------------------------------------------------------------------------------------------------- #
 # Import our three database classes and associated forms, decorators etc
 # -------------------------------------------------------------------------------------------------------------- #
 
 from core.database.repositories.cafe_repository import CafeModel, CafeRepository, OPEN_CAFE_COLOUR, CLOSED_CAFE_COLOUR
-from core.database.repositories.gpx_repository import GpxModel, GpxRepository
+from core.database.repositories.gpx_repository import GpxModel, GpxRepository, GpxCafeModel
 from core.database.repositories.calendar_repository import CalendarModel, CalendarRepository, DEFAULT_START_TIMES
 from core.database.repositories.event_repository import EventRepository
 
@@ -22,10 +22,11 @@ from core.database.jinja.calendar_jinja import start_time_string
 
 from core.decorators.user_decorators import update_last_seen, logout_barred_user
 
-from core.subs_google_maps import create_polyline_set, ELSR_HOME, MAP_BOUNDS, google_maps_api_key, count_map_loads
-from core.subs_gpx import GPX_UPLOAD_FOLDER_ABS
+from core.subs_google_maps import create_polyline_set, ELSR_HOME, MAP_BOUNDS, google_maps_api_key, map_thumbnails
+from core.subs_gpx_storage import gpx_exists
 from core.subs_graphjs import get_elevation_data_set, get_destination_cafe_height
 from core.subs_dates import get_date_from_url
+from core.subs_site_flags import global_flash
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -55,8 +56,12 @@ def work_out_days(target_date_str) -> list[object] | None:
     doesn't actually check for official Bank Holidays, it just looks for rides scheduled on the Friday or Monday. If
     the function is called with a mid-week day, eg a random Wednesday, it will just return the date for that day.
 
+    NB All the rides for the Friday to Monday are read in one query, which both tells us if the Friday / Monday
+    are BHs and gives the weekend page its rides.
+
     :param target_date_str:                     The date string requested in format "DDMMYYYY"
-    :return:
+    :return:                                    [days, dates_long, dates_short, rides_by_date] where rides_by_date
+                                                is {"DDMMYYYY": [rides ordered by group]} for each day shown
     """
     # Step 1: Create a set of date strings eg ["23082023", "24082023" ]
     if target_date_str:
@@ -135,15 +140,31 @@ def work_out_days(target_date_str) -> list[object] | None:
 
     # Ignore case of just one day eg a random Wednesday
     if len(days) > 1:
-        # ----------------------------------------------------------- #
-        # Do we have any rides on the Friday?
-        # ----------------------------------------------------------- #
         # Convert "23082023" -> datetime object -> "22082023"
         friday_date = datetime(int(dates_short["Saturday"][4:8]), int(dates_short["Saturday"][2:4]),
                                int(dates_short["Saturday"][0:2]), 0, 00) - timedelta(days=1)
         friday_date_str = friday_date.strftime("%d%m%Y")
-        # Do we have any rides in the dB
-        if CalendarRepository.all_calendar_date(friday_date_str):
+
+        # Convert "23082023" -> datetime object -> "24082023"
+        monday_date = datetime(int(dates_short["Sunday"][4:8]), int(dates_short["Sunday"][2:4]),
+                               int(dates_short["Sunday"][0:2]), 0, 00) + timedelta(days=1)
+        monday_date_str = monday_date.strftime("%d%m%Y")
+
+        # Every ride from Friday to Monday in one go
+        candidate_dates = [friday_date_str, dates_short["Saturday"], dates_short["Sunday"], monday_date_str]
+    else:
+        candidate_dates = [dates_short[days[0]]]
+
+    rides_by_date: dict[str, list[CalendarModel]] = {date_str: [] for date_str in candidate_dates}
+    for ride in CalendarRepository.all_calendar_dates(candidate_dates):
+        # NB Stays in group order, as that's how they came out of the dB
+        rides_by_date[ride.date].append(ride)
+
+    if len(days) > 1:
+        # ----------------------------------------------------------- #
+        # Do we have any rides on the Friday?
+        # ----------------------------------------------------------- #
+        if rides_by_date[friday_date_str]:
             # We have a ride on the Friday, so pre-pend Friday
             days.insert(0, "Friday")
             dates_short["Friday"] = friday_date_str
@@ -151,12 +172,7 @@ def work_out_days(target_date_str) -> list[object] | None:
         # ----------------------------------------------------------- #
         # Do we have any rides on the Monday?
         # ----------------------------------------------------------- #
-        # Convert "23082023" -> datetime object -> "24082023"
-        monday_date = datetime(int(dates_short["Sunday"][4:8]), int(dates_short["Sunday"][2:4]),
-                               int(dates_short["Sunday"][0:2]), 0, 00) + timedelta(days=1)
-        monday_date_str = monday_date.strftime("%d%m%Y")
-        # Do we have any rides in the dB
-        if CalendarRepository.all_calendar_date(monday_date_str):
+        if rides_by_date[monday_date_str]:
             # We have a ride on the Monday, so append Monday
             days.append("Monday")
             dates_short["Monday"] = monday_date_str
@@ -179,9 +195,9 @@ def work_out_days(target_date_str) -> list[object] | None:
         dates_long[day] = target_date.strftime("%A %b %d %Y")
 
     # ----------------------------------------------------------- #
-    # Return the three data sets
+    # Return the four data sets
     # ----------------------------------------------------------- #
-    return [days, dates_long, dates_short]
+    return [days, dates_long, dates_short, rides_by_date]
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -221,6 +237,15 @@ def weekend() -> Response | str:
         days = tmp[0]  # eg 'Saturday'
         dates_long = tmp[1]  # eg 'Saturday 25 August 2023'
         dates_short = tmp[2]  # eg '01022023'
+        rides_by_date = tmp[3]  # eg {'01022023': [ride, ride]}
+
+    # ----------------------------------------------------------- #
+    # Look up every ride's route and cafe in one go
+    # ----------------------------------------------------------- #
+    all_rides: list[CalendarModel] = [ride for day in days for ride in rides_by_date[dates_short[day]]]
+    gpx_lookup: dict[int, GpxModel] = GpxRepository.all_by_ids([ride.gpx_id for ride in all_rides])
+    cafe_lookup: dict[int, CafeModel] = CafeRepository.all_by_ids([ride.cafe_id for ride in all_rides])
+    cafe_links: dict[tuple[int, int], GpxCafeModel] = GpxRepository.cafe_links(list(gpx_lookup.keys()))
 
     # ----------------------------------------------------------- #
     # Add GPX details
@@ -239,7 +264,7 @@ def weekend() -> Response | str:
     # Populate everything for each day eg loop over ['Saturday', 'Sunday']
     for day in days:
         # Get a set of rides for this day from the calendar indexed by short dates eg '01022024'
-        tmp_rides: list[CalendarModel] = CalendarRepository.all_calendar_date(dates_short[day])
+        tmp_rides: list[CalendarModel] = rides_by_date[dates_short[day]]
 
         # Create empty sets for all the data jinja will need to populate each day
         rides[day] = []
@@ -251,7 +276,7 @@ def weekend() -> Response | str:
         # Loop over each ride
         for ride in tmp_rides:
             # Look up the GPX object referenced in the ride object
-            gpx: GpxModel | None = GpxRepository.one_by_id(ride.gpx_id)
+            gpx: GpxModel | None = gpx_lookup.get(ride.gpx_id)
 
             # NB It could have been deleted, so check it still exists
             if gpx:
@@ -283,7 +308,7 @@ def weekend() -> Response | str:
                 rides[day].append(ride)
 
                 # Look up cafe (which might not yet be in the db)
-                cafe: CafeModel | None = CafeRepository.one_by_id(ride.cafe_id)
+                cafe: CafeModel | None = cafe_lookup.get(ride.cafe_id)
                 if cafe:
                     # Update destination (as cafe may have changed name)
                     ride.destination = cafe.name
@@ -307,7 +332,7 @@ def weekend() -> Response | str:
                 # Double check we can find the GPX file
                 # NB have seen once where it was stuck as a tmp file - wonder if I updated the website mid edit?
                 filename: str = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
-                if os.path.exists(filename):
+                if gpx_exists(filename):
                     ride.missing_gpx = False
                 else:
                     # Flag missing GPX file (will only be shown to Admins)
@@ -332,12 +357,12 @@ def weekend() -> Response | str:
         polylines[day] = create_polyline_set(gpxes[day])
 
     # ----------------------------------------------------------- #
-    # Keep track of map loads
+    # Thumbnails to show until they tap on a map
     # ----------------------------------------------------------- #
+    # NB Each day's map only loads (and gets counted, see map_load()) when they tap on it
+    map_images = {}
     for day in days:
-        if rides[day]:
-            # Weekend page has one map per day
-            count_map_loads(1)
+        map_images[day] = map_thumbnails(gpxes[day])
 
     # ----------------------------------------------------------- #
     # Get elevation graph data
@@ -346,7 +371,7 @@ def weekend() -> Response | str:
     elevation_cafes = {}
     for day in days:
         elevation_data[day] = get_elevation_data_set(gpxes[day])
-        elevation_cafes[day] = get_destination_cafe_height(elevation_data[day], gpxes[day], cafes[day])
+        elevation_cafes[day] = get_destination_cafe_height(gpxes[day], cafes[day], cafe_links)
 
     # ----------------------------------------------------------- #
     # Render the page
@@ -355,8 +380,9 @@ def weekend() -> Response | str:
         flash("One or more routes hasn't been made public yet!")
 
     # Temporary alert for change of meeting point
-    if GLOBAL_FLASH:
-        flash(GLOBAL_FLASH)
+    flash_message = global_flash()
+    if flash_message:
+        flash(flash_message)
 
     # Render the page
     return render_template("calendar_weekend.html", year=current_year,
@@ -364,5 +390,5 @@ def weekend() -> Response | str:
                            days=days, dates_long=dates_long, dates_short=dates_short,
                            DEFAULT_START_TIMES=DEFAULT_START_TIMES,
                            rides=rides, start_details=start_details,
-                           polylines=polylines, cafe_coords=cafe_coords, live_site=live_site(),
+                           polylines=polylines, map_images=map_images, cafe_coords=cafe_coords, live_site=live_site(),
                            elevation_data=elevation_data, elevation_cafes=elevation_cafes, anchor=target_date_str)
@@ -1,7 +1,6 @@
 import smtplib
 from unidecode import unidecode
 from datetime import datetime
-import json
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -410,8 +409,11 @@ def send_ride_notification_emails(ride: CalendarModel) -> None:
     # ----------------------------------------------------------- #
     # Modify ride to show email have been sent
     # ----------------------------------------------------------- #
-    # Do this now in case we crash mid-email send
-    CalendarRepository.mark_email_sent(ride.id)
+    # Do this now in case we crash mid-email send. It only succeeds once per ride, so if the job is retried (or
+    # another worker has got there first) we don't email everyone twice.
+    if not CalendarRepository.mark_email_sent(ride.id):
+        app.logger.debug(f"send_ride_notification_emails(): Aborting as email already claimed, ride.id = '{ride.id}'.")
+        return
 
     # ----------------------------------------------------------- #
     # Scan all users
@@ -481,11 +483,10 @@ def send_one_ride_notification_email(user: UserModel, ride: CalendarModel) -> No
     if gpx:
         ascent = str(gpx.ascent_m)
         distance = str(gpx.length_km)
-        for cafe_passed in json.loads(gpx.cafes_passed):
-            if cafe_passed["cafe_id"] == ride.cafe_id:
-                km = cafe_passed["range_km"]
-                cafe_distance = f"{km} km / {round(km/1.6,1)} miles"
-                break
+        cafe_passed = GpxRepository.cafe_passed(gpx.id, ride.cafe_id)
+        if cafe_passed:
+            km = cafe_passed.range_km
+            cafe_distance = f"{km} km / {round(km/1.6,1)} miles"
 
     # ----------------------------------------------------------- #
     # Create hyperlinks
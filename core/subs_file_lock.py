@@ -0,0 +1,73 @@
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+from typing import Iterator
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Stored next to the file it protects eg "gpx_42.gpx" -> "gpx_42.gpx.lock"
+LOCK_SUFFIX = ".lock"
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Lock a file across all the gunicorn workers
+# -------------------------------------------------------------------------------------------------------------- #
+
+@contextmanager
+def file_lock(filename: str, shared: bool = False) -> Iterator[None]:
+    """
+    Exclusive advisory lock on a file, shared by every gunicorn worker (and thread) on the box. Blocks until
+    we have it and is released even if the body raises, or the worker dies.
+    NB We lock a separate "<filename>.lock" file, as the file itself gets replaced (so has a new inode) on
+    every edit. The lock file is never deleted, otherwise two workers could end up holding locks on
+    different inodes.
+    NB Not re-entrant, don't nest two locks on the same file.
+    :param filename:                    Absolute path of the file to lock
+    :param shared:                      Take a shared (reader) lock instead, any number of readers can hold one
+                                        at once, but not while anyone holds the exclusive lock
+    :return:                            n/a
+    """
+    with open(f"{filename}{LOCK_SUFFIX}", 'a') as lock_ref:
+        fcntl.flock(lock_ref.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_ref.fileno(), fcntl.LOCK_UN)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Replace a file in one step
+# -------------------------------------------------------------------------------------------------------------- #
+
+def replace_file(filename: str, contents: str | bytes) -> None:
+    """
+    Write a file via a temp file and a single os.replace(), so anyone reading it sees either the old file or
+    the new one, never half of one. The temp file is unique to this worker / thread, so two writers can't
+    clobber each other's temp files. Raises if the write fails (leaving the old file alone).
+    :param filename:                    Absolute path of the file to write
+    :param contents:                    What to write (bytes are written in binary mode)
+    :return:                            n/a
+    """
+    tmp_filename = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_filename, 'wb' if isinstance(contents, bytes) else 'w') as file_ref:
+            file_ref.write(contents)
+        os.replace(tmp_filename, filename)
+    except Exception:
+        try:
+            os.remove(tmp_filename)
+        except OSError:
+            pass
+        raise
@@ -1,17 +1,20 @@
 from flask import url_for
-import gpxpy
-import gpxpy.gpx
-import mpu
-import os
+import atexit
 import json
-from datetime import datetime, date
+import secrets
+import threading
+import time
+from datetime import datetime, date, timedelta
+from typing import Any
 
 
 # -------------------------------------------------------------------------------------------------------------- #
 # Import app etc from __init__.py
 # -------------------------------------------------------------------------------------------------------------- #
 
-from core import app, GPX_UPLOAD_FOLDER_ABS, CONFIG_FOLDER, NEW_GOOGLE_MAPS_API_KEY
+from core import app, NEW_GOOGLE_MAPS_API_KEY
+from itsdangerous import BadSignature
+from itsdangerous.url_safe import URLSafeTimedSerializer
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -21,8 +24,12 @@ from core import app, GPX_UPLOAD_FOLDER_ABS, CONFIG_FOLDER, NEW_GOOGLE_MAPS_API_
 from core.database.repositories.user_repository import UserModel, UserRepository, SUPER_ADMIN_USER_ID
 from core.database.repositories.cafe_repository import CafeRepository
 from core.database.repositories.event_repository import EventRepository
+from core.database.repositories.map_count_repository import MapCountRepository
 from core.subs_email import send_system_alert_email
+from core.subs_site_flags import site_flag, set_site_flag, FLAG_MAPS_ENABLED, FLAG_MAPS_BOOST
 from core.subs_sms import send_sms
+from core.subs_gpx_cache import gpx_track
+from core.subs_gpx_polyline import route_polyline, route_polyline_at, tolerance_for_zoom
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -41,6 +48,12 @@ GPX_COLOURS = ["#b30000", "#7c1158", "#4421af", "#1a53ff", "#0d88e6", "#00b7c7",
 # Don't display 100s on a map as total mess
 MAX_NUM_GPX_PER_GRAPH = 9
 
+# Initial zoom of all the multi route maps, used to pick how simplified the routes can be
+MULTI_ROUTE_ZOOM = 9
+
+# How many route thumbnails stand in for a multi route map until they tap on it
+MAX_MAP_THUMBNAILS = 3
+
 # EL coords
 ELSR_HOME = {"lat": 52.199234344363, "lng": 0.113774646436378}
 
@@ -52,11 +65,11 @@ MAP_BOUNDS = {
         "east": ELSR_HOME['lng'] + 3,
 }
 
-# Maps enable status file location
-MAP_STATUS_FILENAME = "map_status.txt"
+# Each worker adds up its map loads and only writes them to the dB this often (or sooner if we're at the limit)
+MAP_COUNT_FLUSH_SECS = 5
 
-# Store map counts
-MAP_COUNT_FILENAME = "map_counts.csv"
+# How far back the admin page graph goes
+MAP_COUNT_GRAPH_DAYS = 365
 
 # Map load limits by day
 MAP_LIMITS_BY_DAY = {
@@ -72,12 +85,31 @@ MAP_LIMITS_BY_DAY = {
 # Map Boost number
 MAP_BOOST_NUMBER = 500
 
+# How long someone can sit on a page before tapping its map, see map_load_token()
+MAP_LOAD_TOKEN_MAX_AGE_SECS = 6 * 60 * 60
+
 
 # -------------------------------------------------------------------------------------------------------------- #
 # Variables
 # -------------------------------------------------------------------------------------------------------------- #
 
-maps_boost = {
+# Map loads this worker has counted, but not yet added to the dB, by day eg {"20231111": 3}
+pending_map_loads: dict[str, int] = {}
+pending_map_loads_lock = threading.Lock()
+last_map_loads_flush: float = 0
+
+# Writes out pending map loads if no more come along, otherwise a quiet worker could sit on them until it's killed
+map_loads_flush_timer: threading.Timer | None = None
+
+# Signs the tokens we hand out with each tap to load map
+map_load_serializer = URLSafeTimedSerializer(app.secret_key, salt="map-load")
+
+# Tokens this worker has already counted, with when they were issued, so replaying one doesn't count again
+redeemed_map_load_tokens: dict[str, float] = {}
+redeemed_map_load_tokens_lock = threading.Lock()
+
+# Today's total the last time we wrote to the dB, so we can tell if we're near the limit without asking
+map_count_today: dict[str, Any] = {
     'Day': "",
     'Value': 0
 }
@@ -108,46 +140,18 @@ def gpx_colour(number):
 # -------------------------------------------------------------------------------------------------------------- #
 
 def polyline_json(filename):
-    # Use absolute path for filename
-    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(filename))
-
-    # This is the list we will return
-    polyline = []
+    # This is built when the route is uploaded / edited, so we don't touch the points on a page load
+    route = route_polyline(filename)
 
-    # Also need mid lat and min lon
-    mid_lat = 0
-    mid_lon = 0
-    num_points = 0
-
-    with open(filename, 'r') as gpx_file:
-
-        gpx_track = gpxpy.parse(gpx_file)
-
-        for track in gpx_track.tracks:
-            for segment in track.segments:
-
-                for point in segment.points:
-                    polyline.append({
-                        'lat': point.latitude,
-                        'lng': point.longitude
-                    })
-
-                    mid_lat += point.latitude
-                    mid_lon += point.longitude
-                    num_points += 1
-
-    # Required format is a string with no quotes:
-    # const    flightPlanCoordinates = [
-    #     {lat: 37.772, lng: -122.214},
-    #     {lat: 21.291, lng: -157.821},
-    #     {lat: -18.142, lng: 178.431},
-    #     {lat: -27.467, lng: 153.027},
-    # ];
+    if route:
+        return route
 
+    # Required format is a Google encoded polyline string, which the page decodes with
+    # google.maps.geometry.encoding.decodePath()
     return {
-        'polyline': json.dumps(polyline).replace('"', ''),
-        'midlat': mid_lat / num_points,
-        'midlon': mid_lon / num_points,
+        'polyline': "",
+        'midlat': 0,
+        'midlon': 0,
     }
 
 
@@ -155,27 +159,24 @@ def polyline_json(filename):
 # Markers for a set of routes
 # -------------------------------------------------------------------------------------------------------------- #
 
-def create_polyline_set(gpxes):
+def create_polyline_set(gpxes: list[Any], zoom: int = MULTI_ROUTE_ZOOM) -> dict[str, Any]:
     # This is what we return
-    polyline_set = []
+    polyline_set: list[dict[str, str]] = []
 
     # Need to average out the routes
-    mid_lat = 0
-    mid_lon = 0
+    mid_lat: float = 0
+    mid_lon: float = 0
     num_routes = 0
 
     for gpx in gpxes:
-        # Absolute path
-        filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
-
-        # File should always be there, but....
-        if os.path.exists(filename):
+        # Pre encoded polyline, None if the GPX file is missing (should always be there, but....)
+        tmp = route_polyline(gpx.filename)
 
-            # Get results for a single GPX file
-            tmp = polyline_json(filename)
+        if tmp:
             name = gpx.name.replace("'", "")
             polyline = {
-                'polyline': tmp['polyline'],
+                # Coarsest simplified version which still looks right at this zoom
+                'polyline': route_polyline_at(tmp, tolerance_for_zoom(zoom, tmp['midlat'])),
                 'name': f'<a href="{url_for("gpx_details", gpx_id=gpx.id)}">Route: {name}</a>',
                 'color': gpx_colour(num_routes),
             }
@@ -204,6 +205,20 @@ def create_polyline_set(gpxes):
         }
 
 
+# -------------------------------------------------------------------------------------------------------------- #
+# Thumbnails for a set of routes
+# -------------------------------------------------------------------------------------------------------------- #
+
+def map_thumbnails(gpxes: list[Any]) -> list[str]:
+    """
+    Static pictures of the first few routes, to show in place of a multi route map until they tap on it.
+    NB Hidden routes are skipped, as most people aren't allowed to see their thumbnails.
+    :param gpxes:                       Routes on the map
+    :return:                            List of thumbnail urls, see map_deferred.html
+    """
+    return [url_for("gpx_thumbnail", gpx_id=gpx.id) for gpx in gpxes if gpx.public][:MAX_MAP_THUMBNAILS]
+
+
 # -------------------------------------------------------------------------------------------------------------- #
 # Markers for a set of cafes (native Google Map variant)
 # -------------------------------------------------------------------------------------------------------------- #
@@ -232,107 +247,65 @@ def markers_for_cafes_native(cafes):
 # -------------------------------------------------------------------------------------------------------------- #
 
 def start_and_end_maps_native_gm(filename, gpx_id, return_path):
-    # Use absolute path for filename
-    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(filename))
-
     # Creating two separate maps:
     start_markers = []
     end_markers = []
 
-    # Where we will centre the start map
-    start_lat = 0
-    start_lon = 0
-    num_start_points = 0
-
-    # Where we will centre the end map
-    end_lat = 0
-    end_lon = 0
-    num_end_points = 0
-
-    # open our file
-    with open(filename, 'r') as gpx_file:
-        gpx_track = gpxpy.parse(gpx_file)
-
-        # ----------------------------------------------------------- #
-        #   Markers for 1st 2km
-        # ----------------------------------------------------------- #
-        for track in gpx_track.tracks:
-            for segment in track.segments:
-
-                # Need these for working out inter sample spacing
-                last_lat = segment.points[0].latitude
-                last_lon = segment.points[0].longitude
-                total_km = 0
-                index = 0
-
-                for point in segment.points:
-
-                    # Work out how far we have travelled so far...
-                    total_km += mpu.haversine_distance((last_lat, last_lon), (point.latitude, point.longitude))
+    # Parsed points (with distance along the route) come from the cache
+    track = gpx_track(filename)
+    if not track or len(track) == 0:
+        return [start_markers, {"lat": 0, "lng": 0}, end_markers, {"lat": 0, "lng": 0}]
 
-                    index += 1
+    lats = track.lat.tolist()
+    lons = track.lon.tolist()
+    dist_km = track.dist_km.tolist()
+    num_points = len(track)
 
-                    # We only want the first km or so
-                    if total_km < TRIM_DISTANCE_KM:
-                        start_markers.append({
-                            "position": {"lat": point.latitude, "lng": point.longitude},
-                            "title": f'<a href="{url_for("gpx_cut_start", gpx_id=gpx_id, index=index, return_path=f"{return_path}")}">Start Here! (Point {index})</a>',
-                        })
-
-                        start_lat += point.latitude
-                        start_lon += point.longitude
-                        num_start_points += 1
-
-                    else:
-                        break
-
-                    last_lat = point.latitude
-                    last_lon = point.longitude
-
-        if num_start_points > 0:
-            start_map_coords = {"lat": start_lat / num_start_points, "lng": start_lon / num_start_points}
-        else:
-            start_map_coords = {"lat": 0, "lng": 0}
-
-        # ----------------------------------------------------------- #
-        #   Markers for last 2km
-        # ----------------------------------------------------------- #
-        for track in gpx_track.tracks:
-            for segment in track.segments:
-
-                # Need these for working out inter sample spacing
-                last_lat = segment.points[-1].latitude
-                last_lon = segment.points[-1].longitude
-                total_km = 0
-                index = len(segment.points)
+    # ----------------------------------------------------------- #
+    #   Markers for 1st 2km
+    # ----------------------------------------------------------- #
+    # NB index is 1 based as that's what gpx_cut_start expects
+    for index in range(1, num_points + 1):
 
-                for point in segment.points[::-1]:
+        # We only want the first km or so
+        if dist_km[index - 1] >= TRIM_DISTANCE_KM:
+            break
 
-                    # Work out how far we have travelled so far...
-                    total_km += mpu.haversine_distance((last_lat, last_lon), (point.latitude, point.longitude))
+        start_markers.append({
+            "position": {"lat": lats[index - 1], "lng": lons[index - 1]},
+            "title": f'<a href="{url_for("gpx_cut_start", gpx_id=gpx_id, index=index, return_path=f"{return_path}")}">Start Here! (Point {index})</a>',
+        })
 
-                    # We only want the last km or so
-                    if total_km < TRIM_DISTANCE_KM:
-                        end_markers.append({
-                            "position": {"lat": point.latitude, "lng": point.longitude},
-                            "title": f'<a href="{url_for("gpx_cut_end", gpx_id=gpx_id, index=index, return_path=f"{return_path}")}">Finish Here! (Point {index})</a>',
-                        })
+    # Where we will centre the start map
+    num_start_points = len(start_markers)
+    if num_start_points > 0:
+        start_map_coords = {"lat": sum(lats[0:num_start_points]) / num_start_points,
+                            "lng": sum(lons[0:num_start_points]) / num_start_points}
+    else:
+        start_map_coords = {"lat": 0, "lng": 0}
 
-                        end_lat += point.latitude
-                        end_lon += point.longitude
-                        num_end_points += 1
+    # ----------------------------------------------------------- #
+    #   Markers for last 2km
+    # ----------------------------------------------------------- #
+    # Work backwards from the last point
+    for index in range(num_points, 0, -1):
 
-                    else:
-                        break
+        # We only want the last km or so
+        if dist_km[-1] - dist_km[index - 1] >= TRIM_DISTANCE_KM:
+            break
 
-                    last_lat = point.latitude
-                    last_lon = point.longitude
-                    index -= 1
+        end_markers.append({
+            "position": {"lat": lats[index - 1], "lng": lons[index - 1]},
+            "title": f'<a href="{url_for("gpx_cut_end", gpx_id=gpx_id, index=index, return_path=f"{return_path}")}">Finish Here! (Point {index})</a>',
+        })
 
-            if num_end_points > 0:
-                end_map_coords = {"lat": end_lat / num_end_points, "lng": end_lon / num_end_points}
-            else:
-                end_map_coords = {"lat": 0, "lng": 0}
+    # Where we will centre the end map
+    num_end_points = len(end_markers)
+    if num_end_points > 0:
+        end_map_coords = {"lat": sum(lats[num_points - num_end_points:]) / num_end_points,
+                          "lng": sum(lons[num_points - num_end_points:]) / num_end_points}
+    else:
+        end_map_coords = {"lat": 0, "lng": 0}
 
     return [start_markers, start_map_coords, end_markers, end_map_coords]
 
@@ -342,23 +315,10 @@ def start_and_end_maps_native_gm(filename, gpx_id, return_path):
 # -------------------------------------------------------------------------------------------------------------- #
 def maps_enabled():
     # ----------------------------------------------------------- #
-    #   Read status from file
+    #   Shared by every worker, see subs_site_flags
     # ----------------------------------------------------------- #
-    filename = os.path.join(CONFIG_FOLDER, os.path.basename(MAP_STATUS_FILENAME))
-
-    # Better check file is there
-    if not os.path.exists(filename):
-        # Create it disabled just to be safe
-        app.logger.error(f"maps_enabled(): Missing file '{filename}'. Created new one.")
-        EventRepository.log_event("maps_enabled()", f"Missing file '{filename}'. Created new one.")
-        with open(filename, 'w') as file:
-            file.write("False")
-
-    with open(filename, 'r') as file:
-        text = file.readline().strip()
-        map_status = text == "True"
-
-    return map_status
+    # NB Never been set means disabled, just to be safe
+    return site_flag(FLAG_MAPS_ENABLED, "False") == "True"
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -377,12 +337,9 @@ def google_maps_api_key():
 # -------------------------------------------------------------------------------------------------------------- #
 def set_enable_maps():
     # ----------------------------------------------------------- #
-    #   Write status to file
+    #   Set enabled (for every worker)
     # ----------------------------------------------------------- #
-    filename = os.path.join(CONFIG_FOLDER, os.path.basename(MAP_STATUS_FILENAME))
-
-    with open(filename, 'w') as file:
-        file.write("True")
+    set_site_flag(FLAG_MAPS_ENABLED, "True")
 
     # ----------------------------------------------------------- #
     #   Alert Super Admin
@@ -400,12 +357,9 @@ def set_enable_maps():
 # -------------------------------------------------------------------------------------------------------------- #
 def set_disable_maps():
     # ----------------------------------------------------------- #
-    #   Set disabled
+    #   Set disabled (for every worker)
     # ----------------------------------------------------------- #
-    filename = os.path.join(CONFIG_FOLDER, os.path.basename(MAP_STATUS_FILENAME))
-
-    with open(filename, 'w') as file:
-        file.write("False")
+    set_site_flag(FLAG_MAPS_ENABLED, "False")
 
     # ----------------------------------------------------------- #
     #   Alert Super Admin
@@ -418,21 +372,35 @@ def set_disable_maps():
     send_sms(site_owner, "Maps have been disabled")
 
 
+# -------------------------------------------------------------------------------------------------------------- #
+# Today's map boost
+# -------------------------------------------------------------------------------------------------------------- #
+def maps_boost() -> dict[str, Any]:
+    # ----------------------------------------------------------- #
+    #   Shared by every worker, see subs_site_flags
+    # ----------------------------------------------------------- #
+    # Stored as eg '{"Day": "20231111", "Value": 500}', NB the date not the day of the week, so a boost
+    # expires at midnight without anyone having to reset it
+    try:
+        boost = json.loads(site_flag(FLAG_MAPS_BOOST) or "")
+        return {'Day': str(boost['Day']), 'Value': int(boost['Value'])}
+    except (ValueError, TypeError, KeyError):
+        return {'Day': "", 'Value': 0}
+
+
 # -------------------------------------------------------------------------------------------------------------- #
 # Return map limit for the day
 # -------------------------------------------------------------------------------------------------------------- #
 def map_limit_by_day(day: str) -> int:
 
-    print(f"map_limit_by_day: maps_boost = {maps_boost}")
-
     # This is the baseline number
     limit: int = MAP_LIMITS_BY_DAY[day]
-    print(f"Default limit is '{limit}'")
-    print(maps_boost)
 
-    # Are we boosting?
-    if maps_boost['Day'] == day:
-        limit += maps_boost['Value']
+    # Are we boosting? NB A boost only ever applies to today
+    boost = maps_boost()
+    if boost['Day'] == datetime.today().strftime("%Y%m%d") and \
+            day == datetime.today().strftime("%A"):
+        limit += boost['Value']
 
     return limit
 
@@ -441,19 +409,20 @@ def map_limit_by_day(day: str) -> int:
 # Boost map limit (until midnight)
 # -------------------------------------------------------------------------------------------------------------- #
 def boost_map_limit():
-    global maps_boost
-
-    # Get today as string eg "Monday"
-    today_str = datetime.today().strftime("%A")
+    # Get today as string eg "20231111"
+    today_str = datetime.today().strftime("%Y%m%d")
 
     # Make sure Day is set to today
-    if maps_boost['Day'] == today_str:
+    boost = maps_boost()
+    if boost['Day'] == today_str:
         # Day is the same, so just increment the boost
-        maps_boost['Value'] += MAP_BOOST_NUMBER
+        boost['Value'] += MAP_BOOST_NUMBER
     else:
         # Different day, so reset
-        maps_boost['Day'] = today_str
-        maps_boost['Value'] = MAP_BOOST_NUMBER
+        boost = {'Day': today_str, 'Value': MAP_BOOST_NUMBER}
+
+    # Every worker sees the boost, not just the one which handled the admin's POST
+    set_site_flag(FLAG_MAPS_BOOST, json.dumps(boost))
 
     # ----------------------------------------------------------- #
     #   Alert Super Admin
@@ -469,55 +438,98 @@ def boost_map_limit():
 # -------------------------------------------------------------------------------------------------------------- #
 # Keep a count of map loads
 # -------------------------------------------------------------------------------------------------------------- #
-def count_map_loads(count: int):
+def count_map_loads(count: int) -> None:
+    """
+    Count map loads towards today's limit. These are added up in memory and written to the dB every
+    MAP_COUNT_FLUSH_SECS, rather than on every page view.
+    :param count:                       Number of Google maps on the page
+    :return:                            n/a
+    """
     # ----------------------------------------------------------- #
     #   Need today's date
     # ----------------------------------------------------------- #
     today_str = datetime.today().strftime("%Y%m%d")
+    map_limit = map_limit_by_day(datetime.today().strftime("%A"))
 
     # ----------------------------------------------------------- #
-    #   Read in the whole file
+    #   Add to our pending count
     # ----------------------------------------------------------- #
-    # Use abs path
-    filename = os.path.join(CONFIG_FOLDER, os.path.basename(MAP_COUNT_FILENAME))
+    with pending_map_loads_lock:
+        pending_map_loads[today_str] = pending_map_loads.get(today_str, 0) + count
+        flush = time.time() - last_map_loads_flush >= MAP_COUNT_FLUSH_SECS
+
+        # Don't sit on loads which would take us over the limit
+        if map_count_today['Day'] == today_str and \
+                map_count_today['Value'] + pending_map_loads[today_str] > map_limit:
+            flush = True
+
+        if not flush:
+            schedule_map_loads_flush()
+
+    if flush:
+        flush_map_loads()
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Make sure pending map loads get written, even if no one else loads a map
+# -------------------------------------------------------------------------------------------------------------- #
+def schedule_map_loads_flush() -> None:
+    """
+    Start the flush timer, if it isn't already running. NB Call with pending_map_loads_lock held.
+    :return:                            n/a
+    """
+    global map_loads_flush_timer
+
+    if map_loads_flush_timer is None:
+        map_loads_flush_timer = threading.Timer(MAP_COUNT_FLUSH_SECS, flush_map_loads)
+        # Don't hold up the worker exiting, atexit flushes anything left
+        map_loads_flush_timer.daemon = True
+        map_loads_flush_timer.start()
 
-    # Make sure file exists!
-    if os.path.exists(filename):
-        with open(filename, 'r') as file:
-            lines = file.readlines()
-    else:
-        app.logger.error(f"count_map_loads(): Missing file '{filename}'.")
-        EventRepository.log_event("count_map_loads()", f"Missing file '{filename}'.")
-        lines = []
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Write our pending map loads to the dB
+# -------------------------------------------------------------------------------------------------------------- #
+def flush_map_loads() -> None:
+    global last_map_loads_flush, map_loads_flush_timer
 
     # ----------------------------------------------------------- #
-    #   Modify file to include count
+    #   Take what we have so far
     # ----------------------------------------------------------- #
-    if len(lines) > 0:
-        last_line = lines[-1]
-    else:
-        last_line = ""
-
-    # Does the last line cover today?
-    if last_line.split(',')[0].strip() == today_str:
-        # Increment count
-        total_today = int(last_line.split(',')[1]) + count
-        # Update last line
-        lines[-1] = f"{today_str},{total_today}\n"
-    else:
-        # Must have rolled over to new day
-        total_today = count
-        lines.append(f"{today_str},{total_today}\n")
-        # Reset boost, as it's a new day
-        print("Resetting maps_boost!")
-        maps_boost['Day'] = ""
-        maps_boost['Value'] = 0
+    with pending_map_loads_lock:
+        pending = dict(pending_map_loads)
+        pending_map_loads.clear()
+        last_map_loads_flush = time.time()
+
+        # We're doing it now, so the timer needn't
+        if map_loads_flush_timer is not None:
+            map_loads_flush_timer.cancel()
+            map_loads_flush_timer = None
+
+    if not pending:
+        return
 
     # ----------------------------------------------------------- #
-    #   Write file back out
+    #   Add to the dB
     # ----------------------------------------------------------- #
-    with open(filename, 'w') as file:
-        file.writelines(lines)
+    today_str = datetime.today().strftime("%Y%m%d")
+    total_today = None
+    for day, count in pending.items():
+        # A single UPDATE ... SET count = count + n, so workers can't lose each other's counts
+        total = MapCountRepository.add_loads(day, count)
+        if total is None:
+            # Put them back and try again next time
+            with pending_map_loads_lock:
+                pending_map_loads[day] = pending_map_loads.get(day, 0) + count
+                schedule_map_loads_flush()
+        elif day == today_str:
+            total_today = total
+
+    if total_today is None:
+        return
+
+    map_count_today['Day'] = today_str
+    map_count_today['Value'] = total_today
 
     # ----------------------------------------------------------- #
     #   Compare against our thresholds
@@ -538,50 +550,88 @@ def count_map_loads(count: int):
                              f"as count is {total_today} / {map_limit}!")
 
 
+# Don't lose the last few seconds of counts when gunicorn recycles a worker
+atexit.register(flush_map_loads)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Token for a tap to load map
+# -------------------------------------------------------------------------------------------------------------- #
+def map_load_token() -> str:
+    """
+    Each tap to load map on a page gets its own signed token, which /map_load wants back before it counts the load.
+    Stops anyone running up our Google bill by just POSTing to /map_load.
+    :return:                            Signed token
+    """
+    return map_load_serializer.dumps(secrets.token_hex(8))
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Check a token from /map_load
+# -------------------------------------------------------------------------------------------------------------- #
+def redeem_map_load_token(token: str | None) -> bool:
+    """
+    Is this a token we issued, recently, which hasn't been used yet?
+    NB Used tokens are only remembered by this worker, so at worst a token counts once per worker.
+    :param token:                       Token from the page
+    :return:                            True if we should count the map load
+    """
+    if not token:
+        return False
+
+    # ----------------------------------------------------------- #
+    #   Did we sign it?
+    # ----------------------------------------------------------- #
+    try:
+        nonce, issued = map_load_serializer.loads(token, max_age=MAP_LOAD_TOKEN_MAX_AGE_SECS, return_timestamp=True)
+    except BadSignature:
+        # NB SignatureExpired is a BadSignature too
+        return False
+
+    # ----------------------------------------------------------- #
+    #   Only count it once
+    # ----------------------------------------------------------- #
+    now = time.time()
+    with redeemed_map_load_tokens_lock:
+        # Forget the ones which have expired anyway
+        for old_nonce, old_issued in list(redeemed_map_load_tokens.items()):
+            if now - old_issued > MAP_LOAD_TOKEN_MAX_AGE_SECS:
+                del redeemed_map_load_tokens[old_nonce]
+
+        if nonce in redeemed_map_load_tokens:
+            return False
+
+        redeemed_map_load_tokens[nonce] = issued.timestamp()
+
+    return True
+
+
+# Templates ask for a fresh token for each tap to load map, see deferred_map.html
+app.jinja_env.globals.update(map_load_token=map_load_token)
+
+
 # -------------------------------------------------------------------------------------------------------------- #
 # Get current count
 # -------------------------------------------------------------------------------------------------------------- #
 def get_current_map_count():
-    global maps_boost
-
     # ----------------------------------------------------------- #
     #   Need today's date
     # ----------------------------------------------------------- #
     today_str = datetime.today().strftime("%Y%m%d")
 
     # ----------------------------------------------------------- #
-    #   Read in the whole file
+    #   Write ours out first, so the dB is up to date
     # ----------------------------------------------------------- #
-    # Use abs path
-    filename = os.path.join(CONFIG_FOLDER, os.path.basename(MAP_COUNT_FILENAME))
-
-    # Make sure file exists!
-    if os.path.exists(filename):
-        with open(filename, 'r') as file:
-            lines = file.readlines()
-    else:
-        app.logger.error(f"get_current_map_count(): Missing file '{filename}'.")
-        EventRepository.log_event("get_current_map_count()", f"Missing file '{filename}'.")
-        lines = []
+    flush_map_loads()
 
     # ----------------------------------------------------------- #
-    #   Need last line
+    #   Today's row, plus anything we failed to write
     # ----------------------------------------------------------- #
-    if len(lines) > 0:
-        last_line = lines[-1]
-    else:
-        last_line = ""
+    # NB Other workers may be sitting on a few seconds' worth too
+    with pending_map_loads_lock:
+        pending = pending_map_loads.get(today_str, 0)
 
-    # Does the last line cover today?
-    if last_line.split(',')[0].strip() == today_str:
-        # Use this number
-        total_today = int(last_line.split(',')[1])
-    else:
-        # Must have rolled over to new day
-        total_today = 0
-
-    # Return today's count
-    return total_today
+    return MapCountRepository.one_day(today_str) + pending
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -589,17 +639,10 @@ def get_current_map_count():
 # -------------------------------------------------------------------------------------------------------------- #
 def graph_map_counts():
     # ----------------------------------------------------------- #
-    #   Read in the whole map usage file
+    #   Just the days we want from the dB
     # ----------------------------------------------------------- #
-    # Use abs path
-    filename = os.path.join(CONFIG_FOLDER, os.path.basename(MAP_COUNT_FILENAME))
-
-    # Make sure file exists!
-    if os.path.exists(filename):
-        with open(filename, 'r') as file:
-            lines = file.readlines()
-    else:
-        return None
+    first_day = (datetime.today() - timedelta(days=MAP_COUNT_GRAPH_DAYS)).strftime("%Y%m%d")
+    rows = MapCountRepository.since(first_day)
 
     # ----------------------------------------------------------- #
     #   Need three arrays
@@ -611,26 +654,19 @@ def graph_map_counts():
     # ----------------------------------------------------------- #
     #   Generate our map count data sets
     # ----------------------------------------------------------- #
-    for line in lines:
+    for row in rows:
         try:
-            # Get date and number map reads
-            line = line.rstrip('\n')
-            data = line.split(',')
-
             # Need the day of week
-            date_str = data[0].strip()
+            date_str = row.day
             date_obj = date(int(date_str[0:4]), int(date_str[4:6]), int(date_str[6:8]))
             day_of_week = date_obj.strftime('%A')
 
-            # Need map count
-            count = int(data[1])
-
             # Need limit by day of week
             limit = MAP_LIMITS_BY_DAY[day_of_week]
 
             # Stick in our lists
             dates.append(date_str)
-            counts.append(count)
+            counts.append(row.count)
             limits.append(limit)
         except Exception as e:
             pass
@@ -1,13 +1,8 @@
-import gpxpy
-import gpxpy.gpx
-import mpu
-import os
-
 # -------------------------------------------------------------------------------------------------------------- #
 # Import app from __init__.py
 # -------------------------------------------------------------------------------------------------------------- #
 
-from core import app, GPX_UPLOAD_FOLDER_ABS
+from core import app
 
 # -------------------------------------------------------------------------------------------------------------- #
 # Import our three database classes and associated forms, decorators etc
@@ -19,6 +14,11 @@ from core.database.repositories.cafe_repository import CafeRepository
 from core.database.repositories.event_repository import EventRepository
 from core.database.repositories.calendar_repository import CalendarModel, CalendarRepository
 from core.subs_email import send_ride_notification_emails
+from core.subs_gpx_cache import GpxTrack, gpx_track
+from core.subs_route_store import stored_track
+from core.subs_gpx_fingerprint import update_route_fingerprint
+from core.subs_gpx_matching import cafes_passed_by_track, closest_approach_to_cafes, route_may_pass, \
+                                   update_route_footprint
 
 # -------------------------------------------------------------------------------------------------------------- #
 # Constants used to verify sensible cafe coordinates
@@ -57,8 +57,8 @@ def allowed_file(filename: str) -> bool:
 
 def check_new_cafe_with_all_gpxes(cafe: CafeModel) -> None:
     """
-    Called when we add a new cafe to the database. We need to update all GPXModel.cafes_passed JSON strings
-    to reference this new cafe if they pass nearby.
+    Called when we add a new cafe to the database. We need to link all the routes which pass nearby to
+    this new cafe in the gpx_cafes table.
     :param cafe:                    Cafe ORM for new cafe
     :return:                        n/a
     """
@@ -67,6 +67,9 @@ def check_new_cafe_with_all_gpxes(cafe: CafeModel) -> None:
     # Get all the routes
     gpxes: list[GpxModel] = GpxRepository.all_gpxes()
 
+    # The routes we have already linked to this cafe (it may have been moved rather than added)
+    linked_gpx_ids: set[int] = GpxRepository.gpx_ids_passing_cafe(cafe.id)
+
     # Keep a count of how many routes pass this cafe
     routes_passing: int = 0
 
@@ -75,63 +78,41 @@ def check_new_cafe_with_all_gpxes(cafe: CafeModel) -> None:
     # ----------------------------------------------------------- #
     for gpx in gpxes:
 
-        # Use absolute path for filename
-        filename: str = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
-
-        # Check GPX file actually exists
-        if os.path.exists(filename):
-
-            # Open the file
-            with open(filename, 'r') as file_ref:
-                try:
-                    gpx_file = gpxpy.parse(file_ref)
-                except Exception as e:
-                    print(f"Error parsing GPX file '{filename}': {e}")
-                    gpx_file = None
-
-            if gpx_file:
-                # Max distance
-                min_dist_to_cafe_km: float = 100
-                dist_along_route_km: float = 0
-                saved_dist_along_route_km: float = 1000
-
-                for track in gpx_file.tracks:
-                    for segment in track.segments:
-
-                        last_lat = segment.points[0].latitude
-                        last_lon = segment.points[0].longitude
-
-                        for point in segment.points:
-
-                            # How far along the route we are
-                            dist_along_route_km += mpu.haversine_distance((last_lat, last_lon), (point.latitude, point.longitude))
-
-                            # How far is the cafe from the GPX file
-                            dist_to_cafe_km = mpu.haversine_distance((cafe.lat, cafe.lon), (point.latitude, point.longitude))
-
-                            if dist_to_cafe_km < min_dist_to_cafe_km:
-                                min_dist_to_cafe_km = dist_to_cafe_km
-                                saved_dist_along_route_km = dist_along_route_km
-
-                            last_lat = point.latitude
-                            last_lon = point.longitude
-
-                # ----------------------------------------------------------- #
-                # Close enough?
-                # ----------------------------------------------------------- #
-                if min_dist_to_cafe_km <= MIN_DIST_TO_CAFE_KM:
-                    app.logger.debug(f"-- Closest to cafe {cafe.name} was {round(min_dist_to_cafe_km, 1)} km"
-                                     f" at {round(saved_dist_along_route_km, 1)} km along the route. Total length was {round(dist_along_route_km, 1)} km")
-                    GpxRepository.update_cafe_list(
-                        gpx_id=gpx.id,
-                        cafe_id=cafe.id,
-                        dist_to_cafe_km=round(min_dist_to_cafe_km, 1),
-                        dist_along_route_km=round(saved_dist_along_route_km, 1)
-                    )
-                    routes_passing += 1
-                else:
-                    # Just in case they edited the route and now it doesn't pass this cafe
-                    GpxRepository.remove_cafe_from_cafes_passed(gpx_id=gpx.id, cafe_id=cafe.id)
+        # ----------------------------------------------------------- #
+        # Can we rule it out from its bounding box / cells?
+        # ----------------------------------------------------------- #
+        if not route_may_pass(gpx, cafe.lat, cafe.lon, MIN_DIST_TO_CAFE_KM):
+            # Just in case they moved the cafe and the route used to pass it
+            if gpx.id in linked_gpx_ids:
+                GpxRepository.remove_cafe_from_cafes_passed(gpx_id=gpx.id, cafe_id=cafe.id)
+            continue
+
+        # ----------------------------------------------------------- #
+        # Only now do we need the actual points (from the shared route store, not the XML)
+        # ----------------------------------------------------------- #
+        track: GpxTrack | None = stored_track(gpx.id, gpx.filename)
+
+        if track and len(track) > 0:
+            min_distance_km, min_distance_path_km = closest_approach_to_cafes(track, [cafe.lat], [cafe.lon])
+            min_dist_to_cafe_km: float = float(min_distance_km[0])
+            saved_dist_along_route_km: float = float(min_distance_path_km[0])
+
+            # ----------------------------------------------------------- #
+            # Close enough?
+            # ----------------------------------------------------------- #
+            if min_dist_to_cafe_km <= MIN_DIST_TO_CAFE_KM:
+                app.logger.debug(f"-- Closest to cafe {cafe.name} was {round(min_dist_to_cafe_km, 1)} km"
+                                 f" at {round(saved_dist_along_route_km, 1)} km along the route. Total length was {round(track.length_km, 1)} km")
+                GpxRepository.update_cafe_list(
+                    gpx_id=gpx.id,
+                    cafe_id=cafe.id,
+                    dist_to_cafe_km=round(min_dist_to_cafe_km, 1),
+                    dist_along_route_km=round(saved_dist_along_route_km, 1)
+                )
+                routes_passing += 1
+            elif gpx.id in linked_gpx_ids:
+                # Just in case they edited the route and now it doesn't pass this cafe
+                GpxRepository.remove_cafe_from_cafes_passed(gpx_id=gpx.id, cafe_id=cafe.id)
 
     # ----------------------------------------------------------- #
     # Update cafe
@@ -145,32 +126,27 @@ def check_new_cafe_with_all_gpxes(cafe: CafeModel) -> None:
 # -------------------------------------------------------------------------------------------------------------- #
 def remove_cafe_from_all_gpxes(cafe_id: int) -> None:
     """
-    Used when we delete a cafe from the database. We need to remove reference to that cafe from the
-    GPXModel.cafes_passed JSON string.
+    Used when we delete a cafe from the database. We need to remove all the links between that cafe and
+    the routes which passed it.
     :param cafe_id:                         ID of the cafe we are deleting
     :return:                                n/a
     """
     app.logger.debug(f"remove_cafe_from_all_gpxes(): Called with cafe_id = '{cafe_id}'.")
 
-    # Get all the routes
-    gpxes: list[GpxModel] = GpxRepository.all_gpxes()
-
-    # Loop over each GPX file
-    for gpx in gpxes:
-        # Remove this entry
-        GpxRepository.remove_cafe_from_cafes_passed(gpx_id=gpx.id, cafe_id=cafe_id)
+    # One DELETE on the link table, rather than rewriting every route
+    GpxRepository.remove_cafe_from_all_gpxes(cafe_id)
 
 
 # -------------------------------------------------------------------------------------------------------------- #
 # Update a GPX from existing cafe dB
 # -------------------------------------------------------------------------------------------------------------- #
-def check_new_gpx_with_all_cafes(gpx_id: int, calendar_id: int | None = None) -> None:
+def check_new_gpx_with_all_cafes(gpx_id: int, calendar_id: int | None = None) -> bool:
     """
-    Called when we are adding a new GPX file. We need to update the GPXModel.cafes_passed JSON string
-    to contain details of the cafes near to the route.
+    Called when we are adding a new GPX file. We need to link the route to the cafes near to it in the
+    gpx_cafes table.
     :param gpx_id:                      The ID of the GPX ORM in the gpx table
     :param calendar_id:                 If we are sending email alerts then it is the calendar ID of the ride, else None
-    :return:
+    :return:                            True if it worked, False if the job should be retried
     """
     # ----------------------------------------------------------- #
     # Check params are valid
@@ -181,83 +157,26 @@ def check_new_gpx_with_all_cafes(gpx_id: int, calendar_id: int | None = None) ->
     if not gpx:
         app.logger.debug(f"check_new_gpx_with_all_cafes(): Failed to locate GPX: gpx_id = '{gpx_id}'.")
         EventRepository.log_event("GPX Fail", f"Failed to locate GPX: gpx_id = '{gpx_id}'.")
-        return
+        return False
 
     app.logger.debug(f"check_new_gpx_with_all_cafes(): Updating GPX '{gpx.name}' for closeness to all cafes.")
     EventRepository.log_event("Update GPX", f"Updating GPX '{gpx.name}' for closeness to all cafes.'")
 
     # ----------------------------------------------------------- #
-    # Get all the cafes
-    # ----------------------------------------------------------- #
-    cafes = CafeRepository.all_cafes()
-
-    # Need a list of closeness
-    min_distance_km: list[float] = [100] * len(cafes)
-    min_distance_path_km: list[float] = [0] * len(cafes)
-
-    # ----------------------------------------------------------- #
-    # Loop over the GPX file
+    # Work out how close the route gets to every cafe
     # ----------------------------------------------------------- #
+    # NB gpx_track() returns None if the file is missing
+    track: GpxTrack | None = gpx_track(gpx.filename)
 
-    # Use absolute path for filename
-    filename: str = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
+    if track and len(track) > 0:
 
-    # Check GPX file actually exists
-    if os.path.exists(filename):
+        # Keep the route's bounding box and fingerprint up to date, as it may have just been edited
+        update_route_footprint(gpx.id, track)
+        update_route_fingerprint(gpx.id, track)
 
-        # Open and parse the file
-        with open(filename, 'r') as file_ref:
-
-            gpx_file = gpxpy.parse(file_ref)
-
-            for track in gpx_file.tracks:
-                for segment in track.segments:
-
-                    # Reset everything
-                    last_lat: float = segment.points[0].latitude
-                    last_lon: float = segment.points[0].longitude
-                    dist_along_route_km: float = 0
-
-                    for point in segment.points:
-
-                        # How far along the route we are
-                        dist_along_route_km += mpu.haversine_distance((last_lat, last_lon),
-                                                                      (point.latitude, point.longitude))
-
-                        cafe_index: int = 0
-                        for cafe in cafes:
-
-                            # How far is the cafe from the GPX file
-                            dist_to_cafe_km: float = mpu.haversine_distance((cafe.lat, cafe.lon),
-                                                                            (point.latitude, point.longitude))
-
-                            # Is this the closest point, so far, to this cafe?
-                            if dist_to_cafe_km < min_distance_km[cafe_index]:
-                                # Update our record of the closest point
-                                min_distance_km[cafe_index] = dist_to_cafe_km
-                                min_distance_path_km[cafe_index] = dist_along_route_km
-
-                            # Next rows in our lists
-                            cafe_index += 1
-
-                        # Move along one point
-                        last_lat = point.latitude
-                        last_lon = point.longitude
-
-            # ----------------------------------------------------------- #
-            # Summarise what we found
-            # ----------------------------------------------------------- #
-            cafe_index = 0
-            for cafe in cafes:
-                if min_distance_km[cafe_index] <= MIN_DIST_TO_CAFE_KM:
-                    app.logger.debug(f"-- Route passes within {round(min_distance_km[cafe_index], 1)} km of {cafe.name} "
-                                     f"after {round(min_distance_path_km[cafe_index], 1)} km.")
-                    # Push update to GPX file
-                    GpxRepository.update_cafe_list(gpx.id, cafe.id, min_distance_km[cafe_index],
-                                                   min_distance_path_km[cafe_index])
-
-                # Next rows in our lists
-                cafe_index += 1
+        # Push all the matches to the dB in one transaction
+        if not GpxRepository.set_cafe_list(gpx.id, cafes_passed_by_track(track, MIN_DIST_TO_CAFE_KM)):
+            return False
 
     # ----------------------------------------------------------- #
     # Have we been asked to send a ride email notification?
@@ -271,13 +190,10 @@ def check_new_gpx_with_all_cafes(gpx_id: int, calendar_id: int | None = None) ->
             # Should never happen, but...
             app.logger.debug(f"check_new_gpx_with_all_cafes(): Passed invalid ride ID, calendar_id = '{calendar_id}'")
             EventRepository.log_event("check_new_gpx_with_all_cafes() Fail", f"Passed invalid ride ID, calendar_id = '{calendar_id}'")
-            return
+            return False
         # Send emails
         send_ride_notification_emails(ride)
 
-# print("Analysing all GPX and all cafes for closeness to each other.")
-# with app.app_context():
-#     cafes = CafeRepository.all_cafes()
-#     for cafe in cafes:
-#         print(f"Checking cafe '{cafe.name}'")
-#         check_new_cafe_with_all_gpxes(cafe)
+    return True
+
+# To re-check every route against every cafe, run: python -m core.subs_gpx_reanalyse --dry-run
@@ -0,0 +1,132 @@
+import hashlib
+import os
+import time
+import numpy
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, GPX_UPLOAD_FOLDER_ABS
+from core.subs_file_lock import replace_file
+from core.subs_gpx_cache import GpxTrack
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Route geometry, stored once per distinct set of points eg "blobs/<sha256>.bin"
+BLOB_FOLDER_ABS = os.path.join(GPX_UPLOAD_FOLDER_ABS, "blobs")
+BLOB_SUFFIX = ".bin"
+
+# Each blob is just (lat, lon, elevation) per point as little endian float64, so the hash of the file is the
+# hash of the points
+BLOB_DTYPE = numpy.dtype("<f8")
+BLOB_COLUMNS = 3
+
+# Don't prune anything this new, as it may be about to get its version row
+BLOB_PRUNE_MIN_AGE_SECS = 60 * 60
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+def blob_filename(blob: str) -> str:
+    return os.path.join(BLOB_FOLDER_ABS, f"{blob}{BLOB_SUFFIX}")
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Write
+# -------------------------------------------------------------------------------------------------------------- #
+
+def save_blob(track: GpxTrack) -> str | None:
+    """
+    Store a route's points under the hash of their contents. Blobs are never modified, so if we already have
+    this one (eg someone uploaded the same file twice) there's nothing to write.
+    :param track:                       The points to store
+    :return:                            The hash (which is the blob's name) or None if it failed
+    """
+    data: bytes = numpy.column_stack([track.lat, track.lon, track.elevation]).astype(BLOB_DTYPE).tobytes()
+    blob: str = hashlib.sha256(data).hexdigest()
+
+    filename = blob_filename(blob)
+    if os.path.exists(filename):
+        # Touch it, so prune_blobs() can't remove it before the new version refers to it
+        try:
+            os.utime(filename)
+            return blob
+        except OSError:
+            # Just been pruned, so write it again
+            pass
+
+    try:
+        os.makedirs(BLOB_FOLDER_ABS, exist_ok=True)
+        replace_file(filename, data)
+    except Exception as e:
+        app.logger.debug(f"save_blob(): Failed to write '{filename}', error code was '{e.args}'.")
+        return None
+
+    return blob
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Read
+# -------------------------------------------------------------------------------------------------------------- #
+
+def blob_track(blob: str, start: int, end: int) -> GpxTrack | None:
+    """
+    Points [start:end] of a blob, which is how each version of a route is stored.
+    :param blob:                        Hash from save_blob()
+    :param start:                       First point
+    :param end:                         One past the last point
+    :return:                            GpxTrack or None if the blob is missing / broken
+    """
+    filename = blob_filename(blob)
+    try:
+        with open(filename, 'rb') as file_ref:
+            points = numpy.frombuffer(file_ref.read(), dtype=BLOB_DTYPE).reshape(-1, BLOB_COLUMNS)
+    except Exception as e:
+        app.logger.debug(f"blob_track(): Failed to read '{filename}', error code was '{e.args}'.")
+        return None
+
+    points = points[start:end]
+    return GpxTrack(points[:, 0].copy(), points[:, 1].copy(), points[:, 2].copy())
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Tidy up
+# -------------------------------------------------------------------------------------------------------------- #
+
+def prune_blobs(in_use: set[str]) -> int:
+    """
+    Delete every blob no version refers to any more, eg after a route is deleted.
+    :param in_use:                      From GpxRepository.all_version_blobs()
+    :return:                            Number of blobs deleted
+    """
+    try:
+        filenames = os.listdir(BLOB_FOLDER_ABS)
+    except OSError:
+        return 0
+
+    too_new = time.time() - BLOB_PRUNE_MIN_AGE_SECS
+    count: int = 0
+    for filename in filenames:
+        if not filename.endswith(BLOB_SUFFIX) or \
+                filename[:-len(BLOB_SUFFIX)] in in_use:
+            continue
+        full_filename = os.path.join(BLOB_FOLDER_ABS, filename)
+        try:
+            if os.path.getmtime(full_filename) < too_new:
+                os.remove(full_filename)
+                count += 1
+        except OSError:
+            pass
+
+    return count
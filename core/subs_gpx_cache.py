@@ -0,0 +1,215 @@
+import os
+import threading
+from collections import OrderedDict
+import numpy
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app
+from core.subs_gpx_stream import iter_track_points
+from core.subs_gpx_storage import open_gpx, gpx_stat
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Same radius mpu.haversine_distance() uses, so our numbers match the old scalar code
+EARTH_RADIUS_KM = 6371
+
+# How many parsed routes each gunicorn worker keeps in memory. A stripped route is ~2,000 points, so each
+# entry is only ~64 kB of arrays, but we don't want the whole library sat in every worker.
+GPX_CACHE_MAX_ROUTES = 64
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Variables
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Key is the GPX filename (which is unique per gpx_id eg "gpx_42.gpx"), value is (mtime, size, track)
+_track_cache: OrderedDict[str, tuple[int, int, "GpxTrack"]] = OrderedDict()
+_track_cache_lock = threading.Lock()
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Parsed route
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class GpxTrack:
+    """
+    Compact, read only copy of the points in a GPX file. All the tracks and segments in the file are joined
+    end to end, which is what we have after strip_excess_info_from_gpx() anyway.
+    """
+    __slots__ = ("lat", "lon", "elevation", "dist_km")
+
+    def __init__(self, lat: numpy.ndarray, lon: numpy.ndarray, elevation: numpy.ndarray,
+                 dist_km: numpy.ndarray | None = None):
+        self.lat = lat
+        self.lon = lon
+        self.elevation = elevation
+        # Cumulative distance along the route for each point, first point is 0 km
+        self.dist_km = cumulative_distance_km(lat, lon) if dist_km is None else dist_km
+
+        # Nobody should be editing a cached route
+        for array in (self.lat, self.lon, self.elevation, self.dist_km):
+            array.flags.writeable = False
+
+    def __len__(self) -> int:
+        return len(self.lat)
+
+    @property
+    def length_km(self) -> float:
+        if len(self.dist_km) == 0:
+            return 0
+        return float(self.dist_km[-1])
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Vectorised version of mpu.haversine_distance()
+# -------------------------------------------------------------------------------------------------------------- #
+
+def haversine_km(lat1: numpy.ndarray | float, lon1: numpy.ndarray | float,
+                 lat2: numpy.ndarray | float, lon2: numpy.ndarray | float) -> numpy.ndarray:
+    """
+    Same maths as mpu.haversine_distance(), but works on numpy arrays (with the usual broadcasting rules).
+    :param lat1:                        Latitude(s) of the first point(s) in degrees
+    :param lon1:                        Longitude(s) of the first point(s) in degrees
+    :param lat2:                        Latitude(s) of the second point(s) in degrees
+    :param lon2:                        Longitude(s) of the second point(s) in degrees
+    :return:                            Distance(s) in km
+    """
+    dlat = numpy.radians(lat2 - lat1)
+    dlon = numpy.radians(lon2 - lon1)
+    a = numpy.sin(dlat / 2) ** 2 + \
+        numpy.cos(numpy.radians(lat1)) * numpy.cos(numpy.radians(lat2)) * numpy.sin(dlon / 2) ** 2
+    return EARTH_RADIUS_KM * 2 * numpy.arctan2(numpy.sqrt(a), numpy.sqrt(1 - a))
+
+
+def cumulative_distance_km(lat: numpy.ndarray, lon: numpy.ndarray) -> numpy.ndarray:
+    """
+    Distance along the route for every point, starting at 0 km for the first point.
+    :param lat:                         Array of latitudes
+    :param lon:                         Array of longitudes
+    :return:                            Array of cumulative distances in km
+    """
+    dist_km = numpy.zeros(len(lat))
+    if len(lat) > 1:
+        numpy.cumsum(haversine_km(lat[:-1], lon[:-1], lat[1:], lon[1:]), out=dist_km[1:])
+    return dist_km
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Parse a GPX file into a GpxTrack
+# -------------------------------------------------------------------------------------------------------------- #
+
+def parse_gpx_track(gpx_filename: str) -> GpxTrack:
+    """
+    Parse a GPX file and keep just the lat, lon and elevation of each point. Missing elevations become 0 m.
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            GpxTrack
+    """
+    lats: list[float] = []
+    lons: list[float] = []
+    elevations: list[float] = []
+
+    with open_gpx(gpx_filename) as file_ref:
+        for _, lat, lon, elevation in iter_track_points(file_ref):
+            lats.append(lat)
+            lons.append(lon)
+            elevations.append(elevation or 0)
+
+    return GpxTrack(numpy.array(lats, dtype=float),
+                    numpy.array(lons, dtype=float),
+                    numpy.array(elevations, dtype=float))
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Cached access to a GPX file
+# -------------------------------------------------------------------------------------------------------------- #
+
+def gpx_track(gpx_filename: str) -> GpxTrack | None:
+    """
+    Return the parsed points for a GPX file, only parsing the file if we haven't seen this version of it before.
+    The cache is per worker, so we also key on the file's mtime and size, which means an edit made by another
+    gunicorn worker is picked up the next time we're asked for the route.
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            GpxTrack or None if the file is missing / broken
+    """
+    key: str = os.path.basename(gpx_filename)
+
+    stat = gpx_stat(key)
+    if not stat:
+        return None
+
+    # ----------------------------------------------------------- #
+    # Already have this version?
+    # ----------------------------------------------------------- #
+    with _track_cache_lock:
+        entry = _track_cache.get(key)
+        if entry and \
+                entry[0] == stat.st_mtime_ns and \
+                entry[1] == stat.st_size:
+            _track_cache.move_to_end(key)
+            return entry[2]
+
+    # ----------------------------------------------------------- #
+    # Parse outside the lock, as it's the slow bit
+    # ----------------------------------------------------------- #
+    try:
+        track: GpxTrack = parse_gpx_track(key)
+    except Exception as e:
+        app.logger.debug(f"gpx_track(): Failed to parse '{key}', error code was '{e.args}'.")
+        return None
+
+    with _track_cache_lock:
+        _track_cache[key] = (stat.st_mtime_ns, stat.st_size, track)
+        _track_cache.move_to_end(key)
+        while len(_track_cache) > GPX_CACHE_MAX_ROUTES:
+            _track_cache.popitem(last=False)
+
+    return track
+
+
+def prime_gpx_track(gpx_filename: str, track: GpxTrack) -> None:
+    """
+    Seed the cache with a route we've just written ourselves, so the first page view doesn't parse it again.
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :param track:                       The points we wrote to the file
+    :return:                            n/a
+    """
+    key: str = os.path.basename(gpx_filename)
+
+    stat = gpx_stat(key)
+    if not stat:
+        return
+
+    with _track_cache_lock:
+        _track_cache[key] = (stat.st_mtime_ns, stat.st_size, track)
+        _track_cache.move_to_end(key)
+        while len(_track_cache) > GPX_CACHE_MAX_ROUTES:
+            _track_cache.popitem(last=False)
+
+
+def invalidate_gpx_track(gpx_filename: str) -> None:
+    """
+    Drop any cached copy of a GPX file, called whenever we rewrite the file.
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            n/a
+    """
+    with _track_cache_lock:
+        _track_cache.pop(os.path.basename(gpx_filename), None)
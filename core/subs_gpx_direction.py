@@ -1,8 +1,5 @@
 import math
 import numpy
-import os
-import gpxpy
-import gpxpy.gpx
 import mpu
 
 
@@ -10,8 +7,10 @@ import mpu
 # Import our own classes
 # -------------------------------------------------------------------------------------------------------------- #
 
-from core import app, GPX_UPLOAD_FOLDER_ABS
+from core import app
 from core.database.repositories.event_repository import EventRepository
+from core.subs_gpx_cache import GpxTrack, gpx_track
+from core.subs_gpx_storage import gpx_exists
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -30,11 +29,8 @@ def gpx_direction(gpx_filename, gpx_id):
     # Check we have an actual file
     # ----------------------------------------------------------- #
 
-    # Use absolute path for filename
-    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx_filename))
-
     # Check GPX file actually exists
-    if not os.path.exists(filename):
+    if not gpx_exists(gpx_filename):
         app.logger.debug(f"gpx_direction(): Failed to locate file: gpx_id = '{gpx_id}'.")
         EventRepository.log_event("gpx_direction Fail", f"Failed to locate file: gpx_id = '{gpx_id}'.")
         return "Missing File"
@@ -43,35 +39,42 @@ def gpx_direction(gpx_filename, gpx_id):
     # Work out the direction the route goes in
     # ----------------------------------------------------------- #
 
-    # Open and parse the file
-    with open(filename, 'r') as file_ref:
+    # Parsed points come from the cache
+    track = gpx_track(gpx_filename)
+    if not track or len(track) == 0:
+        app.logger.debug(f"gpx_direction(): Failed to parse file: gpx_id = '{gpx_id}'.")
+        return "Missing File"
 
-        gpx_file = gpxpy.parse(file_ref)
+    return track_direction(track)
 
-        for track in gpx_file.tracks:
-            for segment in track.segments:
 
-                # We'll need these
-                start_lat = segment.points[0].latitude
-                start_lon = segment.points[0].longitude
-                app.logger.debug(f"start_lat = '{start_lat}', start_lon = '{start_lon}'")
+def track_direction(track: GpxTrack) -> str:
+    """
+    Work out if an already parsed route is Clockwise or anti-Clockwise.
+    :param track:                       Parsed route
+    :return:                            "CW", "CCW" or "Not Circular"
+    """
+    num_points = len(track)
 
-                num_points = len(segment.points)
+    # We'll need these
+    start_lat = track.lat[0]
+    start_lon = track.lon[0]
+    app.logger.debug(f"start_lat = '{start_lat}', start_lon = '{start_lon}'")
 
-                # Outward point is 25% along the path
-                out_lat = segment.points[math.floor(num_points*0.25)].latitude
-                out_lon = segment.points[math.floor(num_points*0.25)].longitude
-                app.logger.debug(f"out_lat = '{out_lat}', out_lon = '{out_lon}'")
+    # Outward point is 25% along the path
+    out_lat = track.lat[math.floor(num_points * 0.25)]
+    out_lon = track.lon[math.floor(num_points * 0.25)]
+    app.logger.debug(f"out_lat = '{out_lat}', out_lon = '{out_lon}'")
 
-                # Return point is 75% along the path
-                ret_lat = segment.points[math.floor(num_points * 0.75)].latitude
-                ret_lon = segment.points[math.floor(num_points * 0.75)].longitude
-                app.logger.debug(f"ret_lat = '{ret_lat}', ret_lon = '{ret_lon}'")
+    # Return point is 75% along the path
+    ret_lat = track.lat[math.floor(num_points * 0.75)]
+    ret_lon = track.lon[math.floor(num_points * 0.75)]
+    app.logger.debug(f"ret_lat = '{ret_lat}', ret_lon = '{ret_lon}'")
 
-                # Last point
-                last_lat = segment.points[-1].latitude
-                last_lon = segment.points[-1].longitude
-                app.logger.debug(f"last_lat = '{last_lat}', last_lon = '{last_lon}'")
+    # Last point
+    last_lat = track.lat[-1]
+    last_lon = track.lon[-1]
+    app.logger.debug(f"last_lat = '{last_lat}', last_lon = '{last_lon}'")
 
     # ----------------------------------------------------------- #
     # Derive angle of two vectors
@@ -0,0 +1,166 @@
+import gzip
+import hashlib
+import os
+import gpxpy.gpx
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, GPX_UPLOAD_FOLDER_ABS
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our three database classes and associated forms, decorators etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.repositories.gpx_repository import GpxModel
+from core.database.repositories.event_repository import EventRepository
+from core.subs_file_lock import replace_file
+from core.subs_gpx_cache import GpxTrack, gpx_track
+from core.subs_gpx_storage import gpx_stat, GPX_COMPRESSED_SUFFIX, GPX_COMPRESS_LEVEL
+from core.subs_gpx_edit import new_gpx, add_route_details
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Downloadable copies live in their own folder, so nothing which scans the GPX folder for "*.gpx" sees them
+DOWNLOAD_FOLDER_ABS = os.path.join(GPX_UPLOAD_FOLDER_ABS, "downloads")
+
+# Length of the hex key in each download's filename (and its ETag)
+DOWNLOAD_KEY_LENGTH = 16
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Which version of the download do we want?
+# -------------------------------------------------------------------------------------------------------------- #
+
+def download_key(gpx: GpxModel) -> str | None:
+    """
+    The download changes when the route is renamed or its GPX file is edited (cropped, replaced etc), so key it
+    on the route's id, its name and the version (mtime, size) of its GPX file.
+    :param gpx:                         Route ORM
+    :return:                            Hex key or None if the GPX file is missing
+    """
+    stat = gpx_stat(gpx.filename)
+    if not stat:
+        return None
+
+    version = f"{gpx.id}|{gpx.name}|{stat.st_mtime_ns}|{stat.st_size}"
+    return hashlib.sha1(version.encode("utf-8")).hexdigest()[:DOWNLOAD_KEY_LENGTH]
+
+
+def download_filename(gpx_id: int, key: str) -> str:
+    """
+    Where the downloadable copy of a route lives, eg "downloads/gpx_42.0123456789abcdef.gpx.gz". It's stored
+    gzipped, so we can send it as is to anyone who accepts gzip.
+    :param gpx_id:                      ID of the route
+    :param key:                         From download_key()
+    :return:                            Absolute path
+    """
+    return os.path.join(DOWNLOAD_FOLDER_ABS, f"gpx_{gpx_id}.{key}.gpx{GPX_COMPRESSED_SUFFIX}")
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Build the downloadable copy
+# -------------------------------------------------------------------------------------------------------------- #
+
+def write_download_gpx(gpx: GpxModel, track: GpxTrack, filename: str) -> bool:
+    """
+    Write a Strava friendly copy of the route: our name and link, plus the timestamps Strava insists on.
+    :param gpx:                         Route ORM
+    :param track:                       The route's points
+    :param filename:                    Where to write it
+    :return:                            True if it worked
+    """
+    gpx_file = new_gpx(f"ELSR: {gpx.name}")
+    gpx_file.tracks[0].segments[0].points = [gpxpy.gpx.GPXTrackPoint(lat, lon, elevation)
+                                             for lat, lon, elevation in zip(track.lat.tolist(),
+                                                                            track.lon.tolist(),
+                                                                            track.elevation.tolist())]
+    add_route_details(gpx_file, gpx)
+
+    # Two workers building the same download can't trip over each other, the last one to finish wins and both
+    # copies are identical apart from the random timestamps
+    try:
+        replace_file(filename, gzip.compress(gpx_file.to_xml().encode("utf-8"), compresslevel=GPX_COMPRESS_LEVEL))
+    except Exception as e:
+        app.logger.debug(f"write_download_gpx(): Failed to write '{filename}', error code was '{e.args}'.")
+        EventRepository.log_event("GPX Fail", f"Failed to write download '{filename}', error code was '{e.args}'.")
+        return False
+
+    return True
+
+
+def delete_download_gpx(gpx_id: int, keep_filename: str | None = None) -> None:
+    """
+    Remove the downloadable copies of a route, called when it's deleted and to tidy up old versions.
+    :param gpx_id:                      ID of the route
+    :param keep_filename:               Don't delete this one (the current version)
+    :return:                            n/a
+    """
+    prefix = f"gpx_{gpx_id}."
+    try:
+        filenames = os.listdir(DOWNLOAD_FOLDER_ABS)
+    except OSError:
+        return
+
+    for filename in filenames:
+        full_filename = os.path.join(DOWNLOAD_FOLDER_ABS, filename)
+        # Leave other workers' tmp files alone, they'll be swapped in shortly (NB old downloads weren't gzipped)
+        if not filename.startswith(prefix) or \
+                not filename.endswith((".gpx", f".gpx{GPX_COMPRESSED_SUFFIX}")) or \
+                full_filename == keep_filename:
+            continue
+        try:
+            os.remove(full_filename)
+        except OSError:
+            pass
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# The file to send
+# -------------------------------------------------------------------------------------------------------------- #
+
+def download_gpx(gpx: GpxModel) -> tuple[str, str] | None:
+    """
+    Return the downloadable copy of a route, only building it the first time it's asked for after the route is
+    added, renamed or edited. We never touch the route's own GPX file here, so downloads are read only and
+    any number can run at once.
+    :param gpx:                         Route ORM
+    :return:                            (absolute filename, key to use as the ETag) or None if it failed
+    """
+    key = download_key(gpx)
+    if not key:
+        app.logger.debug(f"download_gpx(): Missing GPX file '{gpx.filename}', gpx_id = '{gpx.id}'.")
+        return None
+
+    filename = download_filename(gpx.id, key)
+    if os.path.exists(filename):
+        return filename, key
+
+    # ----------------------------------------------------------- #
+    # New (or changed) route, so build it
+    # ----------------------------------------------------------- #
+    track = gpx_track(gpx.filename)
+    if not track or len(track) == 0:
+        app.logger.debug(f"download_gpx(): Failed to read '{gpx.filename}', gpx_id = '{gpx.id}'.")
+        return None
+
+    os.makedirs(DOWNLOAD_FOLDER_ABS, exist_ok=True)
+    if not write_download_gpx(gpx, track, filename):
+        return None
+
+    delete_download_gpx(gpx.id, keep_filename=filename)
+    app.logger.debug(f"download_gpx(): Built '{filename}' for gpx_id = '{gpx.id}' ({gpx.name}).")
+    return filename, key
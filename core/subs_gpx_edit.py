@@ -2,9 +2,11 @@ import random
 import gpxpy
 import gpxpy.gpx
 import mpu
+import numpy
 import os
-from time import sleep
+from contextlib import AbstractContextManager
 from datetime import datetime, timedelta
+from typing import IO
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -17,9 +19,22 @@ from core import app, GPX_UPLOAD_FOLDER_ABS
 # Import our three database classes and associated forms, decorators etc
 # -------------------------------------------------------------------------------------------------------------- #
 
-from core.database.repositories.gpx_repository import GpxRepository, GPX_ALLOWED_EXTENSIONS
-from core.database.repositories.cafe_repository import CafeRepository
+from core.database.repositories.gpx_repository import GpxModel, GpxRepository
+from core.database.models.gpx_version_model import GpxVersionModel, VERSION_UPLOAD, VERSION_CUT_START, \
+                                                   VERSION_CUT_END
 from core.database.repositories.event_repository import EventRepository
+from core.subs_gpx import MIN_DIST_TO_CAFE_KM
+from core.subs_file_lock import file_lock
+from core.subs_gpx_storage import write_gpx, gpx_exists
+from core.subs_gpx_cache import GpxTrack, gpx_track, invalidate_gpx_track, prime_gpx_track
+from core.subs_gpx_blobs import save_blob, blob_track
+from core.subs_gpx_direction import track_direction
+from core.subs_gpx_stream import iter_track_points
+from core.subs_gpx_matching import cafes_passed_by_track, route_footprint
+from core.subs_gpx_polyline import write_route_polyline
+from core.subs_route_store import refresh_stored_route
+from core.subs_gpx_fingerprint import update_route_fingerprint, find_duplicate_routes
+from core.subs_jobs import queue_gpx_analysis
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -29,166 +44,275 @@ from core.database.repositories.event_repository import EventRepository
 # Remove any points closer together than this
 GPX_MAX_RESOLUTION_KM = 0.05
 
+# Cropping can't take a route below this many points
+MIN_ROUTE_POINTS = 2
+
 
 # -------------------------------------------------------------------------------------------------------------- #
 # Update existing file
 # -------------------------------------------------------------------------------------------------------------- #
 
-def update_existing_gpx(gpx_file, gpx_filename):
+def update_existing_gpx(gpx_file: gpxpy.gpx.GPX, gpx_filename: str, track: GpxTrack | None = None) -> bool:
+    """
+    Overwrite an existing GPX file in one atomic step.
+    NB The caller must hold gpx_file_lock() across reading the file and calling this, otherwise two workers
+    editing the same route (eg one user reloading the page rapidly) would each write their own edit of the
+    original file and one of the edits would be lost.
+    :param gpx_file:                    gpxpy object to write
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :param track:                       The points in gpx_file if we have them, saves parsing the file again
+    :return:                            True if it worked
+    """
     # This is the full path to the existing GPX file we are going to over write
-    old_filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx_filename))
-
-    # This is a temp file we will use to write out the new GPX file to first
-    tmp_filename = f"{old_filename}.tmp"
-
-    # ----------------------------------------------------------- #
-    # Step 1: Wait for tmp file to clear
-    # ----------------------------------------------------------- #
-    # As Gunicorn has multiple workers, it is possible (and has happened) that two workers call this function
-    # overlapping in time and they corrupt each other's files. What actually seems to happen is one user reloads the
-    # page rapidly, and we end up in a 'right mess'.
-
-    # Wait for the tmp file to get removed by the 'other' version of this function
-    for _ in range(0, 20):
-        if os.path.exists(tmp_filename):
-            app.logger.debug(f"update_existing_gpx(): Detected '{tmp_filename}', so sleeping for 1 second.")
-            sleep(1)
-        else:
-            break
-
-    # If it's still there after 20 seconds, just blow it away
-    if os.path.exists(tmp_filename):
-        app.logger.debug(f"update_existing_gpx(): '{tmp_filename}' still there after 20 secs, so deleting.")
-        try:
-            os.remove(tmp_filename)
-            # We need this as remove seems to keep the file locked for a short period
-            sleep(0.5)
-        except Exception as e:
-            app.logger.debug(f"update_existing_gpx(): Failed to delete existing file '{tmp_filename}', "
-                             f"error code was '{e.args}'.")
-            EventRepository.log_event("GPX Fail",
-                              f"Failed to delete existing file '{tmp_filename}', error code was '{e.args}'.")
-            return False
-
-    # ----------------------------------------------------------- #
-    # Step 2: Write out our new file to "gpx_XXX.gpx.tmp"
-    # ----------------------------------------------------------- #
-    try:
-        with open(tmp_filename, 'w') as file_ref2:
-            file_ref2.write(gpx_file.to_xml())
-    except Exception as e:
-        EventRepository.log_event("GPX Fail", f"Failed to write file '{tmp_filename}', error code was '{e.args}'.")
-        app.logger.debug(f"update_existing_file: Failed to write file '{tmp_filename}', error code was '{e.args}'.")
-        return False
+    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx_filename))
 
     # ----------------------------------------------------------- #
-    # Step 3: Delete the original file "gpx_XXX.gpx"
+    # Step 1: Write out our new file and swap it in
     # ----------------------------------------------------------- #
     try:
-        os.remove(old_filename)
-        # We need this as remove seems to keep the file locked for a short period
-        sleep(0.5)
+        write_gpx(filename, gpx_file.to_xml())
     except Exception as e:
-        EventRepository.log_event("GPX Fail", f"Failed to delete existing file '{old_filename}', error code was '{e.args}'.")
-        app.logger.debug(f"update_existing_file: Failed to delete existing file '{old_filename}', "
-                         f"error code was '{e.args}'.")
+        EventRepository.log_event("GPX Fail", f"Failed to replace file '{filename}', error code was '{e.args}'.")
+        app.logger.debug(f"update_existing_gpx(): Failed to replace file '{filename}', error code was '{e.args}'.")
         return False
 
     # ----------------------------------------------------------- #
-    # Step 4: Rename "gpx_XXX.gpx.tmp" --> "gpx_XXX.gpx"
+    # Step 2: Drop our cached copy of the old route and rebuild its polyline
     # ----------------------------------------------------------- #
-    try:
-        os.rename(tmp_filename, old_filename)
-    except Exception as e:
-        EventRepository.log_event("GPX Fail", f"Failed to rename existing file '{tmp_filename}', error code was '{e.args}'.")
-        app.logger.debug(f"update_existing_file: Failed to rename existing file '{tmp_filename}', "
-                         f"error code was '{e.args}'.")
-        return False
+    if track:
+        prime_gpx_track(filename, track)
+    else:
+        invalidate_gpx_track(filename)
+    write_route_polyline(filename, track)
+    refresh_stored_route(filename, track)
 
     # All worked if we get here!
     return True
 
 
+def gpx_file_lock(gpx_filename: str) -> AbstractContextManager[None]:
+    """
+    Lock a route's GPX file against edits from any other gunicorn worker.
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            Context manager
+    """
+    return file_lock(os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx_filename)))
+
+
 # -------------------------------------------------------------------------------------------------------------- #
-# Cut the end of the start of the GPX
+# Route versions
 # -------------------------------------------------------------------------------------------------------------- #
 
-def cut_start_gpx(gpx_filename, start_count):
-    EventRepository.log_event("GPX cut Start", f"Called with gpx_filename='{gpx_filename}', start_count='{start_count}'.")
-    app.logger.debug(f"cut_start_gpx: Called with gpx_filename='{gpx_filename}', start_count='{start_count}'.")
+def add_gpx_version(gpx_id: int, track: GpxTrack, action: str = VERSION_UPLOAD) -> GpxVersionModel | None:
+    """
+    Start a route's history with a new set of points, eg when it's uploaded.
+    :param gpx_id:                      ID of the route
+    :param track:                       All of its points
+    :param action:                      What made this version
+    :return:                            The new (now current) version or None if it failed
+    """
+    blob = save_blob(track)
+    if not blob:
+        return None
+    return GpxRepository.add_version(gpx_id, blob, 0, len(track), None, action)
+
+
+def current_gpx_version(gpx: GpxModel) -> GpxVersionModel | None:
+    """
+    The version the route's GPX file is a copy of. Routes from before we had versions get one made from their
+    GPX file the first time we need it.
+    :param gpx:                         Route ORM
+    :return:                            Version or None if it failed
+    """
+    version = GpxRepository.one_version(gpx.id, gpx.version_id) if gpx.version_id else None
+    if version:
+        return version
+
+    track = gpx_track(gpx.filename)
+    if not track or len(track) == 0:
+        app.logger.debug(f"current_gpx_version(): Failed to read '{gpx.filename}', gpx_id = '{gpx.id}'.")
+        return None
+    return add_gpx_version(gpx.id, track)
+
+
+def write_gpx_version(gpx: GpxModel, version: GpxVersionModel) -> bool:
+    """
+    Rewrite the route's GPX file from one of its versions.
+    NB The caller must hold gpx_file_lock().
+    :param gpx:                         Route ORM
+    :param version:                     Version to write out (only blob, start and end are used, so it needn't
+                                        be in the dB yet)
+    :return:                            True if the new file has been swapped in
+    """
+    track = blob_track(version.blob, version.start, version.end)
+    if not track or len(track) == 0:
+        app.logger.debug(f"write_gpx_version(): Failed to read blob '{version.blob}', gpx_id = '{gpx.id}'.")
+        EventRepository.log_event("GPX Fail", f"Failed to read blob '{version.blob}', gpx_id = '{gpx.id}'.")
+        return False
 
-    # ----------------------------------------------------------- #
-    # Open the file and trim it
-    # ----------------------------------------------------------- #
+    gpx_file = new_gpx(f"ELSR: {gpx.name}")
+    gpx_file.tracks[0].segments[0].points = [gpxpy.gpx.GPXTrackPoint(lat, lon, elevation)
+                                             for lat, lon, elevation in zip(track.lat.tolist(),
+                                                                            track.lon.tolist(),
+                                                                            track.elevation.tolist())]
+    add_route_details(gpx_file, gpx)
+    return update_existing_gpx(gpx_file, gpx.filename, track)
+
+
+def edit_gpx_version(gpx_id: int, action: str, start_count: int | None = None,
+                     end_count: int | None = None) -> tuple[int, int] | None:
+    """
+    Crop a route. The new version is just a different slice of the same blob, so the points themselves are
+    never copied or changed and the old version is still there to go back to.
+    :param gpx_id:                      ID of the route
+    :param action:                      VERSION_CUT_START or VERSION_CUT_END
+    :param start_count:                 Drop the points before this one
+    :param end_count:                   Keep this many points
+    :return:                            (points before, points after) or None if it failed
+    """
+    # Re-read the route under the lock, as another worker may have just edited it
+    gpx = GpxRepository.one_by_id(gpx_id)
+    if not gpx:
+        return None
+
+    version = current_gpx_version(gpx)
+    if not version:
+        return None
+
+    # Always leave at least a couple of points
+    start = version.start
+    end = version.end
+    if start_count is not None:
+        start = max(min(start + max(start_count - 1, 0), end - MIN_ROUTE_POINTS), start)
+    if end_count is not None:
+        end = min(max(start + end_count, start + MIN_ROUTE_POINTS), end)
+
+    # Write the file first and only then commit the new version, so the dB never points at a version the file
+    # doesn't hold (which would send the next undo back to the wrong parent)
+    if not write_gpx_version(gpx, GpxVersionModel(blob=version.blob, start=start, end=end)):
+        return None
+
+    if not GpxRepository.add_version(gpx.id, version.blob, start, end, version.id, action):
+        # Put the file back to match the dB
+        write_gpx_version(gpx, version)
+        return None
+
+    return version.end - version.start, end - start
+
+
+def undo_gpx_edit(gpx_id: int) -> bool:
+    """
+    Put a route back to the version before its last edit.
+    :param gpx_id:                      ID of the route
+    :return:                            True if it worked
+    """
+    gpx = GpxRepository.one_by_id(gpx_id)
+    if not gpx:
+        return False
 
-    # Use absolute path for filename
-    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx_filename))
+    with gpx_file_lock(gpx.filename):
+        # Re-read the route under the lock, as another worker may have just edited it
+        gpx = GpxRepository.one_by_id(gpx_id)
+        if not gpx or \
+                not gpx_exists(gpx.filename):
+            app.logger.debug(f"undo_gpx_edit(): Route deleted under us, gpx_id = '{gpx_id}'.")
+            return False
 
-    with open(filename, 'r') as file_ref:
-        gpx_file = gpxpy.parse(file_ref)
+        version = GpxRepository.one_version(gpx.id, gpx.version_id)
+        if not version or \
+                not version.parent_id:
+            app.logger.debug(f"undo_gpx_edit(): Nothing to undo for gpx_id = '{gpx_id}'.")
+            return False
 
-        # Read in all points after start_count
-        for track in gpx_file.tracks:
+        # As for edits, write the file before committing the version it now holds
+        parent = GpxRepository.one_version(gpx.id, version.parent_id)
+        if not parent or \
+                not write_gpx_version(gpx, parent):
+            app.logger.debug(f"undo_gpx_edit(): Failed to undo version_id = '{version.id}', gpx_id = '{gpx_id}'.")
+            EventRepository.log_event("GPX Fail", f"Failed to undo version_id = '{version.id}', gpx_id = '{gpx_id}'.")
+            return False
 
-            count_before = len(track.segments[0].points)
+        if not GpxRepository.set_version(gpx.id, parent.id):
+            # Put the file back to match the dB
+            write_gpx_version(gpx, version)
+            app.logger.debug(f"undo_gpx_edit(): Failed to set version_id = '{parent.id}', gpx_id = '{gpx_id}'.")
+            EventRepository.log_event("GPX Fail", f"Failed to set version_id = '{parent.id}', gpx_id = '{gpx_id}'.")
+            return False
 
-            for segment in track.segments:
-                # ----------------------------------------------------------- #
-                # Strip start_count points from the beginning
-                # ----------------------------------------------------------- #
-                for _ in range(max(start_count - 1, 0)):
-                    segment.points.pop(0)
+    EventRepository.log_event("GPX Undo", f"Back to version_id = '{parent.id}', gpx_id = '{gpx_id}'.")
+    app.logger.debug(f"undo_gpx_edit(): Back to version_id = '{parent.id}', gpx_id = '{gpx_id}'.")
+    return True
 
-            count_after = len(track.segments[0].points)
 
-    # ----------------------------------------------------------- #
-    # Overwrite the existing file with the new file
-    # ----------------------------------------------------------- #
-    update_existing_gpx(gpx_file, gpx_filename)
-    EventRepository.log_event("GPX cut Start", f"Length was {count_before}, now {count_after}. gpx_filename = '{gpx_filename}'")
-    app.logger.debug(f"cut_start_gpx: Length was {count_before}, now {count_after}. gpx_filename = '{gpx_filename}'")
+def locked_gpx_edit(gpx: GpxModel, action: str, start_count: int | None = None,
+                    end_count: int | None = None) -> tuple[int, int] | None:
+    """
+    Crop a route, holding its lock from reading the route until we've replaced the file, so concurrent edits
+    queue up. The route may have been deleted while we were waiting for the lock, in which case there's nothing
+    to crop (and we mustn't write the file back).
+    :param gpx:                         Route ORM
+    :param action:                      VERSION_CUT_START or VERSION_CUT_END
+    :param start_count:                 Drop the points before this one
+    :param end_count:                   Keep this many points
+    :return:                            (points before, points after) or None if it failed
+    """
+    with gpx_file_lock(gpx.filename):
+        try:
+            if not gpx_exists(gpx.filename):
+                raise FileNotFoundError(gpx.filename)
+            return edit_gpx_version(gpx.id, action, start_count=start_count, end_count=end_count)
+
+        except FileNotFoundError as e:
+            app.logger.debug(f"locked_gpx_edit(): Route deleted under us, gpx_id = '{gpx.id}', "
+                             f"error code was '{e.args}'.")
+            EventRepository.log_event("GPX Fail", f"Route deleted before it could be cropped, gpx_id = '{gpx.id}'.")
+            return None
+
+
+def can_undo_gpx_edit(gpx: GpxModel) -> bool:
+    version = GpxRepository.one_version(gpx.id, gpx.version_id) if gpx.version_id else None
+    return bool(version and version.parent_id)
 
 
 # -------------------------------------------------------------------------------------------------------------- #
-# Crop the end of the GPX file
+# Cut the end of the start of the GPX
 # -------------------------------------------------------------------------------------------------------------- #
-def cut_end_gpx(gpx_filename, end_count):
-    EventRepository.log_event("GPX cut End", f"Called with gpx_filename='{gpx_filename}', end_count='{end_count}'.")
-    app.logger.debug(f"cut_end_gpx: Called with gpx_filename='{gpx_filename}', end_count='{end_count}'.")
 
-    # ----------------------------------------------------------- #
-    # Open the file and trim it
-    # ----------------------------------------------------------- #
-    # Use absolute path for filename
-    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx_filename))
+def cut_start_gpx(gpx: GpxModel, start_count: int) -> bool:
+    EventRepository.log_event("GPX cut Start", f"Called with gpx_id='{gpx.id}', start_count='{start_count}'.")
+    app.logger.debug(f"cut_start_gpx: Called with gpx_id='{gpx.id}', start_count='{start_count}'.")
 
-    with open(filename, 'r') as file_ref:
-        gpx_file = gpxpy.parse(file_ref)
+    counts = locked_gpx_edit(gpx, VERSION_CUT_START, start_count=start_count)
 
-        # Read in all points after start_count
-        for track in gpx_file.tracks:
+    if not counts:
+        EventRepository.log_event("GPX cut Start Fail", f"Failed to crop gpx_id = '{gpx.id}'.")
+        app.logger.debug(f"cut_start_gpx: Failed to crop gpx_id = '{gpx.id}'.")
+        return False
 
-            count_before = len(track.segments[0].points)
+    count_before, count_after = counts
+    EventRepository.log_event("GPX cut Start", f"Length was {count_before}, now {count_after}. gpx_id = '{gpx.id}'")
+    app.logger.debug(f"cut_start_gpx: Length was {count_before}, now {count_after}. gpx_id = '{gpx.id}'")
+    return True
 
-            for segment in track.segments:
 
-                # ----------------------------------------------------------- #
-                # Strip start_count points from the beginning
-                # ----------------------------------------------------------- #
-                num_points = len(segment.points)
-                num_to_crop = num_points - end_count
+# -------------------------------------------------------------------------------------------------------------- #
+# Crop the end of the GPX file
+# -------------------------------------------------------------------------------------------------------------- #
+def cut_end_gpx(gpx: GpxModel, end_count: int) -> bool:
+    EventRepository.log_event("GPX cut End", f"Called with gpx_id='{gpx.id}', end_count='{end_count}'.")
+    app.logger.debug(f"cut_end_gpx: Called with gpx_id='{gpx.id}', end_count='{end_count}'.")
 
-                for _ in range(num_to_crop):
-                    segment.points.pop(-1)
+    counts = locked_gpx_edit(gpx, VERSION_CUT_END, end_count=end_count)
 
-                count_after = len(track.segments[0].points)
+    if not counts:
+        EventRepository.log_event("GPX cut End Fail", f"Failed to crop gpx_id = '{gpx.id}'.")
+        app.logger.debug(f"cut_end_gpx: Failed to crop gpx_id = '{gpx.id}'.")
+        return False
 
-    # ----------------------------------------------------------- #
-    # Overwrite the existing file with the new file in 4 steps
-    # ----------------------------------------------------------- #
-    update_existing_gpx(gpx_file, gpx_filename)
-    EventRepository.log_event("GPX cut End", f"Length was {count_before}, now {count_after}. gpx_filename = '{gpx_filename}'.")
-    app.logger.debug(f"cut_end_gpx: Length was {count_before}, now {count_after}. gpx_filename = '{gpx_filename}'.")
+    count_before, count_after = counts
+    EventRepository.log_event("GPX cut End", f"Length was {count_before}, now {count_after}. gpx_id = '{gpx.id}'.")
+    app.logger.debug(f"cut_end_gpx: Length was {count_before}, now {count_after}. gpx_id = '{gpx.id}'.")
+    return True
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -211,148 +335,193 @@ def new_gpx(route_name):
 
 
 # -------------------------------------------------------------------------------------------------------------- #
-# Make sure the GPX file has an up to date name
+# Add our name, link and timestamps to a GPX file
 # -------------------------------------------------------------------------------------------------------------- #
 
-def check_route_name(gpx):
-    # ----------------------------------------------------------- #
-    # Use absolute path
-    # ----------------------------------------------------------- #
-    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
-
-    # ----------------------------------------------------------- #
-    # Params we will add
-    # ----------------------------------------------------------- #
+def add_route_details(gpx_file: gpxpy.gpx.GPX, gpx: GpxModel) -> None:
     # This is the name which will appear in the Garmin etc
     route_name = f"ELSR: {gpx.name}"
     route_link = f"https://www.elsr.co.uk/route/{gpx.id}"
 
-    # ----------------------------------------------------------- #
-    # Open the file
-    # ----------------------------------------------------------- #
-    with open(filename, 'r') as file_ref:
-        gpx_file = gpxpy.parse(file_ref)
-        gpx_track = gpx_file.tracks[0]
-
-        # Looks like we need to add the time stamps back in otherwise Strava won't import it
-        # But Strava is fussy about timestamps, so not too fast, not too slow and it appears
-        # they need to have a random element.
-        for track in gpx_file.tracks:
-            for segment in track.segments:
-                last_time = datetime.now()
-                for point in segment.points:
-                    point.time = last_time + timedelta(minutes=3, seconds=random.randint(0, 120))
+    # Looks like we need to add the time stamps back in otherwise Strava won't import it
+    # But Strava is fussy about timestamps, so not too fast, not too slow and it appears
+    # they need to have a random element.
+    for track in gpx_file.tracks:
+        for segment in track.segments:
+            last_time = datetime.now()
+            for point in segment.points:
+                point.time = last_time + timedelta(minutes=3, seconds=random.randint(0, 120))
 
     # Update our params
+    gpx_track = gpx_file.tracks[0]
     gpx_file.author_name = "ELSR website"
     gpx_file.author_link = route_link
     gpx_file.name = route_name
     gpx_track.name = route_name
-    gpx_track.link = route_link
-    gpx_track.type = "cycling"
-
-    # Refresh the file
-    update_existing_gpx(gpx_file, filename)
-    app.logger.debug(f"check_route_name(): Updated name for GPX '{filename}' to '{route_name}'.")
+    gpx_track.link = route_link  # type: ignore
+    gpx_track.type = "cycling"  # type: ignore
 
 
 # -------------------------------------------------------------------------------------------------------------- #
-# Clean up the GPX file and update length / elevation stats in the db
+# Read an uploaded GPX file once and add the cleaned up route to the dB
 # -------------------------------------------------------------------------------------------------------------- #
 
-def strip_excess_info_from_gpx(gpx_filename, gpx_id, route_name):
+def ingest_gpx_upload(upload: IO[bytes], gpx: GpxModel) -> GpxModel | None:
+    """
+    Everything we need from a newly uploaded GPX file, from a single streamed pass over the upload: length, ascent,
+    direction, bounding box, the culled points and the cafes it passes. The dB row (and its cafe links) are
+    written in one transaction and the cleaned up file is written once, we never keep the raw upload.
+    :param upload:                      File like object, eg request.files['filename']
+    :param gpx:                         New route ORM with name, email, type etc filled in
+    :return:                            The route now in the dB, or None if it failed. gpx.duplicates is set to
+                                        a list of existing routes which look like the same ride.
+    """
     # ----------------------------------------------------------- #
     # Header
     # ----------------------------------------------------------- #
-    app.logger.debug(f"strip_excess_info_from_gpx(): Called with gpx_filename='{gpx_filename}', gpx_id='{gpx_id}'.")
-
-    # ----------------------------------------------------------- #
-    # Use absolute path
-    # ----------------------------------------------------------- #
-    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx_filename))
+    app.logger.debug(f"ingest_gpx_upload(): Called with '{gpx.name}'.")
 
     # ----------------------------------------------------------- #
-    # Generate stats for updating the dB route summary
+    # Step 1: Stream the points, working out route stats (from the full resolution points) and culling as we go
     # ----------------------------------------------------------- #
-    total_length_km = 0
-    total_ascent_m = 0
-    num_points_before = 0
-    num_points_after = 0
+    # NB Device files can be 15 MB of mostly HR / power extensions, so we never build the whole file in memory
+    total_length_km: float = 0
+    total_ascent_m: float = 0
+    num_points_before: int = 0
 
-    # ----------------------------------------------------------- #
-    # Create a new GPX object
-    # ----------------------------------------------------------- #
-    # For some reason we can't delete the extension data from a GPX file (HR, cadence, power). So, the bodge is
-    # just to create a new file and migrate across only the data we want (lat, lon, height).
-    new_gpx_file = new_gpx(route_name)
+    lats: list[float] = []
+    lons: list[float] = []
+    elevations: list[float | None] = []
 
-    # ----------------------------------------------------------- #
-    # Open the file
-    # ----------------------------------------------------------- #
-    with open(filename, 'r') as file_ref:
-        gpx_file = gpxpy.parse(file_ref)
-
-        # Read in all points after start_count
-        for track in gpx_file.tracks:
-
-            for segment in track.segments:
+    last_segment: int = -1
+    last_lat: float = 0
+    last_lon: float = 0
+    last_elevation: float | None = None
+    saved_lat: float = 0
+    saved_lon: float = 0
 
-                # Set these to zero, so we always include the first point, otherwise it skips the first
-                # few points till we have moved along the route past GPX_MAX_RESOLUTION_KM
-                last_lat = segment.points[0].latitude
-                last_lon = segment.points[0].longitude
-                last_elevation = segment.points[0].elevation
-
-                # From our new GPX file
+    try:
+        for segment, lat, lon, elevation in iter_track_points(upload):
+            # Devices drop the odd <ele>, carry the last one forward, rather than treating it as a drop to 0 m
+            # and a climb back up. NB Still None until we've seen one.
+            if elevation is None:
+                elevation = last_elevation
+
+            # Start of a new segment, so we don't join the end of the last one to this one and always
+            # include the first point (as it's a long way from (0, 0))
+            if segment != last_segment:
+                last_segment = segment
+                last_lat = lat
+                last_lon = lon
+                last_elevation = elevation
                 saved_lat = 0
                 saved_lon = 0
 
-                for point in segment.points:
+            # ----------------------------------------------------------- #
+            # Route stats come from original file (higher resolution)
+            # ----------------------------------------------------------- #
+            total_length_km += mpu.haversine_distance((last_lat, last_lon), (lat, lon))
+            num_points_before += 1
+
+            # Total ascent
+            if elevation is not None and last_elevation is not None and elevation > last_elevation:
+                total_ascent_m += elevation - last_elevation
+
+            # Update last point
+            last_lat = lat
+            last_lon = lon
+            last_elevation = elevation
+
+            # ----------------------------------------------------------- #
+            # How far is this point from the previous saved one?
+            # ----------------------------------------------------------- #
+            if mpu.haversine_distance((saved_lat, saved_lon), (lat, lon)) >= GPX_MAX_RESOLUTION_KM:
+                lats.append(lat)
+                lons.append(lon)
+                elevations.append(elevation)
+                saved_lat = lat
+                saved_lon = lon
 
-                    # ----------------------------------------------------------- #
-                    # Route stats come from original file (higher resolution)
-                    # ----------------------------------------------------------- #
-                    inter_dist_km = mpu.haversine_distance((last_lat, last_lon), (point.latitude, point.longitude))
-                    total_length_km += inter_dist_km
-                    num_points_before += 1
-
-                    # Total ascent
-                    if point.elevation > last_elevation:
-                        total_ascent_m += point.elevation - last_elevation
+    except Exception as e:
+        app.logger.debug(f"ingest_gpx_upload(): Failed to parse upload, error code was '{e.args}'.")
+        EventRepository.log_event("GPX Fail", f"Failed to parse upload, error code was '{e.args}'.")
+        return None
 
-                    # Update last point
-                    last_lat = point.latitude
-                    last_lon = point.longitude
-                    last_elevation = point.elevation
+    if not lats:
+        app.logger.debug(f"ingest_gpx_upload(): No points in upload for '{gpx.name}'.")
+        EventRepository.log_event("GPX Fail", f"No points in upload for '{gpx.name}'.")
+        return None
 
-                    # ----------------------------------------------------------- #
-                    # How far is this point from the previous saved one?
-                    # ----------------------------------------------------------- #
-                    inter_dist_km = mpu.haversine_distance((saved_lat, saved_lon), (point.latitude, point.longitude))
+    # Any points before the first <ele> get the first one we saw (or 0 m if there weren't any)
+    first_elevation = next((elevation for elevation in elevations if elevation is not None), 0)
+    elevations = [first_elevation if elevation is None else elevation for elevation in elevations]
 
-                    if inter_dist_km >= GPX_MAX_RESOLUTION_KM:
-                        # Create a new point, using just the data we want
-                        new_point = gpxpy.gpx.GPXTrackPoint(point.latitude,
-                                                            point.longitude,
-                                                            point.elevation)
+    culled_track = GpxTrack(numpy.array(lats), numpy.array(lons), numpy.array(elevations))
 
-                        # Add to out new GPX file
-                        new_gpx_file.tracks[0].segments[0].points.append(new_point)
-                        num_points_after += 1
+    # ----------------------------------------------------------- #
+    # Step 2: Everything else we store about the route
+    # ----------------------------------------------------------- #
+    gpx.length_km = round(total_length_km, 1)
+    gpx.ascent_m = round(total_ascent_m, 1)
+    gpx.direction = track_direction(culled_track)
+    gpx.cafes_passed = "[]"
+    for key, value in route_footprint(culled_track).items():
+        setattr(gpx, key, value)
 
-                        # Update last point
-                        saved_lat = point.latitude
-                        saved_lon = point.longitude
+    cafes_passed = cafes_passed_by_track(culled_track, MIN_DIST_TO_CAFE_KM)
 
     # ----------------------------------------------------------- #
-    # Update stats in the dB
+    # Step 3: One dB transaction for the route and its cafes
     # ----------------------------------------------------------- #
-    GpxRepository.update_stats(gpx_id, total_length_km, total_ascent_m)
+    added_gpx = GpxRepository.add_gpx_with_cafes(gpx, cafes_passed)
+    if not added_gpx:
+        return None
+    gpx = added_gpx
 
     # ----------------------------------------------------------- #
-    # Overwrite the existing file
+    # Step 4: Write out the cleaned file
     # ----------------------------------------------------------- #
-    update_existing_gpx(new_gpx_file, gpx_filename)
-    EventRepository.log_event("Clean GPX", f"Culled from {num_points_before} to {num_points_after} points.")
-    app.logger.debug(f"strip_excess_info_from_gpx(): Culled from {num_points_before} to {num_points_after} points.")
+    # For some reason we can't delete the extension data from a GPX file (HR, cadence, power). So, the bodge is
+    # just to create a new file and migrate across only the data we want (lat, lon, height).
+    new_gpx_file = new_gpx(f"ELSR: {gpx.name}")
+    new_gpx_file.tracks[0].segments[0].points = [gpxpy.gpx.GPXTrackPoint(lat, lon, elevation)
+                                                 for lat, lon, elevation in zip(lats, lons, elevations)]
+    add_route_details(new_gpx_file, gpx)
 
+    filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
+    try:
+        write_gpx(filename, new_gpx_file.to_xml())
+    except Exception as e:
+        app.logger.debug(f"ingest_gpx_upload(): Failed to write '{filename}', error code was '{e.args}'.")
+        EventRepository.log_event("GPX Fail", f"Failed to write '{filename}', error code was '{e.args}'.")
+        GpxRepository.delete_gpx(gpx.id)
+        return None
+
+    # Start the route's history, so the author can crop it and undo that later
+    version = add_gpx_version(gpx.id, culled_track)
+    if version:
+        gpx.version_id = version.id
+
+    # We already have the points, so save the first page view parsing them again
+    prime_gpx_track(filename, culled_track)
+
+    # ----------------------------------------------------------- #
+    # Step 5: Everything we keep alongside the route, then see if we already have it
+    # ----------------------------------------------------------- #
+    # NB These are keyed on gpx.id, so can only be written after the dB commit. The polyline and the route store
+    # are rebuilt from the GPX file whenever they're read and turn out to be missing, but the fingerprint isn't,
+    # so if that fails we ask a worker to redo it (check_new_gpx_with_all_cafes() refreshes it from the file).
+    write_route_polyline(filename, culled_track)
+    refresh_stored_route(filename, culled_track)
+    if not update_route_fingerprint(gpx.id, culled_track):
+        app.logger.debug(f"ingest_gpx_upload(): Failed to fingerprint gpx_id = '{gpx.id}', queueing a rebuild.")
+        EventRepository.log_event("GPX Fail", f"Failed to fingerprint gpx_id = '{gpx.id}', queueing a rebuild.")
+        queue_gpx_analysis(gpx.id)
+
+    # NB The caller can offer the uploader one of these instead of keeping a new copy
+    gpx.duplicates = find_duplicate_routes(gpx, culled_track)
+
+    EventRepository.log_event("Clean GPX", f"Culled from {num_points_before} to {len(lats)} points.")
+    app.logger.debug(f"ingest_gpx_upload(): Culled from {num_points_before} to {len(lats)} points, "
+                     f"found {len(cafes_passed)} cafes, gpx_id = '{gpx.id}'.")
+    return gpx
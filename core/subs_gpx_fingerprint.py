@@ -0,0 +1,205 @@
+import hashlib
+import math
+import numpy
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.repositories.gpx_repository import GpxModel, GpxRepository
+from core.subs_gpx_cache import GpxTrack, EARTH_RADIUS_KM
+from core.subs_gpx_matching import grid_steps
+from core.subs_route_store import stored_track
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# The fingerprint is the sequence of grid cells the route passes through, cut into overlapping runs of
+# SHINGLE_CELLS cells. Two rides of the same loop share nearly all their shingles, the same roads ridden the
+# other way round share almost none.
+FINGERPRINT_CELL_KM = 0.5
+SHINGLE_CELLS = 4
+
+# Candidates must be within this fraction of the new route's length
+DUPLICATE_LENGTH_TOLERANCE = 0.1
+
+# Candidates must share this fraction of their shingles (Jaccard index)
+DUPLICATE_MIN_SIMILARITY = 0.6
+
+# Confirmed duplicates stay within this distance of each other all the way round (discrete Frechet distance)
+DUPLICATE_MAX_FRECHET_KM = 0.3
+
+# We compare routes re-sampled to one point every this many km
+FRECHET_STEP_KM = 0.1
+
+# km per degree of latitude (and of longitude at the equator)
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Fingerprint
+# -------------------------------------------------------------------------------------------------------------- #
+
+def route_shingles(track: GpxTrack) -> list[int]:
+    """
+    Fingerprint a route as a set of hashed runs of grid cells.
+    :param track:                       Parsed route
+    :return:                            Sorted list of unique signed 64 bit shingles
+    """
+    if len(track) == 0:
+        return []
+
+    # ----------------------------------------------------------- #
+    # Sequence of cells, without repeats
+    # ----------------------------------------------------------- #
+    lat_step, lon_step = grid_steps(FINGERPRINT_CELL_KM)
+    rows = numpy.floor(track.lat / lat_step).astype(numpy.int64)
+    cols = numpy.floor(track.lon / lon_step).astype(numpy.int64)
+    changed = numpy.ones(len(rows), dtype=bool)
+    changed[1:] = (rows[1:] != rows[:-1]) | (cols[1:] != cols[:-1])
+    cells = numpy.stack([rows[changed], cols[changed]], axis=1)
+
+    # A very short route might not cross enough cells, so it gets one shingle of whatever it has
+    width = min(SHINGLE_CELLS, len(cells))
+
+    # ----------------------------------------------------------- #
+    # Hash each run of cells, the hash has to be the same in every process (so not hash())
+    # ----------------------------------------------------------- #
+    shingles: set[int] = set()
+    for start in range(len(cells) - width + 1):
+        digest = hashlib.blake2b(cells[start:start + width].tobytes(), digest_size=8).digest()
+        shingles.add(int.from_bytes(digest, 'big', signed=True))
+
+    return sorted(shingles)
+
+
+def update_route_fingerprint(gpx_id: int, track: GpxTrack) -> bool:
+    """
+    Store a route's shingles in the dB. Called whenever a route is uploaded or edited.
+    :param gpx_id:                      ID of the route
+    :param track:                       Parsed route
+    :return:                            True if it worked
+    """
+    return GpxRepository.set_shingles(gpx_id, route_shingles(track))
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Discrete Frechet distance
+# -------------------------------------------------------------------------------------------------------------- #
+
+def resample_track(track: GpxTrack, step_km: float = FRECHET_STEP_KM) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Simplify a route to evenly spaced points, so GPS jitter and differing point densities don't matter.
+    :param track:                       Parsed route
+    :param step_km:                     Spacing of the new points
+    :return:                            (lats, lons)
+    """
+    if len(track) < 2 or track.length_km == 0:
+        return track.lat, track.lon
+    dists = numpy.append(numpy.arange(0, track.length_km, step_km), track.length_km)
+    return numpy.interp(dists, track.dist_km, track.lat), numpy.interp(dists, track.dist_km, track.lon)
+
+
+def frechet_within(lat_a: numpy.ndarray, lon_a: numpy.ndarray, lat_b: numpy.ndarray, lon_b: numpy.ndarray,
+                   max_km: float) -> bool:
+    """
+    Decide whether the discrete Frechet distance between two routes is at most max_km, ie whether two riders
+    could go round them, both only ever moving forwards, without ever being more than max_km apart.
+    We fill in the reachable cells of the free space one row at a time, each row being a numpy operation.
+    :param lat_a:                       First route latitudes
+    :param lon_a:                       First route longitudes
+    :param lat_b:                       Second route latitudes
+    :param lon_b:                       Second route longitudes
+    :param max_km:                      Threshold
+    :return:                            True if they're within max_km of each other all the way round
+    """
+    if len(lat_a) == 0 or len(lat_b) == 0:
+        return False
+
+    # Flat projection, fine over the size of a bike ride
+    x_scale = KM_PER_DEGREE * math.cos(math.radians(float(lat_a[0])))
+    xa, ya = lon_a * x_scale, lat_a * KM_PER_DEGREE
+    xb, yb = lon_b * x_scale, lat_b * KM_PER_DEGREE
+
+    columns = numpy.arange(len(xb))
+    reachable: numpy.ndarray = numpy.zeros(len(xb), dtype=bool)
+    for i in range(len(xa)):
+        ok = numpy.hypot(xb - xa[i], yb - ya[i]) <= max_km
+
+        # Cells we can step into from the row below, either straight up or diagonally
+        if i == 0:
+            seeds = numpy.zeros(len(xb), dtype=bool)
+            seeds[0] = ok[0]
+        else:
+            from_below = reachable.copy()
+            from_below[1:] |= reachable[:-1]
+            seeds = ok & from_below
+
+        # Then we can walk right from a seed until we hit a cell which is too far away
+        last_seed = numpy.maximum.accumulate(numpy.where(seeds, columns, -1))
+        run_start = numpy.maximum.accumulate(numpy.where(ok, 0, columns + 1))
+        reachable = ok & (last_seed >= run_start)
+
+        if not reachable.any():
+            return False
+
+    return bool(reachable[-1])
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Find duplicates of a route
+# -------------------------------------------------------------------------------------------------------------- #
+
+def find_duplicate_routes(gpx: GpxModel, track: GpxTrack) -> list[GpxModel]:
+    """
+    Look for existing routes which are really the same as this one. The shingle index narrows it down to a
+    handful of candidates without touching any other routes, then we check each of those properly.
+    :param gpx:                         The route, already in the dB (it won't match itself)
+    :param track:                       Its points
+    :return:                            Existing routes the uploader can see, most similar first
+    """
+    shingles = route_shingles(track)
+    if not shingles:
+        return []
+
+    candidates = GpxRepository.similar_gpx_ids(shingles, gpx.length_km, DUPLICATE_LENGTH_TOLERANCE,
+                                               DUPLICATE_MIN_SIMILARITY, skip_gpx_id=gpx.id)
+
+    lat_a, lon_a = resample_track(track)
+    duplicates: list[GpxModel] = []
+    for gpx_id, similarity in candidates:
+        other: GpxModel | None = GpxRepository.one_by_id(gpx_id)
+        # Only offer routes the uploader is allowed to see
+        if not other or \
+                not (other.public or other.email == gpx.email):
+            continue
+
+        other_track = stored_track(other.id, other.filename)
+        if not other_track or len(other_track) == 0:
+            continue
+
+        lat_b, lon_b = resample_track(other_track)
+        if frechet_within(lat_a, lon_a, lat_b, lon_b, DUPLICATE_MAX_FRECHET_KM):
+            app.logger.debug(f"find_duplicate_routes(): gpx_id = '{gpx.id}' looks like gpx_id = '{other.id}', "
+                             f"similarity = {round(similarity, 2)}.")
+            duplicates.append(other)
+
+    return duplicates
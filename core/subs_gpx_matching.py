@@ -0,0 +1,343 @@
+import json
+import math
+import threading
+from typing import Any
+import numpy
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.repositories.cafe_repository import CafeRepository
+from core.database.repositories.gpx_repository import GpxModel, GpxRepository
+from core.subs_gpx_cache import GpxTrack, haversine_km, EARTH_RADIUS_KM
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# How many route points we compare against all the cafes in one go. 512 points x 300 cafes is ~1.2 MB of
+# float64 per chunk, which keeps the working set small even for a huge route.
+MATCH_CHUNK_POINTS = 512
+
+# Starting value for the closest approach, same as the old scalar loop used
+NO_MATCH_KM = 100
+
+# Size of a cell in the cafe grid index, ideally the same as MIN_DIST_TO_CAFE_KM
+CAFE_GRID_CELL_KM = 1.0
+
+# km per degree of latitude (and of longitude at the equator)
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+
+# A degree of longitude shrinks as we go north, so we size the grid for the most northerly latitude we'd
+# ever see. Cambridge is at 52 deg, so this makes the cells a bit wider than they need to be, which is safe.
+GRID_MAX_LAT_DEG = 60
+
+# Size of the coarse cells we store against each route, a 100 km loop touches ~100 of these
+ROUTE_CELL_KM = 2.0
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Variables
+# -------------------------------------------------------------------------------------------------------------- #
+
+# The cafe index for this worker and the dB signature it was built from
+_cafe_index: "CafeGridIndex | None" = None
+_cafe_index_signature: tuple[Any, ...] | None = None
+_cafe_index_lock = threading.Lock()
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Spatial index of cafes
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class CafeGridIndex:
+    """
+    Uniform lat / lon grid of cafe locations. Each cell is at least CAFE_GRID_CELL_KM across in both directions,
+    so every cafe within that range of a point is in the point's cell or one of its eight neighbours.
+    """
+
+    def __init__(self, cafes: list[Any], cell_km: float = CAFE_GRID_CELL_KM) -> None:
+        # Keep plain copies of what the matcher needs, rather than holding on to ORM objects
+        self.ids: list[int] = [cafe.id for cafe in cafes]
+        self.names: list[str] = [cafe.name for cafe in cafes]
+        self.lats: numpy.ndarray = numpy.array([cafe.lat for cafe in cafes], dtype=float)
+        self.lons: numpy.ndarray = numpy.array([cafe.lon for cafe in cafes], dtype=float)
+
+        # Cell size in degrees
+        self.cell_km: float = cell_km
+        self.lat_step, self.lon_step = grid_steps(cell_km)
+
+        # Cell -> list of positions in the arrays above
+        self.cells: dict[tuple[int, int], list[int]] = {}
+        for position, cell in enumerate(zip(self._rows(self.lats).tolist(), self._cols(self.lons).tolist())):
+            self.cells.setdefault(cell, []).append(position)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def _rows(self, lats: numpy.ndarray) -> numpy.ndarray:
+        return numpy.floor(lats / self.lat_step).astype(int)
+
+    def _cols(self, lons: numpy.ndarray) -> numpy.ndarray:
+        return numpy.floor(lons / self.lon_step).astype(int)
+
+    def cafes_near_track(self, track: GpxTrack, radius_km: float) -> numpy.ndarray:
+        """
+        Find the cafes which could be within radius_km of the route. This is a superset, so the caller still needs
+        to work out the actual distances, but only for a handful of cafes rather than all of them.
+        :param track:                   Parsed route from gpx_track()
+        :param radius_km:               How close the cafe has to be to the route
+        :return:                        Sorted array of positions into self.ids / self.lats / self.lons
+        """
+        if len(track) == 0 or len(self) == 0:
+            return numpy.zeros(0, dtype=int)
+
+        # How many rings of neighbouring cells we need to cover radius_km
+        ring: int = max(1, math.ceil(radius_km / self.cell_km))
+
+        # Only look up each cell the route passes through once
+        route_cells = numpy.unique(numpy.stack([self._rows(track.lat), self._cols(track.lon)], axis=1), axis=0)
+
+        candidates: set[int] = set()
+        for row, col in route_cells.tolist():
+            for d_row in range(-ring, ring + 1):
+                for d_col in range(-ring, ring + 1):
+                    candidates.update(self.cells.get((row + d_row, col + d_col), ()))
+
+        return numpy.array(sorted(candidates), dtype=int)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Grid cell size in degrees
+# -------------------------------------------------------------------------------------------------------------- #
+
+def grid_steps(cell_km: float) -> tuple[float, float]:
+    """
+    Convert a cell size in km into a step in latitude and longitude, such that the cell is at least cell_km across
+    in both directions anywhere south of GRID_MAX_LAT_DEG.
+    :param cell_km:                     Minimum size of the cell in km
+    :return:                            (lat_step, lon_step) in degrees
+    """
+    return cell_km / KM_PER_DEGREE, \
+        cell_km / (KM_PER_DEGREE * math.cos(math.radians(GRID_MAX_LAT_DEG)))
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Bounding box and coarse cells for a route
+# -------------------------------------------------------------------------------------------------------------- #
+
+def route_footprint(track: GpxTrack) -> dict[str, Any]:
+    """
+    Summarise where a route goes, so we can rule out most routes for a cafe without opening their GPX files.
+    :param track:                       Parsed route from gpx_track()
+    :return:                            Dictionary of min_lat, max_lat, min_lon, max_lon and cells, where cells is
+                                        a JSON string of the ROUTE_CELL_KM grid cells the route passes through
+                                        eg '["2342:45", "2342:46"]'.
+    """
+    lat_step, lon_step = grid_steps(ROUTE_CELL_KM)
+    rows = numpy.floor(track.lat / lat_step).astype(int)
+    cols = numpy.floor(track.lon / lon_step).astype(int)
+    cells = numpy.unique(numpy.stack([rows, cols], axis=1), axis=0)
+
+    return {
+        'min_lat': float(track.lat.min()),
+        'max_lat': float(track.lat.max()),
+        'min_lon': float(track.lon.min()),
+        'max_lon': float(track.lon.max()),
+        'cells': json.dumps([f"{row}:{col}" for row, col in cells.tolist()]),
+    }
+
+
+def update_route_footprint(gpx_id: int, track: GpxTrack) -> bool:
+    """
+    Store the bounding box and coarse cells for a route in the dB. Called whenever a route is uploaded or edited.
+    :param gpx_id:                      ID of the route
+    :param track:                       Parsed route from gpx_track()
+    :return:                            True if it worked
+    """
+    if len(track) == 0:
+        return False
+    return GpxRepository.update_footprint(gpx_id, **route_footprint(track))
+
+
+def route_may_pass(gpx: GpxModel, lat: float, lon: float, radius_km: float) -> bool:
+    """
+    Quick check, using only the dB, whether a route could possibly pass within radius_km of a point. If this
+    returns False, the route definitely doesn't. If it returns True, the caller still has to check the points.
+    :param gpx:                         Route from the dB
+    :param lat:                         Latitude of the point (eg a cafe)
+    :param lon:                         Longitude of the point (eg a cafe)
+    :param radius_km:                   How close the route has to get to the point
+    :return:                            False if the route can't pass within radius_km
+    """
+    # Old routes might not have a footprint yet, so we have to check them the slow way
+    if gpx.min_lat is None:
+        return True
+
+    # ----------------------------------------------------------- #
+    # Bounding box, expanded by radius_km
+    # ----------------------------------------------------------- #
+    lat_margin, lon_margin = grid_steps(radius_km)
+    if not gpx.min_lat - lat_margin <= lat <= gpx.max_lat + lat_margin or \
+            not gpx.min_lon - lon_margin <= lon <= gpx.max_lon + lon_margin:
+        return False
+
+    # ----------------------------------------------------------- #
+    # Coarse cells around the point
+    # ----------------------------------------------------------- #
+    if not gpx.cells:
+        return True
+
+    lat_step, lon_step = grid_steps(ROUTE_CELL_KM)
+    row = math.floor(lat / lat_step)
+    col = math.floor(lon / lon_step)
+    ring: int = max(1, math.ceil(radius_km / ROUTE_CELL_KM))
+    route_cells: set[str] = set(json.loads(gpx.cells))
+
+    for d_row in range(-ring, ring + 1):
+        for d_col in range(-ring, ring + 1):
+            if f"{row + d_row}:{col + d_col}" in route_cells:
+                return True
+
+    return False
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Current cafe index
+# -------------------------------------------------------------------------------------------------------------- #
+
+def rebuild_cafe_index() -> CafeGridIndex:
+    """
+    Rebuild this worker's cafe index from the dB. Called whenever a cafe is added, moved or deleted.
+    :return:                            The new index
+    """
+    global _cafe_index, _cafe_index_signature
+
+    with _cafe_index_lock:
+        # Take the signature first, so if a cafe changes while we're loading we'll just rebuild again next time
+        _cafe_index_signature = CafeRepository.location_signature()
+        _cafe_index = CafeGridIndex(CafeRepository.all_cafes())
+        app.logger.debug(f"rebuild_cafe_index(): Indexed {len(_cafe_index)} cafes "
+                         f"into {len(_cafe_index.cells)} cells.")
+        return _cafe_index
+
+
+def cafe_index() -> CafeGridIndex:
+    """
+    Return this worker's cafe index, rebuilding it if the cafes have changed. The cafe edit may well have been
+    handled by a different gunicorn worker, so we compare against a cheap summary of the cafe table rather than
+    relying on rebuild_cafe_index() having been called in this process.
+    :return:                            Up to date index
+    """
+    with _cafe_index_lock:
+        index = _cafe_index
+        signature = _cafe_index_signature
+
+    if index is None or \
+            signature != CafeRepository.location_signature():
+        index = rebuild_cafe_index()
+
+    return index
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Closest approach of a route to a set of cafes
+# -------------------------------------------------------------------------------------------------------------- #
+
+def closest_approach_to_cafes(track: GpxTrack, cafe_lats: numpy.ndarray | list[float],
+                              cafe_lons: numpy.ndarray | list[float],
+                              chunk_points: int = MATCH_CHUNK_POINTS) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Work out how close a route gets to each cafe, and how far along the route that happens. We build the
+    points x cafes distance matrix a chunk of points at a time, so memory use doesn't grow with the route.
+    Ties go to the earliest point on the route, which is what the old scalar loop did
+    (see scripts/benchmark_cafe_matching.py).
+    :param track:                       Parsed route from gpx_track()
+    :param cafe_lats:                   Sequence of cafe latitudes
+    :param cafe_lons:                   Sequence of cafe longitudes (same order as cafe_lats)
+    :param chunk_points:                Number of route points per chunk
+    :return:                            (min_dist_km, dist_along_route_km) arrays, one entry per cafe
+    """
+    lats: numpy.ndarray = numpy.asarray(cafe_lats, dtype=float)
+    lons: numpy.ndarray = numpy.asarray(cafe_lons, dtype=float)
+
+    min_dist_km: numpy.ndarray = numpy.full(len(lats), NO_MATCH_KM, dtype=float)
+    dist_along_route_km: numpy.ndarray = numpy.zeros(len(lats), dtype=float)
+
+    if len(lats) == 0:
+        return min_dist_km, dist_along_route_km
+
+    cafe_columns = numpy.arange(len(lats))
+
+    for start in range(0, len(track), chunk_points):
+        end = start + chunk_points
+
+        # Rows are route points, columns are cafes
+        dist_km = haversine_km(lats[numpy.newaxis, :], lons[numpy.newaxis, :],
+                               track.lat[start:end, numpy.newaxis], track.lon[start:end, numpy.newaxis])
+
+        # Closest point in this chunk for each cafe
+        closest_row = dist_km.argmin(axis=0)
+        closest_km = dist_km[closest_row, cafe_columns]
+
+        # Only take it if it beats earlier chunks (strictly, so the first point wins a tie)
+        better = closest_km < min_dist_km
+        min_dist_km[better] = closest_km[better]
+        dist_along_route_km[better] = track.dist_km[start + closest_row[better]]
+
+    return min_dist_km, dist_along_route_km
+
+
+def cafes_passed_by_track(track: GpxTrack, max_dist_km: float,
+                          cafes: CafeGridIndex | None = None) -> list[tuple[int, float, float]]:
+    """
+    Find every cafe a route passes within max_dist_km of, using the grid index to skip cafes nowhere near it.
+    :param track:                       Parsed route
+    :param max_dist_km:                 How close the route has to get to a cafe
+    :param cafes:                       Cafe index to use, defaults to this worker's (which needs the dB)
+    :return:                            List of (cafe_id, dist_to_cafe_km, dist_along_route_km)
+    """
+    if len(track) == 0:
+        return []
+
+    # Only bother with cafes in grid cells the route actually passes near
+    if cafes is None:
+        cafes = cafe_index()
+    candidates = cafes.cafes_near_track(track, max_dist_km)
+
+    # One batched pass over points x nearby cafes
+    min_distance_km, min_distance_path_km = closest_approach_to_cafes(track,
+                                                                      cafes.lats[candidates],
+                                                                      cafes.lons[candidates])
+
+    cafes_passed: list[tuple[int, float, float]] = []
+    for index, position in enumerate(candidates.tolist()):
+        if min_distance_km[index] <= max_dist_km:
+            app.logger.debug(f"-- Route passes within {round(min_distance_km[index], 1)} km of "
+                             f"{cafes.names[position]} after {round(min_distance_path_km[index], 1)} km.")
+            cafes_passed.append((cafes.ids[position], float(min_distance_km[index]),
+                                 float(min_distance_path_km[index])))
+
+    return cafes_passed
@@ -0,0 +1,234 @@
+import json
+import math
+import os
+from typing import Any
+import numpy
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, GPX_UPLOAD_FOLDER_ABS
+from core.subs_gpx_cache import GpxTrack, gpx_track, EARTH_RADIUS_KM
+from core.subs_file_lock import replace_file
+from core.subs_gpx_storage import gpx_stat
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Google's encoded polyline format uses 5 decimal places (~1 m)
+POLYLINE_PRECISION = 5
+
+# Stored next to the GPX file eg "gpx_42.gpx" -> "gpx_42.polyline.json"
+POLYLINE_SUFFIX = ".polyline.json"
+
+# Simplified versions of each route we store, as the max error (in metres) allowed by Douglas-Peucker
+LOD_TOLERANCES_M = (10, 25, 50, 100)
+
+# Google's metres per pixel at zoom 0 on the equator, halves for each zoom level
+METRES_PER_PIXEL_ZOOM_0 = 156543.03
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Google encoded polyline
+# -------------------------------------------------------------------------------------------------------------- #
+
+def encode_polyline(lat: numpy.ndarray, lon: numpy.ndarray, precision: int = POLYLINE_PRECISION) -> str:
+    """
+    Encode a route using Google's encoded polyline algorithm, which the browser turns back into points with
+    google.maps.geometry.encoding.decodePath(). It's about a tenth of the size of the equivalent
+    [{lat: 52.1, lng: 0.1}, ...] list.
+    See https://developers.google.com/maps/documentation/utilities/polylinealgorithm
+    :param lat:                         Array of latitudes
+    :param lon:                         Array of longitudes
+    :param precision:                   Number of decimal places to keep
+    :return:                            Encoded string
+    """
+    if len(lat) == 0:
+        return ""
+
+    # Interleave lat, lon and store each as the change from the previous point
+    scaled = numpy.round(numpy.column_stack([lat, lon]) * 10 ** precision).astype(numpy.int64)
+    deltas = numpy.diff(scaled, axis=0, prepend=numpy.zeros((1, 2), dtype=numpy.int64)).ravel()
+
+    # Left shift, invert if negative
+    values = numpy.where(deltas < 0, ~(deltas << 1), deltas << 1)
+
+    chars: list[str] = []
+    for value in values.tolist():
+        # Break into 5 bit chunks, lowest first, with 0x20 set on all but the last
+        while value >= 0x20:
+            chars.append(chr((0x20 | (value & 0x1f)) + 63))
+            value >>= 5
+        chars.append(chr(value + 63))
+
+    return "".join(chars)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Douglas-Peucker simplification
+# -------------------------------------------------------------------------------------------------------------- #
+
+def simplify_track(lat: numpy.ndarray, lon: numpy.ndarray, tolerance_m: float) -> numpy.ndarray:
+    """
+    Douglas-Peucker: keep the fewest points such that no dropped point is more than tolerance_m from the
+    simplified route. We work on a flat projection around the route, which is plenty accurate over the size of
+    a bike ride. Uses distance to the segment (not the infinite line), so loops that end where they start
+    work properly.
+    :param lat:                         Array of latitudes
+    :param lon:                         Array of longitudes
+    :param tolerance_m:                 Max error in metres
+    :return:                            Sorted array of the indices of the points to keep
+    """
+    num_points = len(lat)
+    if num_points <= 2:
+        return numpy.arange(num_points)
+
+    # Flat projection in metres
+    metres_per_degree = EARTH_RADIUS_KM * 1000 * math.pi / 180
+    y = lat * metres_per_degree
+    x = lon * metres_per_degree * math.cos(math.radians(float(lat.mean())))
+
+    keep = numpy.zeros(num_points, dtype=bool)
+    keep[0] = keep[-1] = True
+
+    # Iterative rather than recursive, as routes can be thousands of points long
+    stack: list[tuple[int, int]] = [(0, num_points - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+
+        # Distance of every point in between to the segment first -> last
+        seg_x = x[last] - x[first]
+        seg_y = y[last] - y[first]
+        seg_len2 = seg_x * seg_x + seg_y * seg_y
+        px = x[first + 1:last] - x[first]
+        py = y[first + 1:last] - y[first]
+        if seg_len2 > 0:
+            t = numpy.clip((px * seg_x + py * seg_y) / seg_len2, 0, 1)
+        else:
+            t = numpy.zeros(len(px))
+        dist = numpy.hypot(px - t * seg_x, py - t * seg_y)
+
+        worst = int(dist.argmax())
+        if dist[worst] > tolerance_m:
+            split = first + 1 + worst
+            keep[split] = True
+            stack.append((first, split))
+            stack.append((split, last))
+
+    return numpy.flatnonzero(keep)
+
+
+def tolerance_for_zoom(zoom: int, lat: float) -> int | None:
+    """
+    Pick the coarsest stored level whose error is under half a pixel at this zoom level.
+    :param zoom:                        Google maps zoom level
+    :param lat:                         Latitude the map is centred on
+    :return:                            Tolerance in metres (a key of LOD_TOLERANCES_M) or None for full detail
+    """
+    metres_per_pixel = METRES_PER_PIXEL_ZOOM_0 * math.cos(math.radians(lat)) / 2 ** zoom
+    levels = [tolerance_m for tolerance_m in LOD_TOLERANCES_M if tolerance_m <= metres_per_pixel / 2]
+    return max(levels) if levels else None
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Polyline stored alongside each GPX file
+# -------------------------------------------------------------------------------------------------------------- #
+
+def polyline_filename(gpx_filename: str) -> str:
+    """
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            Absolute path to the route's polyline file
+    """
+    base = os.path.splitext(os.path.basename(gpx_filename))[0]
+    return os.path.join(GPX_UPLOAD_FOLDER_ABS, f"{base}{POLYLINE_SUFFIX}")
+
+
+def write_route_polyline(gpx_filename: str, track: GpxTrack | None = None) -> dict[str, Any] | None:
+    """
+    Encode a route, plus a simplified version for each of LOD_TOLERANCES_M, and save them next to the GPX
+    file. Called whenever a route is uploaded or edited.
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :param track:                       The route's points, if we already have them
+    :return:                            Dictionary of polyline, midlat, midlon and levels or None if it failed,
+                                        where levels maps str(tolerance_m) to an encoded polyline
+    """
+    if track is None:
+        track = gpx_track(gpx_filename)
+    if not track or len(track) == 0:
+        return None
+
+    levels: dict[str, str] = {}
+    for tolerance_m in LOD_TOLERANCES_M:
+        keep = simplify_track(track.lat, track.lon, tolerance_m)
+        levels[str(tolerance_m)] = encode_polyline(track.lat[keep], track.lon[keep])
+
+    route: dict[str, Any] = {
+        'polyline': encode_polyline(track.lat, track.lon),
+        'midlat': float(track.lat.mean()),
+        'midlon': float(track.lon.mean()),
+        'levels': levels,
+    }
+
+    # NB Two workers can rebuild the same route at once, so each writes its own temp file
+    filename = polyline_filename(gpx_filename)
+    try:
+        replace_file(filename, json.dumps(route))
+    except Exception as e:
+        app.logger.debug(f"write_route_polyline(): Failed to write '{filename}', error code was '{e.args}'.")
+
+    return route
+
+
+def route_polyline(gpx_filename: str) -> dict[str, Any] | None:
+    """
+    Return the encoded polyline for a route, only rebuilding it if it's missing or older than the GPX file
+    (eg routes uploaded before we stored these).
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            Dictionary of polyline, midlat, midlon and levels or None if the GPX is missing
+    """
+    filename = polyline_filename(gpx_filename)
+    gpx_file_stat = gpx_stat(gpx_filename)
+    try:
+        if gpx_file_stat and os.stat(filename).st_mtime_ns >= gpx_file_stat.st_mtime_ns:
+            with open(filename, 'r') as file_ref:
+                route = json.load(file_ref)
+            # Files from before we stored simplified levels get rebuilt
+            if 'levels' in route:
+                return route
+    except Exception:
+        # Missing or broken, so just rebuild it
+        pass
+
+    return write_route_polyline(gpx_filename)
+
+
+def route_polyline_at(route: dict[str, Any], tolerance_m: int | None) -> str:
+    """
+    :param route:                       Dictionary from route_polyline()
+    :param tolerance_m:                 From tolerance_for_zoom(), None for full detail
+    :return:                            Encoded polyline at that level of detail
+    """
+    if tolerance_m is None:
+        return route['polyline']
+    return route.get('levels', {}).get(str(tolerance_m), route['polyline'])
+
+
+def delete_route_polyline(gpx_filename: str) -> None:
+    """
+    Remove a route's polyline file, used when the route is deleted.
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            n/a
+    """
+    try:
+        os.remove(polyline_filename(gpx_filename))
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        app.logger.debug(f"delete_route_polyline(): Failed to delete polyline for '{gpx_filename}', "
+                         f"error code was '{e.args}'.")
@@ -0,0 +1,224 @@
+import argparse
+import multiprocessing
+import os
+import time
+from typing import NamedTuple
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, db
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.repositories.cafe_repository import CafeRepository
+from core.database.repositories.gpx_repository import GpxRepository
+from core.subs_gpx import MIN_DIST_TO_CAFE_KM
+from core.subs_gpx_matching import CafeGridIndex, cafes_passed_by_track
+from core.subs_route_store import stored_track
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Routes per job handed to a worker process, small enough that the progress output moves
+ROUTES_PER_SHARD = 16
+
+# The store holds float32 points, so only report a distance as changed if it moved by more than rounding
+CHANGED_KM = 0.1
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Variables
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Each worker process builds its own cafe index once, from plain data rather than the dB
+_worker_cafes: CafeGridIndex | None = None
+
+# Set before the pool forks, so every worker sees it
+_max_dist_km: float = MIN_DIST_TO_CAFE_KM
+
+
+class CafeLocation(NamedTuple):
+    id: int
+    name: str
+    lat: float
+    lon: float
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Worker process
+# -------------------------------------------------------------------------------------------------------------- #
+
+def _init_worker(cafes: list[CafeLocation]) -> None:
+    global _worker_cafes
+
+    # We were forked from a process with open dB connections, which we must never use (or close)
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+    _worker_cafes = CafeGridIndex(cafes)
+
+
+def _analyse_shard(shard: list[tuple[int, str]]) -> tuple[int, list[tuple[int, int, float, float]]]:
+    """
+    Match one shard of routes against every cafe.
+    :param shard:                       List of (gpx_id, filename)
+    :return:                            (number of routes, list of (gpx_id, cafe_id, dist_km, range_km))
+    """
+    links: list[tuple[int, int, float, float]] = []
+    for gpx_id, filename in shard:
+        track = stored_track(gpx_id, filename)
+        if not track or len(track) == 0:
+            continue
+        for cafe_id, dist_km, range_km in cafes_passed_by_track(track, _max_dist_km, _worker_cafes):
+            links.append((gpx_id, cafe_id, dist_km, range_km))
+    return len(shard), links
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Compare with what's in the dB
+# -------------------------------------------------------------------------------------------------------------- #
+
+def diff_links(old_links: list[tuple[int, int, float, float]], new_links: list[tuple[int, int, float, float]]) \
+        -> tuple[list[tuple[int, int]], list[tuple[int, int]], list[tuple[int, int]]]:
+    """
+    :return:                            (added, removed, changed) lists of (gpx_id, cafe_id)
+    """
+    old = {(gpx_id, cafe_id): (dist_km, range_km) for gpx_id, cafe_id, dist_km, range_km in old_links}
+    new = {(gpx_id, cafe_id): (dist_km, range_km) for gpx_id, cafe_id, dist_km, range_km in new_links}
+
+    added = sorted(new.keys() - old.keys())
+    removed = sorted(old.keys() - new.keys())
+    changed = sorted(key for key in new.keys() & old.keys()
+                     if abs(new[key][0] - old[key][0]) > CHANGED_KM or abs(new[key][1] - old[key][1]) > CHANGED_KM)
+    return added, removed, changed
+
+
+def print_diff(old_links: list[tuple[int, int, float, float]], new_links: list[tuple[int, int, float, float]],
+               cafe_names: dict[int, str]) -> None:
+    old = {(gpx_id, cafe_id): (dist_km, range_km) for gpx_id, cafe_id, dist_km, range_km in old_links}
+    new = {(gpx_id, cafe_id): (dist_km, range_km) for gpx_id, cafe_id, dist_km, range_km in new_links}
+    added, removed, changed = diff_links(old_links, new_links)
+
+    for gpx_id, cafe_id in added:
+        dist_km, range_km = new[(gpx_id, cafe_id)]
+        print(f"+ gpx_id {gpx_id} passes '{cafe_names.get(cafe_id)}' ({round(dist_km, 1)} km away "
+              f"at {round(range_km, 1)} km)")
+    for gpx_id, cafe_id in removed:
+        print(f"- gpx_id {gpx_id} no longer passes '{cafe_names.get(cafe_id)}'")
+    for gpx_id, cafe_id in changed:
+        print(f"~ gpx_id {gpx_id} / '{cafe_names.get(cafe_id)}': {old[(gpx_id, cafe_id)]} -> "
+              f"{tuple(round(value, 1) for value in new[(gpx_id, cafe_id)])}")
+
+    print(f"{len(added)} added, {len(removed)} removed, {len(changed)} changed, "
+          f"{len(new) - len(added) - len(changed)} unchanged.")
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Re-check every route against every cafe
+# -------------------------------------------------------------------------------------------------------------- #
+
+def reanalyse_all_routes(max_dist_km: float = MIN_DIST_TO_CAFE_KM, workers: int | None = None,
+                         dry_run: bool = False) -> bool:
+    """
+    Re-check every route against every cafe, eg after changing MIN_DIST_TO_CAFE_KM or fixing cafe locations.
+    Routes are split into shards and spread over a process pool, then just the matches which changed are written
+    back (and those cafes' num_routes_passing recounted) in a single transaction. Routes which were uploaded,
+    edited or re-matched while we were running are left alone.
+    :param max_dist_km:                 How close a route has to get to a cafe
+    :param workers:                     Number of processes, defaults to the number of CPUs
+    :param dry_run:                     Just print what would change
+    :return:                            True if it worked
+    """
+    global _max_dist_km
+    _max_dist_km = max_dist_km
+
+    start_time = time.time()
+
+    # ----------------------------------------------------------- #
+    # Everything we need from the dB, before we fork
+    # ----------------------------------------------------------- #
+    cafes: list[CafeLocation] = [CafeLocation(cafe.id, cafe.name, cafe.lat, cafe.lon)
+                                 for cafe in CafeRepository.all_cafes()]
+    gpxes = GpxRepository.all_gpxes()
+    routes: list[tuple[int, str]] = [(gpx.id, gpx.filename) for gpx in gpxes]
+    versions: dict[int, int | None] = {gpx.id: gpx.version_id for gpx in gpxes}
+
+    # What the routes matched before we started, so we can tell if anything else changes them while we run
+    old_links = GpxRepository.all_cafe_links()
+    shards = [routes[i:i + ROUTES_PER_SHARD] for i in range(0, len(routes), ROUTES_PER_SHARD)]
+    print(f"Checking {len(routes)} routes against {len(cafes)} cafes (within {max_dist_km} km) "
+          f"in {len(shards)} shards.")
+
+    # ----------------------------------------------------------- #
+    # Fan out
+    # ----------------------------------------------------------- #
+    links: list[tuple[int, int, float, float]] = []
+    done: int = 0
+    with multiprocessing.get_context("fork").Pool(processes=workers or os.cpu_count(),
+                                                  initializer=_init_worker, initargs=(cafes,)) as pool:
+        for num_routes, shard_links in pool.imap_unordered(_analyse_shard, shards):
+            done += num_routes
+            links.extend(shard_links)
+            print(f"  {done}/{len(routes)} routes, {len(links)} matches so far "
+                  f"({round(time.time() - start_time, 1)} s)")
+
+    # ----------------------------------------------------------- #
+    # What's changed?
+    # ----------------------------------------------------------- #
+    print_diff(old_links, links, {cafe.id: cafe.name for cafe in cafes})
+
+    if dry_run:
+        print("Dry run, nothing written.")
+        return True
+
+    # ----------------------------------------------------------- #
+    # Skip anything which changed under us
+    # ----------------------------------------------------------- #
+    # An upload / edit / cafe job since we started has newer answers than ours for that route
+    current_links = GpxRepository.all_cafe_links()
+    touched = {gpx_id for gpx_id, _, _, _ in set(old_links) ^ set(current_links)}
+    touched |= {gpx.id for gpx in GpxRepository.all_gpxes() if versions.get(gpx.id, gpx.version_id) != gpx.version_id}
+    if touched:
+        print(f"Skipping {len(touched)} routes which changed while we were running: {sorted(touched)}")
+
+    gpx_ids = [gpx_id for gpx_id, _ in routes if gpx_id not in touched]
+    links = [link for link in links if link[0] not in touched]
+
+    # ----------------------------------------------------------- #
+    # Just what changed, in one transaction
+    # ----------------------------------------------------------- #
+    new = {(gpx_id, cafe_id): (gpx_id, cafe_id, dist_km, range_km) for gpx_id, cafe_id, dist_km, range_km in links}
+    added, removed, changed = diff_links([link for link in current_links if link[0] not in touched], links)
+    upserts = [new[key] for key in added + changed]
+
+    if not GpxRepository.apply_cafe_link_changes(gpx_ids, removed, upserts):
+        print("Failed to write results, nothing changed.")
+        return False
+
+    print(f"Wrote {len(upserts)} matches and removed {len(removed)} "
+          f"in {round(time.time() - start_time, 1)} s.")
+    return True
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Command line
+# -------------------------------------------------------------------------------------------------------------- #
+
+if __name__ == "__main__":
+    # Run with: python -m core.subs_gpx_reanalyse [--dry-run] [--workers N] [--max-km 1.0]
+    parser = argparse.ArgumentParser(description="Re-check every route against every cafe.")
+    parser.add_argument("--dry-run", action="store_true", help="Print what would change, but don't write it")
+    parser.add_argument("--workers", type=int, default=None, help="Number of processes (default: all CPUs)")
+    parser.add_argument("--max-km", type=float, default=MIN_DIST_TO_CAFE_KM,
+                        help=f"How close a route has to get to a cafe (default: {MIN_DIST_TO_CAFE_KM})")
+    args = parser.parse_args()
+
+    reanalyse_all_routes(max_dist_km=args.max_km, workers=args.workers, dry_run=args.dry_run)
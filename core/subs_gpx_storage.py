@@ -0,0 +1,159 @@
+import gzip
+import os
+from typing import IO
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import GPX_UPLOAD_FOLDER_ABS
+from core.subs_file_lock import replace_file
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Routes are stored gzipped on disk eg GpxModel.filename "gpx_42.gpx" is the file "gpx_42.gpx.gz". GPX is very
+# repetitive XML, so this is typically 10-20x smaller.
+GPX_COMPRESSED_SUFFIX = ".gz"
+
+# We write each file once and read it many times, so may as well squeeze it
+GPX_COMPRESS_LEVEL = 9
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+# NB Everything which reads or writes a route's GPX file should come through here, as the file on disk isn't
+# called GpxModel.filename any more. Files from before we compressed them (and the odd hand placed file eg
+# the chaingang route) are still plain XML, so we read either.
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Where is it?
+# -------------------------------------------------------------------------------------------------------------- #
+
+def compressed_gpx_path(gpx_filename: str) -> str:
+    """
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            Absolute path to the gzipped file
+    """
+    return os.path.join(GPX_UPLOAD_FOLDER_ABS, f"{os.path.basename(gpx_filename)}{GPX_COMPRESSED_SUFFIX}")
+
+
+def plain_gpx_path(gpx_filename: str) -> str:
+    """
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            Absolute path to the uncompressed file
+    """
+    return os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx_filename))
+
+
+def stored_gpx_path(gpx_filename: str) -> str | None:
+    """
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            Absolute path to whichever version of the file we have, or None
+    """
+    for filename in (compressed_gpx_path(gpx_filename), plain_gpx_path(gpx_filename)):
+        if os.path.exists(filename):
+            return filename
+    return None
+
+
+def gpx_exists(gpx_filename: str) -> bool:
+    return stored_gpx_path(gpx_filename) is not None
+
+
+def gpx_stat(gpx_filename: str) -> os.stat_result | None:
+    """
+    Used by all the caches built from a GPX file, to tell if it's changed.
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            os.stat() of the file or None if it's missing
+    """
+    for filename in (compressed_gpx_path(gpx_filename), plain_gpx_path(gpx_filename)):
+        try:
+            return os.stat(filename)
+        except OSError:
+            pass
+    return None
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Read
+# -------------------------------------------------------------------------------------------------------------- #
+
+def open_gpx(gpx_filename: str) -> IO[bytes]:
+    """
+    Open a route's GPX file, decompressing it on the fly if need be. Raises FileNotFoundError if it's missing.
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            Binary file object of the XML
+    """
+    filename = stored_gpx_path(gpx_filename)
+    if not filename:
+        raise FileNotFoundError(plain_gpx_path(gpx_filename))
+
+    if filename.endswith(GPX_COMPRESSED_SUFFIX):
+        # NB GzipFile has everything IO[bytes] does, typeshed just doesn't say so
+        return gzip.open(filename, 'rb')  # type: ignore
+    return open(filename, 'rb')
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Write
+# -------------------------------------------------------------------------------------------------------------- #
+
+def write_gpx(gpx_filename: str, xml: str) -> None:
+    """
+    Compress and atomically replace a route's GPX file, removing any old uncompressed copy. Raises if it fails.
+    NB mtime=0 in the gzip header, so the same XML always gives the same bytes.
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :param xml:                         The GPX file
+    :return:                            n/a
+    """
+    replace_file(compressed_gpx_path(gpx_filename),
+                 gzip.compress(xml.encode("utf-8"), compresslevel=GPX_COMPRESS_LEVEL, mtime=0))
+
+    try:
+        os.remove(plain_gpx_path(gpx_filename))
+    except FileNotFoundError:
+        pass
+
+
+def compress_gpx(gpx_filename: str) -> bool:
+    """
+    Swap an old uncompressed GPX file for a gzipped one.
+    NB The caller must hold gpx_file_lock().
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            True if we compressed it, False if there was nothing to do
+    """
+    filename = plain_gpx_path(gpx_filename)
+    if not os.path.exists(filename):
+        return False
+
+    with open(filename, 'rb') as file_ref:
+        write_gpx(gpx_filename, file_ref.read().decode("utf-8"))
+    return True
+
+
+def delete_gpx_file(gpx_filename: str) -> None:
+    """
+    Remove both versions of a route's GPX file. Raises FileNotFoundError if neither was there.
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            n/a
+    """
+    found: bool = False
+    for filename in (compressed_gpx_path(gpx_filename), plain_gpx_path(gpx_filename)):
+        try:
+            os.remove(filename)
+            found = True
+        except FileNotFoundError:
+            pass
+
+    if not found:
+        raise FileNotFoundError(plain_gpx_path(gpx_filename))
@@ -0,0 +1,62 @@
+from typing import IO, Iterator
+from lxml import etree
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Any namespace, so we cope with GPX 1.0 and 1.1 (and files with no namespace at all)
+ELE_TAG = "{*}ele"
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Stream track points out of a GPX file
+# -------------------------------------------------------------------------------------------------------------- #
+
+def iter_track_points(source: str | IO[bytes]) -> Iterator[tuple[int, float, float, float | None]]:
+    """
+    Read the track points from a GPX file one at a time, throwing each one away as soon as we've read it, so
+    memory use doesn't grow with the size of the file. Device files are mostly heart rate, cadence and power
+    extensions, which we never look at. Routes (rte) and waypoints (wpt) are ignored, the same as before, but
+    are thrown away as we go too, so a file full of them doesn't build up in memory either.
+    :param source:                      Filename or file like object (eg request.files['filename'])
+    :return:                            Iterator of (segment number, lat, lon, elevation or None), where
+                                        segment number counts up across all the tracks in the file
+    """
+    segment: int = -1
+
+    # We need a point's <ele> when the point ends, so don't throw away anything inside a point until then
+    in_point: bool = False
+
+    # Uploads come from users, so don't go fetching external entities
+    for event, element in etree.iterparse(source, events=("start", "end"),
+                                          resolve_entities=False, no_network=True, huge_tree=True):
+        if not isinstance(element.tag, str):
+            # Comments and processing instructions
+            continue
+        name = etree.QName(element).localname
+
+        if event == "start":
+            if name == "trkseg":
+                segment += 1
+            elif name == "trkpt":
+                in_point = True
+            continue
+
+        if name == "trkpt":
+            in_point = False
+            elevation_text = element.findtext(ELE_TAG)
+            yield (segment,
+                   float(element.get("lat")),
+                   float(element.get("lon")),
+                   float(elevation_text) if elevation_text and elevation_text.strip() else None)
+        elif in_point:
+            continue
+
+        # Free this element and everything before it, whatever it was (point, waypoint, route, extensions...)
+        element.clear()
+        parent = element.getparent()
+        if parent is not None:
+            while element.getprevious() is not None:
+                del parent[0]
@@ -0,0 +1,251 @@
+import hashlib
+import io
+import math
+import os
+from typing import Any
+import numpy
+from PIL import Image, ImageDraw
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, GPX_UPLOAD_FOLDER_ABS
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our three database classes and associated forms, decorators etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.repositories.gpx_repository import GpxModel
+from core.database.repositories.cafe_repository import CafeRepository
+from core.subs_file_lock import replace_file
+from core.subs_gpx_cache import GpxTrack, gpx_track, EARTH_RADIUS_KM
+from core.subs_gpx_polyline import simplify_track
+from core.subs_gpx_storage import gpx_stat
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Thumbnails live in their own folder, so nothing which scans the GPX folder for "*.gpx" sees them
+THUMBNAIL_FOLDER_ABS = os.path.join(GPX_UPLOAD_FOLDER_ABS, "thumbnails")
+
+# Length of the hex key in each thumbnail's filename (and its ETag)
+THUMBNAIL_KEY_LENGTH = 16
+
+# Same aspect ratio as the map on a phone, big enough to be sharp on one
+THUMBNAIL_WIDTH = 640
+THUMBNAIL_HEIGHT = 400
+THUMBNAIL_MARGIN_PX = 24
+
+# ImageDraw doesn't anti-alias, so we draw at 3x and shrink it
+THUMBNAIL_SUPERSAMPLE = 3
+
+# Same colours as the Google map (see gpx_details.html and markers_for_cafes_native())
+THUMBNAIL_BACKGROUND = "#f5f3ee"
+THUMBNAIL_ROUTE_COLOUR = "#ff0000"
+THUMBNAIL_ROUTE_WIDTH_PX = 3
+THUMBNAIL_START_COLOUR = "#00a000"
+THUMBNAIL_OPEN_CAFE_COLOUR = "#2196f3"
+THUMBNAIL_CLOSED_CAFE_COLOUR = "#ff0000"
+THUMBNAIL_MARKER_RADIUS_PX = 6
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Which version of the thumbnail do we want?
+# -------------------------------------------------------------------------------------------------------------- #
+
+def thumbnail_key(gpx: GpxModel, cafe_list: list[dict[str, Any]]) -> str | None:
+    """
+    The thumbnail changes when the route is edited (cropped, undone etc), or a cafe it passes is added, moved or
+    opens / closes, so key it on the version (mtime, size) of the GPX file plus the cafe markers.
+    :param gpx:                         Route ORM
+    :param cafe_list:                   From CafeRepository.cafes_passed_by_gpx()
+    :return:                            Hex key or None if the GPX file is missing
+    """
+    stat = gpx_stat(gpx.filename)
+    if not stat:
+        return None
+
+    cafes = ";".join(f"{cafe['id']}:{cafe['lat']}:{cafe['lon']}:{cafe['status']}" for cafe in cafe_list)
+    version = f"{gpx.id}|{stat.st_mtime_ns}|{stat.st_size}|{cafes}"
+    return hashlib.sha1(version.encode("utf-8")).hexdigest()[:THUMBNAIL_KEY_LENGTH]
+
+
+def thumbnail_filename(gpx_id: int, key: str) -> str:
+    """
+    :param gpx_id:                      ID of the route
+    :param key:                         From thumbnail_key()
+    :return:                            Absolute path eg "thumbnails/gpx_42.0123456789abcdef.png"
+    """
+    return os.path.join(THUMBNAIL_FOLDER_ABS, f"gpx_{gpx_id}.{key}.png")
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Draw it
+# -------------------------------------------------------------------------------------------------------------- #
+
+def mercator(lat: numpy.ndarray, lon: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Web Mercator (same projection as Google maps), in radians, with y increasing to the north.
+    :param lat:                         Array of latitudes
+    :param lon:                         Array of longitudes
+    :return:                            (x, y)
+    """
+    x = numpy.radians(lon)
+    y = numpy.log(numpy.tan(math.pi / 4 + numpy.radians(numpy.clip(lat, -85, 85)) / 2))
+    return x, y
+
+
+def render_thumbnail(track: GpxTrack, cafe_list: list[dict[str, Any]]) -> bytes:
+    """
+    Draw the route and the cafes it passes as a PNG. We zoom to fit the route (and cafes) with a margin and only
+    draw the points which make a visible difference at that scale.
+    :param track:                       The route's points
+    :param cafe_list:                   From CafeRepository.cafes_passed_by_gpx()
+    :return:                            PNG
+    """
+    # ----------------------------------------------------------- #
+    # Scale to fit
+    # ----------------------------------------------------------- #
+    # Cafes go on the end, so they're in the picture too
+    x, y = mercator(numpy.concatenate([track.lat, [cafe['lat'] for cafe in cafe_list]]),
+                    numpy.concatenate([track.lon, [cafe['lon'] for cafe in cafe_list]]))
+    min_x, max_x = float(x.min()), float(x.max())
+    min_y, max_y = float(y.min()), float(y.max())
+
+    width = THUMBNAIL_WIDTH - 2 * THUMBNAIL_MARGIN_PX
+    height = THUMBNAIL_HEIGHT - 2 * THUMBNAIL_MARGIN_PX
+    # Pixels per radian, NB a route which is a single point (or a dead straight line) only has one dimension
+    scale = min(width / (max_x - min_x) if max_x > min_x else math.inf,
+                height / (max_y - min_y) if max_y > min_y else math.inf)
+    if math.isinf(scale):
+        scale = 1.0
+
+    # Centre it
+    offset_x = (THUMBNAIL_WIDTH - (max_x - min_x) * scale) / 2
+    offset_y = (THUMBNAIL_HEIGHT - (max_y - min_y) * scale) / 2
+
+    # Pixel coordinates (on the supersampled image), NB y is down the image
+    px = (offset_x + (x - min_x) * scale) * THUMBNAIL_SUPERSAMPLE
+    py = (THUMBNAIL_HEIGHT - offset_y - (y - min_y) * scale) * THUMBNAIL_SUPERSAMPLE
+
+    # ----------------------------------------------------------- #
+    # Only keep points which move the line by half a pixel
+    # ----------------------------------------------------------- #
+    mid_lat = float(track.lat.mean())
+    metres_per_pixel = EARTH_RADIUS_KM * 1000 * math.cos(math.radians(mid_lat)) / scale
+    keep = simplify_track(track.lat, track.lon, metres_per_pixel / 2)
+    route = list(zip(px[keep].tolist(), py[keep].tolist()))
+
+    # ----------------------------------------------------------- #
+    # Draw
+    # ----------------------------------------------------------- #
+    image = Image.new("RGB", (THUMBNAIL_WIDTH * THUMBNAIL_SUPERSAMPLE, THUMBNAIL_HEIGHT * THUMBNAIL_SUPERSAMPLE),
+                      THUMBNAIL_BACKGROUND)
+    draw = ImageDraw.Draw(image)
+
+    if len(route) > 1:
+        draw.line(route, fill=THUMBNAIL_ROUTE_COLOUR, width=THUMBNAIL_ROUTE_WIDTH_PX * THUMBNAIL_SUPERSAMPLE,
+                  joint="curve")
+
+    def marker(centre: tuple[float, float], colour: str) -> None:
+        radius = THUMBNAIL_MARKER_RADIUS_PX * THUMBNAIL_SUPERSAMPLE
+        draw.ellipse((centre[0] - radius, centre[1] - radius, centre[0] + radius, centre[1] + radius),
+                     fill=colour, outline="white", width=2 * THUMBNAIL_SUPERSAMPLE)
+
+    # NB simplify_track() always keeps the first point, unless there were no points to start with
+    if len(route) > 0:
+        marker(route[0], THUMBNAIL_START_COLOUR)
+
+    for index, cafe in enumerate(cafe_list, start=len(track)):
+        marker((float(px[index]), float(py[index])),
+               THUMBNAIL_OPEN_CAFE_COLOUR if cafe['status'] else THUMBNAIL_CLOSED_CAFE_COLOUR)
+
+    image = image.resize((THUMBNAIL_WIDTH, THUMBNAIL_HEIGHT), Image.Resampling.LANCZOS)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Tidy up
+# -------------------------------------------------------------------------------------------------------------- #
+
+def delete_route_thumbnails(gpx_id: int, keep_filename: str | None = None) -> None:
+    """
+    Remove the thumbnails of a route, called when it's deleted and to tidy up old versions.
+    :param gpx_id:                      ID of the route
+    :param keep_filename:               Don't delete this one (the current version)
+    :return:                            n/a
+    """
+    prefix = f"gpx_{gpx_id}."
+    try:
+        filenames = os.listdir(THUMBNAIL_FOLDER_ABS)
+    except OSError:
+        return
+
+    for filename in filenames:
+        full_filename = os.path.join(THUMBNAIL_FOLDER_ABS, filename)
+        # Leave other workers' tmp files (see replace_file()) alone, they'll be swapped in shortly
+        if not filename.startswith(prefix) or \
+                filename.endswith(".tmp") or \
+                not filename.endswith(".png") or \
+                full_filename == keep_filename:
+            continue
+        try:
+            os.remove(full_filename)
+        except OSError:
+            pass
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# The file to send
+# -------------------------------------------------------------------------------------------------------------- #
+
+def route_thumbnail(gpx: GpxModel) -> tuple[str, str] | None:
+    """
+    Return the thumbnail of a route, only drawing it the first time it's asked for after the route (or one of its
+    cafes) changes.
+    :param gpx:                         Route ORM
+    :return:                            (absolute filename, key to use as the ETag) or None if it failed
+    """
+    cafe_list = CafeRepository.cafes_passed_by_gpx(gpx.id)
+    key = thumbnail_key(gpx, cafe_list)
+    if not key:
+        app.logger.debug(f"route_thumbnail(): Missing GPX file '{gpx.filename}', gpx_id = '{gpx.id}'.")
+        return None
+
+    filename = thumbnail_filename(gpx.id, key)
+    if os.path.exists(filename):
+        return filename, key
+
+    # ----------------------------------------------------------- #
+    # New (or changed) route, so draw it
+    # ----------------------------------------------------------- #
+    track = gpx_track(gpx.filename)
+    if not track or len(track) == 0:
+        app.logger.debug(f"route_thumbnail(): Failed to read '{gpx.filename}', gpx_id = '{gpx.id}'.")
+        return None
+
+    try:
+        os.makedirs(THUMBNAIL_FOLDER_ABS, exist_ok=True)
+        replace_file(filename, render_thumbnail(track, cafe_list))
+    except Exception as e:
+        app.logger.debug(f"route_thumbnail(): Failed to write '{filename}', error code was '{e.args}'.")
+        return None
+
+    delete_route_thumbnails(gpx.id, keep_filename=filename)
+    app.logger.debug(f"route_thumbnail(): Drew '{filename}' for gpx_id = '{gpx.id}' ({gpx.name}).")
+    return filename, key
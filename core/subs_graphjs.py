@@ -1,12 +1,15 @@
-import gpxpy
-import gpxpy.gpx
-import mpu
 import os
+import threading
+from collections import OrderedDict
+from typing import Any
+import numpy
 
 
 from core import GPX_UPLOAD_FOLDER_ABS
 from core.subs_google_maps import gpx_colour
-from core.database.repositories.cafe_repository import CafeRepository
+from core.subs_gpx_cache import GpxTrack, gpx_track, GPX_CACHE_MAX_ROUTES
+from core.subs_gpx_storage import gpx_exists
+from core.database.repositories.gpx_repository import GpxRepository, GpxCafeModel
 
 
 # -------------------------------------------------------------------------------------------------------------- #
@@ -18,6 +21,19 @@ from core.database.repositories.cafe_repository import CafeRepository
 # so frig this by moving it up a bit.
 FUDGE_FACTOR_m = 10
 
+# How many points we send Chart.js for each elevation profile
+ELEVATION_PROFILE_POINTS = 400
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Variables
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Key is the GPX filename, value is (track, points), the entry is only valid while gpx_track() still returns that
+# same track object, ie the file hasn't changed
+_profile_cache: OrderedDict[str, tuple[GpxTrack, list[dict[str, float]]]] = OrderedDict()
+_profile_cache_lock = threading.Lock()
+
 
 # -------------------------------------------------------------------------------------------------------------- #
 # -------------------------------------------------------------------------------------------------------------- #
@@ -28,6 +44,76 @@ FUDGE_FACTOR_m = 10
 # -------------------------------------------------------------------------------------------------------------- #
 
 
+# -------------------------------------------------------------------------------------------------------------- #
+# Largest Triangle Three Buckets downsampling
+# -------------------------------------------------------------------------------------------------------------- #
+
+def lttb_indices(x: numpy.ndarray, y: numpy.ndarray, threshold: int) -> numpy.ndarray:
+    """
+    Largest Triangle Three Buckets (Sveinn Steinarsson, 2013). Always keeps the first and last points and then
+    one point per bucket, choosing the point which makes the biggest triangle with the point kept from the
+    previous bucket and the average of the next bucket. Keeps the shape of climbs far better than taking every
+    nth point.
+    :param x:                           Array of x values (distance along the route), must be increasing
+    :param y:                           Array of y values (elevation)
+    :param threshold:                   Number of points we want back
+    :return:                            Sorted array of the indices of the points to keep
+    """
+    num_points = len(x)
+    if threshold >= num_points or threshold < 3:
+        return numpy.arange(num_points)
+
+    # Bucket edges for everything between the first and last points
+    edges = numpy.linspace(1, num_points - 1, threshold - 1).astype(int)
+
+    keep = numpy.zeros(threshold, dtype=int)
+    keep[-1] = num_points - 1
+    previous = 0
+
+    for bucket in range(threshold - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+
+        # Average of the next bucket (or the last point, for the final bucket)
+        if bucket + 2 < len(edges):
+            next_start, next_end = edges[bucket + 1], edges[bucket + 2]
+            avg_x = x[next_start:next_end].mean()
+            avg_y = y[next_start:next_end].mean()
+        else:
+            avg_x = x[-1]
+            avg_y = y[-1]
+
+        # Twice the triangle area for each candidate in this bucket
+        area = numpy.abs((x[previous] - avg_x) * (y[start:end] - y[previous]) -
+                         (x[previous] - x[start:end]) * (avg_y - y[previous]))
+        previous = start + int(area.argmax())
+        keep[bucket + 1] = previous
+
+    return keep
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Elevation at a distance along the route
+# -------------------------------------------------------------------------------------------------------------- #
+
+def elevation_at_km(track: GpxTrack, dist_km: float) -> float:
+    """
+    Binary search the route's cumulative distance for the closest point to dist_km (first point wins a tie).
+    :param track:                       Parsed route
+    :param dist_km:                     Distance along the route
+    :return:                            Elevation of the closest point, in m
+    """
+    if len(track) == 0:
+        return 0
+
+    index = int(numpy.searchsorted(track.dist_km, dist_km))
+    if index >= len(track):
+        index = len(track) - 1
+    elif index > 0 and dist_km - track.dist_km[index - 1] <= track.dist_km[index] - dist_km:
+        index -= 1
+
+    return round(float(track.elevation[index]), 1)
+
+
 # -------------------------------------------------------------------------------------------------------------- #
 # Extract a super set of elevation data
 # -------------------------------------------------------------------------------------------------------------- #
@@ -43,7 +129,7 @@ def get_elevation_data_set(gpxes):
         filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, os.path.basename(gpx.filename))
 
         # Check the file exists as you never know..
-        if os.path.exists(filename):
+        if gpx_exists(filename):
             # Generate one set
             super_set.append({
                 'elevation': get_elevation_data(filename),
@@ -60,36 +146,34 @@ def get_elevation_data_set(gpxes):
 # Extract the data set of elevations for graph JS
 # -------------------------------------------------------------------------------------------------------------- #
 
-def get_elevation_data(filename):
-    # This is what we will populate from the GPX file
-    points = []
-
-    # open our file
-    with open(filename, 'r') as gpx_file:
-        gpx_track = gpxpy.parse(gpx_file)
-
-        # ----------------------------------------------------------- #
-        #   Generate our elevation graph data set
-        # ----------------------------------------------------------- #
-        for track in gpx_track.tracks:
-            for segment in track.segments:
-
-                # Need these for working out inter sample spacing
-                last_lat = segment.points[0].latitude
-                last_lon = segment.points[0].longitude
-                total_km = 0
-
-                for point in segment.points:
-                    # Work out how far we have travelled so far...
-                    total_km += mpu.haversine_distance((last_lat, last_lon), (point.latitude, point.longitude))
-
-                    points.append({
-                        'x': round(total_km, 1),
-                        'y': round(point.elevation, 1)
-                    })
-
-                    last_lat = point.latitude
-                    last_lon = point.longitude
+def get_elevation_data(filename: str, num_points: int = ELEVATION_PROFILE_POINTS) -> list[dict[str, float]]:
+    # Parsed points (with distance along the route) come from the cache
+    track = gpx_track(filename)
+    if not track:
+        return []
+
+    # ----------------------------------------------------------- #
+    #   Have we already done this version of the route?
+    # ----------------------------------------------------------- #
+    key = f"{os.path.basename(filename)}:{num_points}"
+    with _profile_cache_lock:
+        entry = _profile_cache.get(key)
+        if entry and entry[0] is track:
+            _profile_cache.move_to_end(key)
+            return entry[1]
+
+    # ----------------------------------------------------------- #
+    #   Generate our (downsampled) elevation graph data set
+    # ----------------------------------------------------------- #
+    keep = lttb_indices(track.dist_km, track.elevation, num_points)
+    points = [{'x': round(total_km, 1), 'y': round(elevation, 1)}
+              for total_km, elevation in zip(track.dist_km[keep].tolist(), track.elevation[keep].tolist())]
+
+    with _profile_cache_lock:
+        _profile_cache[key] = (track, points)
+        _profile_cache.move_to_end(key)
+        while len(_profile_cache) > GPX_CACHE_MAX_ROUTES:
+            _profile_cache.popitem(last=False)
 
     return points
 
@@ -98,30 +182,22 @@ def get_elevation_data(filename):
 # Generate icons for the cafes which match route elevation
 # -------------------------------------------------------------------------------------------------------------- #
 
-def get_cafe_heights_from_gpx(cafe_list, elevation_data):
+def get_cafe_heights_from_gpx(cafe_list: list[dict[str, Any]], filename: str) -> list[dict[str, Any]]:
     # This is what we will return
-    cafe_elevation_data = []
+    cafe_elevation_data: list[dict[str, Any]] = []
+
+    # Full resolution route, so we can binary search it
+    track = gpx_track(filename)
+    if not track:
+        return cafe_elevation_data
 
-    # NB The cafe list is a JSON string from the gpx object
     for cafe in cafe_list:
         # Extract the name and distance
         cafe_name = cafe['name']
         cafe_dist = float(cafe['range_km'])
 
-        # Find closest point in terms of distance along the route and then
-        # use the elevation of that point for the cafe icon.
-        closet_km = 100
-        elevation = 0
-
-        # Now find elevation...
-        for point in elevation_data:
-
-            # Delta between distance along route of this point and our cafe's distance along the route
-            delta_km = abs(float(point['x']) - cafe_dist)
-            if delta_km < closet_km:
-                # New closest point
-                closet_km = delta_km
-                elevation = point['y']
+        # Use the elevation of the closest point in terms of distance along the route for the cafe icon.
+        elevation = elevation_at_km(track, cafe_dist)
 
         # Have all we need for this cafe's entry
         cafe_elevation_data.append({
@@ -140,50 +216,40 @@ def get_cafe_heights_from_gpx(cafe_list, elevation_data):
 # Generate icons for the cafes which match route elevation
 # -------------------------------------------------------------------------------------------------------------- #
 
-def get_destination_cafe_height(elevation_data_set, gpx_set, cafe_set):
+def get_destination_cafe_height(gpx_set: list[Any], cafe_set: list[Any],
+                                cafe_links: dict[tuple[int, int], GpxCafeModel] | None = None) -> list[dict[str, Any]]:
     # This is what we will return
-    cafe_elevation_data = []
+    cafe_elevation_data: list[dict[str, Any]] = []
+
+    # How far along each route each cafe is, in one go, unless the caller already has them
+    # eg {(gpx_id, cafe_id): GpxCafeModel}
+    if cafe_links is None:
+        cafe_links = GpxRepository.cafe_links([gpx.id for gpx in gpx_set])
 
     # Loop through each route
-    for n in range(0, len(elevation_data_set)):
-
-        elevation_data = elevation_data_set[n]
-        gpx = gpx_set[n]
-        target_cafe = cafe_set[n]
-
-        cafe_list: list[dict] = CafeRepository.cafes_passed_by_gpx(gpx.cafes_passed)
-
-        # NB The cafe list is a JSON string from the gpx object
-        for cafe in cafe_list:
-            # Extract the name and distance
-            cafe_id = cafe['id']
-            cafe_name = cafe['name']
-            cafe_dist = float(cafe['range_km'])
-
-            # Find closest point in terms of distance along the route and then
-            # use the elevation of that point for the cafe icon.
-            closet_km = 100
-            elevation = 0
-
-            # Now find elevation...
-            for point in elevation_data['elevation']:
-
-                # Delta between distance along route of this point and our cafe's distance along the route
-                delta_km = abs(float(point['x']) - cafe_dist)
-                if delta_km < closet_km:
-                    # New closest point
-                    closet_km = delta_km
-                    elevation = point['y']
-
-            # Have all we need for this cafe's entry
-            if cafe_id == target_cafe.id:
-                cafe_elevation_data.append({
-                    'name': cafe_name,
-                    'coord':
-                        {
-                            'x': cafe_dist,
-                            'y': elevation + FUDGE_FACTOR_m
-                        }
-                })
+    for gpx, target_cafe in zip(gpx_set, cafe_set):
+
+        # Ride might be to a new cafe, which we won't have in the dB
+        if not target_cafe or not target_cafe.id:
+            continue
+
+        # How far along the route is the cafe?
+        cafe_passed = cafe_links.get((gpx.id, target_cafe.id))
+        if not cafe_passed:
+            continue
+
+        track = gpx_track(gpx.filename)
+        if not track:
+            continue
+
+        # Have all we need for this cafe's entry
+        cafe_elevation_data.append({
+            'name': target_cafe.name,
+            'coord':
+                {
+                    'x': cafe_passed.range_km,
+                    'y': elevation_at_km(track, cafe_passed.range_km) + FUDGE_FACTOR_m
+                }
+        })
 
     return cafe_elevation_data
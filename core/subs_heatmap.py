@@ -0,0 +1,497 @@
+import argparse
+import io
+import math
+import os
+import shutil
+import time
+import numpy
+from PIL import Image
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, GPX_UPLOAD_FOLDER_ABS
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.repositories.gpx_repository import GpxModel, GpxRepository, TYPE_GRAVEL
+from core.subs_file_lock import file_lock, replace_file
+from core.subs_google_maps import MAP_BOUNDS
+from core.subs_gpx_cache import GpxTrack
+from core.subs_gpx_storage import gpx_stat
+from core.subs_route_store import stored_track
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Everything lives in its own folder, so nothing which scans the GPX folder for "*.gpx" sees it
+HEATMAP_FOLDER_ABS = os.path.join(GPX_UPLOAD_FOLDER_ABS, "heatmap")
+HEATMAP_ROUTE_FOLDER_ABS = os.path.join(HEATMAP_FOLDER_ABS, "routes")
+HEATMAP_TILE_FOLDER_ABS = os.path.join(HEATMAP_FOLDER_ABS, "tiles")
+
+# Updates take this exclusively, building a tile takes it shared
+HEATMAP_LOCK_FILENAME = os.path.join(HEATMAP_FOLDER_ABS, "grids")
+
+# Every public route goes in LAYER_ALL, gravel routes go in LAYER_GRAVEL as well
+LAYER_ALL = "all"
+LAYER_GRAVEL = "gravel"
+HEATMAP_LAYERS = [LAYER_ALL, LAYER_GRAVEL]
+
+# Google map tiles are 256 x 256
+TILE_SIZE = 256
+
+# Zoom levels we keep a density grid for, one cell per pixel over MAP_BOUNDS. Each zoom level is 4x the size
+# of the one before, at zoom 10 it's ~40 MB per layer.
+HEATMAP_GRID_ZOOMS = (7, 8, 9, 10)
+
+# Tiles above the last grid are blown up from it, so get blurrier the further in you go
+HEATMAP_MAX_ZOOM = 13
+
+# Counts are number of routes through each pixel
+HEATMAP_DTYPE = numpy.uint16
+
+# Step along the route when we rasterise it, in pixels, so there are no gaps between points
+HEATMAP_STEP_PX = 0.5
+
+# Number of routes through a pixel which gets the hottest colour, on a log scale so single routes still show
+HEATMAP_SATURATION = 30
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+# NB How it works:
+#  - For each layer and zoom level, a grid of counts covering MAP_BOUNDS, one cell per map pixel, so a tile is
+#    just a 256 x 256 slice of it.
+#  - Each route's cells (which pixels it passes through at each zoom level) are kept in "routes/gpx_42.npz", so
+#    when a route changes we can take its old cells off the grids and add its new ones, rather than starting
+#    again from scratch.
+#  - Tiles are rendered to PNG the first time they're asked for, and only the tiles a route touches are thrown
+#    away when it changes.
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Where things are
+# -------------------------------------------------------------------------------------------------------------- #
+
+def grid_filename(layer: str, zoom: int) -> str:
+    return os.path.join(HEATMAP_FOLDER_ABS, f"{layer}_z{zoom}.npy")
+
+
+def route_cells_filename(gpx_id: int) -> str:
+    return os.path.join(HEATMAP_ROUTE_FOLDER_ABS, f"gpx_{gpx_id}.npz")
+
+
+def tile_filename(layer: str, zoom: int, x: int, y: int) -> str:
+    return os.path.join(HEATMAP_TILE_FOLDER_ABS, layer, str(zoom), f"{x}_{y}.png")
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Map projection
+# -------------------------------------------------------------------------------------------------------------- #
+
+def world_pixels(lat: numpy.ndarray | float, lon: numpy.ndarray | float,
+                 zoom: int) -> tuple[numpy.ndarray, numpy.ndarray]:
+    """
+    Web Mercator pixel coordinates, same as Google maps, ie tile (x, y) is pixels [x * 256, (x + 1) * 256) etc.
+    :param lat:                         Latitude(s)
+    :param lon:                         Longitude(s)
+    :param zoom:                        Google maps zoom level
+    :return:                            (x, y), y increases to the south
+    """
+    world_size = TILE_SIZE * 2 ** zoom
+    x = (numpy.asarray(lon, dtype=float) + 180) / 360 * world_size
+    y = (1 - numpy.arcsinh(numpy.tan(numpy.radians(lat))) / math.pi) / 2 * world_size
+    return x, y
+
+
+def grid_tiles(zoom: int) -> tuple[int, int, int, int]:
+    """
+    The tiles which cover MAP_BOUNDS, which is what each grid covers.
+    :param zoom:                        Google maps zoom level
+    :return:                            (first x, first y, number across, number down)
+    """
+    west, north = world_pixels(MAP_BOUNDS['north'], MAP_BOUNDS['west'], zoom)
+    east, south = world_pixels(MAP_BOUNDS['south'], MAP_BOUNDS['east'], zoom)
+    x0, y0 = int(west) // TILE_SIZE, int(north) // TILE_SIZE
+    x1, y1 = int(east) // TILE_SIZE, int(south) // TILE_SIZE
+    return x0, y0, x1 - x0 + 1, y1 - y0 + 1
+
+
+def grid_shape(zoom: int) -> tuple[int, int]:
+    _, _, num_x, num_y = grid_tiles(zoom)
+    return num_y * TILE_SIZE, num_x * TILE_SIZE
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Rasterise a route
+# -------------------------------------------------------------------------------------------------------------- #
+
+def route_cells(track: GpxTrack, zoom: int) -> numpy.ndarray:
+    """
+    Which cells of the grid a route passes through. We step along the route every HEATMAP_STEP_PX so long
+    straight bits don't come out dotted, and each cell counts once however many points land in it (otherwise
+    every cafe stop would be a hot spot).
+    :param track:                       The route's points
+    :param zoom:                        Google maps zoom level
+    :return:                            Sorted array of flat indices into the grid
+    """
+    x, y = world_pixels(track.lat, track.lon, zoom)
+
+    # ----------------------------------------------------------- #
+    # Fill in between points
+    # ----------------------------------------------------------- #
+    dist = numpy.concatenate([[0], numpy.cumsum(numpy.hypot(numpy.diff(x), numpy.diff(y)))])
+    if dist[-1] > 0:
+        steps = numpy.append(numpy.arange(0, dist[-1], HEATMAP_STEP_PX), dist[-1])
+        x = numpy.interp(steps, dist, x)
+        y = numpy.interp(steps, dist, y)
+
+    # ----------------------------------------------------------- #
+    # One bin per pixel, a tile at a time
+    # ----------------------------------------------------------- #
+    # Doing the whole bounding box in one go would need a bin for every pixel of it, which for a long diagonal
+    # route at zoom 10 is hundreds of MB, so we only histogram the tiles the route actually passes through
+    tile_x0, tile_y0, num_x, num_y = grid_tiles(zoom)
+    tile_x = numpy.floor(x / TILE_SIZE).astype(numpy.int64)
+    tile_y = numpy.floor(y / TILE_SIZE).astype(numpy.int64)
+    inside = (tile_x >= tile_x0) & (tile_x < tile_x0 + num_x) & (tile_y >= tile_y0) & (tile_y < tile_y0 + num_y)
+    x, y, tile_x, tile_y = x[inside], y[inside], tile_x[inside], tile_y[inside]
+
+    tile_ids = (tile_y - tile_y0) * num_x + (tile_x - tile_x0)
+    order = numpy.argsort(tile_ids, kind="stable")
+    tile_ids, x, y = tile_ids[order], x[order], y[order]
+    starts = numpy.flatnonzero(numpy.diff(tile_ids, prepend=-1))
+
+    cols = num_x * TILE_SIZE
+    cells: list[numpy.ndarray] = []
+    for start, end in zip(starts.tolist(), starts[1:].tolist() + [len(tile_ids)]):
+        row0 = int(tile_ids[start]) // num_x * TILE_SIZE
+        col0 = int(tile_ids[start]) % num_x * TILE_SIZE
+        left, top = (tile_x0 * TILE_SIZE) + col0, (tile_y0 * TILE_SIZE) + row0
+        counts, _, _ = numpy.histogram2d(x[start:end], y[start:end], bins=TILE_SIZE,
+                                         range=[[left, left + TILE_SIZE], [top, top + TILE_SIZE]])
+        ix, iy = numpy.nonzero(counts)
+        cells.append((iy.astype(numpy.int64) + row0) * cols + ix + col0)
+
+    if not cells:
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.sort(numpy.concatenate(cells))
+
+
+def route_layers(gpx: GpxModel | None) -> list[str]:
+    """
+    :param gpx:                         Route ORM, or None if it's been deleted
+    :return:                            The layers it should be in (none unless it's public)
+    """
+    if not gpx or not gpx.public:
+        return []
+    if gpx.type == TYPE_GRAVEL:
+        return [LAYER_ALL, LAYER_GRAVEL]
+    return [LAYER_ALL]
+
+
+def route_key(gpx: GpxModel, layers: list[str]) -> str | None:
+    """
+    What we rasterised, so we can tell if the route has changed since.
+    :param gpx:                         Route ORM
+    :param layers:                      From route_layers()
+    :return:                            Key or None if the GPX file is missing
+    """
+    stat = gpx_stat(gpx.filename)
+    if not stat:
+        return None
+    return f"{stat.st_mtime_ns}|{stat.st_size}|{','.join(layers)}"
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Each route's cells
+# -------------------------------------------------------------------------------------------------------------- #
+
+def load_route_cells(gpx_id: int) -> tuple[str, list[str], dict[int, numpy.ndarray]] | None:
+    """
+    :param gpx_id:                      ID of the route
+    :return:                            (key, layers, cells for each zoom) or None if it's not on the grids
+    """
+    try:
+        with numpy.load(route_cells_filename(gpx_id)) as data:
+            return (str(data['key']), [str(layer) for layer in data['layers']],
+                    {zoom: data[f"z{zoom}"] for zoom in HEATMAP_GRID_ZOOMS})
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def save_route_cells(gpx_id: int, key: str, layers: list[str], cells: dict[int, numpy.ndarray]) -> None:
+    buffer = io.BytesIO()
+    arrays: dict[str, numpy.ndarray] = {f"z{zoom}": cells[zoom] for zoom in HEATMAP_GRID_ZOOMS}
+    numpy.savez(buffer, key=numpy.array(key), layers=numpy.array(layers), **arrays)  # type: ignore
+    os.makedirs(HEATMAP_ROUTE_FOLDER_ABS, exist_ok=True)
+    replace_file(route_cells_filename(gpx_id), buffer.getvalue())
+
+
+def delete_route_cells(gpx_id: int) -> None:
+    try:
+        os.remove(route_cells_filename(gpx_id))
+    except FileNotFoundError:
+        pass
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Tile cache
+# -------------------------------------------------------------------------------------------------------------- #
+
+def delete_tiles(layer: str, zoom: int, cells: numpy.ndarray) -> None:
+    """
+    Throw away the cached tiles covering some cells of a grid, plus the tiles blown up from them.
+    NB The caller must hold the exclusive lock, so no one can be building one of them from the old grid.
+    :param layer:                       Grid layer
+    :param zoom:                        Grid zoom level
+    :param cells:                       Flat indices into the grid
+    :return:                            n/a
+    """
+    tile_x0, tile_y0, _, _ = grid_tiles(zoom)
+    _, cols = grid_shape(zoom)
+    tiles = numpy.unique(numpy.column_stack([cells % cols // TILE_SIZE, cells // cols // TILE_SIZE]), axis=0)
+
+    # Only the last grid is blown up for the zoom levels above it
+    max_zoom = HEATMAP_MAX_ZOOM if zoom == HEATMAP_GRID_ZOOMS[-1] else zoom
+    for tile_x, tile_y in tiles.tolist():
+        for tile_zoom in range(zoom, max_zoom + 1):
+            scale = 2 ** (tile_zoom - zoom)
+            for x in range((tile_x0 + tile_x) * scale, (tile_x0 + tile_x + 1) * scale):
+                for y in range((tile_y0 + tile_y) * scale, (tile_y0 + tile_y + 1) * scale):
+                    try:
+                        os.remove(tile_filename(layer, tile_zoom, x, y))
+                    except FileNotFoundError:
+                        pass
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Incremental update, when a route changes
+# -------------------------------------------------------------------------------------------------------------- #
+
+def update_route_heatmap(gpx_id: int) -> bool:
+    """
+    Bring the heatmap up to date for one route, after it's been added, edited, published, hidden or deleted.
+    Takes the route's old cells off the grids and adds its new ones, then throws away just the tiles which
+    changed. Safe to run more than once, if the route hasn't changed it does nothing.
+    :param gpx_id:                      ID of the route
+    :return:                            True if it worked
+    """
+    if not os.path.exists(grid_filename(LAYER_ALL, HEATMAP_GRID_ZOOMS[0])):
+        app.logger.debug("update_route_heatmap(): No heatmap yet, run 'python -m core.subs_heatmap' first.")
+        return True
+
+    # ----------------------------------------------------------- #
+    # Where the route should be
+    # ----------------------------------------------------------- #
+    gpx: GpxModel | None = GpxRepository.one_by_id(gpx_id)
+    layers = route_layers(gpx)
+    key: str | None = None
+    cells: dict[int, numpy.ndarray] = {}
+    if gpx and layers:
+        key = route_key(gpx, layers)
+        track = stored_track(gpx.id, gpx.filename) if key else None
+        if not track or len(track) == 0:
+            app.logger.debug(f"update_route_heatmap(): Failed to read GPX file for gpx_id = '{gpx_id}'.")
+            layers, key = [], None
+        else:
+            cells = {zoom: route_cells(track, zoom) for zoom in HEATMAP_GRID_ZOOMS}
+
+    with file_lock(HEATMAP_LOCK_FILENAME):
+        # ----------------------------------------------------------- #
+        # Where it is now
+        # ----------------------------------------------------------- #
+        old = load_route_cells(gpx_id)
+        if old and old[0] == key:
+            return True
+        if not old and not layers:
+            return True
+        old_layers, old_cells = (old[1], old[2]) if old else ([], {})
+
+        # ----------------------------------------------------------- #
+        # Move it
+        # ----------------------------------------------------------- #
+        for layer in HEATMAP_LAYERS:
+            for zoom in HEATMAP_GRID_ZOOMS:
+                if layer not in old_layers and layer not in layers:
+                    continue
+                grid = numpy.load(grid_filename(layer, zoom), mmap_mode='r+').reshape(-1)
+                if layer in old_layers:
+                    # Cells are unique, so no need for numpy.subtract.at()
+                    grid[old_cells[zoom]] = numpy.maximum(grid[old_cells[zoom]], 1) - 1
+                if layer in layers:
+                    grid[cells[zoom]] += 1
+                grid.flush()
+
+                changed = [layer_cells[zoom] for layer_cells, in_layers in ((old_cells, old_layers), (cells, layers))
+                           if layer in in_layers]
+                delete_tiles(layer, zoom, numpy.unique(numpy.concatenate(changed)))
+
+        if layers and key:
+            save_route_cells(gpx_id, key, layers, cells)
+        else:
+            delete_route_cells(gpx_id)
+
+    app.logger.debug(f"update_route_heatmap(): Updated heatmap for gpx_id = '{gpx_id}', layers = {layers}.")
+    return True
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Full rebuild, offline
+# -------------------------------------------------------------------------------------------------------------- #
+
+def rebuild_heatmap() -> None:
+    """
+    Rasterise every public route from scratch, eg the first time, or after changing MAP_BOUNDS or the zoom
+    levels. The grids are built off to the side and swapped in, so the site can stay up.
+    NB Stop the job workers first, an update which lands while this is running would be lost.
+    Run with: python -m core.subs_heatmap
+    """
+    start_time = time.time()
+    gpxes: list[GpxModel] = GpxRepository.all_gpxes()
+
+    grids = {(layer, zoom): numpy.zeros(grid_shape(zoom), dtype=HEATMAP_DTYPE).reshape(-1)
+             for layer in HEATMAP_LAYERS for zoom in HEATMAP_GRID_ZOOMS}
+    routes: dict[int, tuple[str, list[str], dict[int, numpy.ndarray]]] = {}
+
+    # ----------------------------------------------------------- #
+    # Every public route
+    # ----------------------------------------------------------- #
+    for gpx in gpxes:
+        layers = route_layers(gpx)
+        if not layers:
+            continue
+        key = route_key(gpx, layers)
+        track = stored_track(gpx.id, gpx.filename) if key else None
+        if not key or not track or len(track) == 0:
+            print(f"Missing GPX file for gpx_id = '{gpx.id}' ({gpx.name}).")
+            continue
+
+        cells = {zoom: route_cells(track, zoom) for zoom in HEATMAP_GRID_ZOOMS}
+        for layer in layers:
+            for zoom in HEATMAP_GRID_ZOOMS:
+                grids[(layer, zoom)][cells[zoom]] += 1
+        routes[gpx.id] = (key, layers, cells)
+
+    print(f"Rasterised {len(routes)} public routes in {round(time.time() - start_time, 1)} s.")
+
+    # ----------------------------------------------------------- #
+    # Swap it all in
+    # ----------------------------------------------------------- #
+    os.makedirs(HEATMAP_FOLDER_ABS, exist_ok=True)
+    with file_lock(HEATMAP_LOCK_FILENAME):
+        for (layer, zoom), grid in grids.items():
+            tmp_filename = f"{grid_filename(layer, zoom)}.{os.getpid()}.tmp.npy"
+            numpy.save(tmp_filename, grid.reshape(grid_shape(zoom)))
+            os.replace(tmp_filename, grid_filename(layer, zoom))
+
+        shutil.rmtree(HEATMAP_ROUTE_FOLDER_ABS, ignore_errors=True)
+        for gpx_id, (key, layers, cells) in routes.items():
+            save_route_cells(gpx_id, key, layers, cells)
+
+        shutil.rmtree(HEATMAP_TILE_FOLDER_ABS, ignore_errors=True)
+
+    print(f"Rebuilt heatmap in {round(time.time() - start_time, 1)} s.")
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Tiles
+# -------------------------------------------------------------------------------------------------------------- #
+
+def render_tile(counts: numpy.ndarray) -> bytes:
+    """
+    Colour a block of counts, transparent where there aren't any routes, through red to yellow where there
+    are lots.
+    :param counts:                      Counts, any size (it's stretched to a tile)
+    :return:                            PNG
+    """
+    heat = numpy.clip(numpy.log1p(counts.astype(float)) / math.log1p(HEATMAP_SATURATION), 0, 1)
+
+    rgba = numpy.zeros(counts.shape + (4,), dtype=numpy.uint8)
+    rgba[..., 0] = 255
+    rgba[..., 1] = (heat * 255).astype(numpy.uint8)
+    rgba[..., 3] = numpy.where(counts > 0, 96 + heat * 159, 0).astype(numpy.uint8)
+
+    image = Image.fromarray(rgba, "RGBA")
+    if counts.shape != (TILE_SIZE, TILE_SIZE):
+        image = image.resize((TILE_SIZE, TILE_SIZE), Image.Resampling.BILINEAR)
+
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+
+def heatmap_tile(layer: str, zoom: int, x: int, y: int) -> str | None:
+    """
+    Return a heatmap tile, drawing it the first time it's asked for.
+    :param layer:                       One of HEATMAP_LAYERS
+    :param zoom:                        Google maps zoom level
+    :param x:                           Tile x
+    :param y:                           Tile y
+    :return:                            Absolute filename of the PNG or None if there's no such tile (eg outside
+                                        MAP_BOUNDS) or no heatmap yet
+    """
+    if layer not in HEATMAP_LAYERS or \
+            not HEATMAP_GRID_ZOOMS[0] <= zoom <= HEATMAP_MAX_ZOOM:
+        return None
+
+    filename = tile_filename(layer, zoom, x, y)
+    if os.path.exists(filename):
+        return filename
+
+    # ----------------------------------------------------------- #
+    # Which bit of which grid
+    # ----------------------------------------------------------- #
+    # Above the last grid we blow up a piece of one of its tiles
+    grid_zoom = min(zoom, HEATMAP_GRID_ZOOMS[-1])
+    scale = 2 ** (zoom - grid_zoom)
+    size = TILE_SIZE // scale
+    tile_x0, tile_y0, num_x, num_y = grid_tiles(grid_zoom)
+    col = (x // scale - tile_x0) * TILE_SIZE + (x % scale) * size
+    row = (y // scale - tile_y0) * TILE_SIZE + (y % scale) * size
+
+    # ----------------------------------------------------------- #
+    # Draw it
+    # ----------------------------------------------------------- #
+    # Outside MAP_BOUNDS, so no routes (and we don't want to cache every tile in the world)
+    if not (0 <= col < num_x * TILE_SIZE and 0 <= row < num_y * TILE_SIZE):
+        return None
+
+    try:
+        # Updates can't change the grid (or remove tiles) until we've saved it
+        with file_lock(HEATMAP_LOCK_FILENAME, shared=True):
+            grid = numpy.load(grid_filename(layer, grid_zoom), mmap_mode='r')
+            counts = numpy.array(grid[row:row + size, col:col + size])
+
+            os.makedirs(os.path.dirname(filename), exist_ok=True)
+            replace_file(filename, render_tile(counts))
+
+    except Exception as e:
+        app.logger.debug(f"heatmap_tile(): Failed to draw '{filename}', error code was '{e.args}'.")
+        return None
+
+    return filename
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Command line
+# -------------------------------------------------------------------------------------------------------------- #
+
+if __name__ == "__main__":
+    # Run with: python -m core.subs_heatmap
+    parser = argparse.ArgumentParser(description="Rebuild the route heatmap from every public route.")
+    parser.parse_args()
+
+    rebuild_heatmap()
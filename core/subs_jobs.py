@@ -0,0 +1,167 @@
+import argparse
+import time
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.models.job_model import JobModel, JOB_GPX_CAFES, JOB_RIDE_EMAILS, JOB_HEATMAP
+from core.database.repositories.job_repository import JobRepository
+from core.database.repositories.calendar_repository import CalendarModel, CalendarRepository
+from core.database.repositories.event_repository import EventRepository
+from core.subs_gpx import check_new_gpx_with_all_cafes
+from core.subs_email import send_ride_notification_emails
+from core.subs_heatmap import update_route_heatmap
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# How long an idle worker waits before looking for new jobs
+JOB_POLL_SECS = 2
+
+# How often an idle worker checks for jobs abandoned by a dead worker
+JOB_STALE_CHECK_SECS = 60
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Web side, add jobs to the queue
+# -------------------------------------------------------------------------------------------------------------- #
+
+def queue_gpx_analysis(gpx_id: int, calendar_id: int | None = None) -> bool:
+    """
+    Ask a worker to match a route against all the cafes, and then send out any ride emails waiting on it.
+    :param gpx_id:                      The ID of the GPX ORM in the gpx table
+    :param calendar_id:                 If we are sending email alerts then it is the calendar ID of the ride, else None
+    :return:                            True if the job was queued
+    """
+    app.logger.debug(f"queue_gpx_analysis(): Queueing cafe analysis for gpx_id = '{gpx_id}', "
+                     f"calendar_id = '{calendar_id}'.")
+    return JobRepository.add_job(JOB_GPX_CAFES, gpx_id=gpx_id, calendar_id=calendar_id)
+
+
+def queue_ride_emails(calendar_id: int) -> bool:
+    """
+    Ask a worker to send the email alerts for a ride.
+    :param calendar_id:                 The ride
+    :return:                            True if the job was queued
+    """
+    app.logger.debug(f"queue_ride_emails(): Queueing ride emails for calendar_id = '{calendar_id}'.")
+    return JobRepository.add_job(JOB_RIDE_EMAILS, calendar_id=calendar_id)
+
+
+def queue_heatmap_update(gpx_id: int) -> bool:
+    """
+    Ask a worker to redraw a route on the heatmap, after it's been edited, published, hidden or deleted.
+    :param gpx_id:                      The route (it doesn't matter if it's already been deleted)
+    :return:                            True if the job was queued
+    """
+    app.logger.debug(f"queue_heatmap_update(): Queueing heatmap update for gpx_id = '{gpx_id}'.")
+    return JobRepository.add_job(JOB_HEATMAP, gpx_id=gpx_id)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Worker side
+# -------------------------------------------------------------------------------------------------------------- #
+
+def run_job(job: JobModel) -> bool:
+    """
+    Do one job. Ride emails are only ever sent once, as send_ride_notification_emails() claims the ride's
+    sent_email flag first, so it's always safe to retry a job.
+    :param job:                         Job claimed from the queue
+    :return:                            True if it worked
+    """
+    if job.kind == JOB_GPX_CAFES:
+        return check_new_gpx_with_all_cafes(job.gpx_id, job.calendar_id)
+
+    elif job.kind == JOB_RIDE_EMAILS:
+        ride: CalendarModel | None = CalendarRepository.one_by_id(job.calendar_id)
+        if not ride:
+            app.logger.debug(f"run_job(): Can't find ride, calendar_id = '{job.calendar_id}'.")
+            return False
+        send_ride_notification_emails(ride)
+        return True
+
+    elif job.kind == JOB_HEATMAP:
+        return update_route_heatmap(job.gpx_id)
+
+    app.logger.debug(f"run_job(): Unknown job kind '{job.kind}', job.id = '{job.id}'.")
+    return False
+
+
+def run_next_job() -> bool:
+    """
+    Claim and run the next job in the queue.
+    :return:                            False if the queue was empty
+    """
+    job: JobModel | None = JobRepository.claim_next_job()
+    if not job:
+        return False
+
+    app.logger.debug(f"run_next_job(): Starting {job}, attempt {job.attempts}.")
+    try:
+        worked = run_job(job)
+        error = "Job returned False"
+    except Exception as e:
+        worked = False
+        error = f"{type(e).__name__}: {e.args}"
+
+    if worked:
+        JobRepository.mark_done(job.id)
+    else:
+        app.logger.debug(f"run_next_job(): {job} failed, error was '{error}'.")
+        EventRepository.log_event("Job Fail", f"Job '{job.kind}' failed, job.id = '{job.id}', gpx_id = '{job.gpx_id}', "
+                                              f"calendar_id = '{job.calendar_id}', error was '{error}'.")
+        JobRepository.mark_failed(job.id, error)
+
+    return True
+
+
+def run_worker(once: bool = False) -> None:
+    """
+    Work through the queue forever. Run as many of these as you like, they never pick up the same job.
+    :param once:                        Stop when the queue is empty (eg from cron)
+    :return:                            n/a
+    """
+    last_stale_check: float = 0
+    while True:
+        if time.time() - last_stale_check > JOB_STALE_CHECK_SECS:
+            last_stale_check = time.time()
+            count = JobRepository.requeue_stale_jobs()
+            if count:
+                app.logger.debug(f"run_worker(): Requeued {count} stale jobs.")
+
+        if not run_next_job():
+            if once:
+                return
+            time.sleep(JOB_POLL_SECS)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Command line
+# -------------------------------------------------------------------------------------------------------------- #
+
+if __name__ == "__main__":
+    # Run alongside gunicorn with: python -m core.subs_jobs
+    parser = argparse.ArgumentParser(description="Background worker for route analysis, ride emails and the heatmap.")
+    parser.add_argument("--once", action="store_true", help="Exit when the queue is empty")
+    args = parser.parse_args()
+
+    run_worker(once=args.once)
@@ -0,0 +1,304 @@
+import math
+import threading
+from typing import Any
+import numpy
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our own classes
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.subs_route_store import open_route_store
+from core.subs_gpx_cache import EARTH_RADIUS_KM
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Size of a cell in the segment grid
+SEGMENT_CELL_KM = 1.0
+
+# km per degree of latitude (and of longitude at the equator)
+KM_PER_DEGREE = EARTH_RADIUS_KM * math.pi / 180
+
+# Same trick as the cafe grid, size the longitude step for the most northerly latitude we'd ever see, so a cell
+# is always at least SEGMENT_CELL_KM wide
+GRID_MAX_LAT_DEG = 60
+
+# Cells are packed into one int64 as (row << 32) + col + CELL_COL_OFFSET
+CELL_COL_OFFSET = 1 << 31
+
+# Largest search radius we'll accept, beyond this the flat earth maths below starts to drift
+MAX_SEARCH_RADIUS_KM = 25
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Variables
+# -------------------------------------------------------------------------------------------------------------- #
+
+# The index for this worker and the route store index it was built from
+_segment_index: "RouteSegmentIndex | None" = None
+_segment_index_source: dict[str, Any] | None = None
+_segment_index_lock = threading.Lock()
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Spatial index of route segments
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+class RouteSegmentIndex:
+    """
+    Grid over every segment (pair of consecutive points) of every route in the route store. Each cell maps to
+    runs of (gpx_id, first segment, last segment), where segment n joins row n to row n + 1 of the store.
+    The points themselves stay in the store's memmap, so we never open a GPX file to answer a query.
+    """
+
+    def __init__(self, index: dict[str, Any], data: numpy.memmap | None):
+        self.lat_step = SEGMENT_CELL_KM / KM_PER_DEGREE
+        self.lon_step = SEGMENT_CELL_KM / (KM_PER_DEGREE * math.cos(math.radians(GRID_MAX_LAT_DEG)))
+
+        # Columns of the store, still memory mapped
+        self.lats = data[:, 0] if data is not None else numpy.zeros(0)
+        self.lons = data[:, 1] if data is not None else numpy.zeros(0)
+
+        # One entry per run, sorted by cell
+        self.run_cells = numpy.zeros(0, dtype=numpy.int64)
+        self.run_starts = numpy.zeros(0, dtype=numpy.int64)
+        self.run_ends = numpy.zeros(0, dtype=numpy.int64)
+        self.run_gpx_ids = numpy.zeros(0, dtype=numpy.int64)
+
+        if data is not None and index['routes']:
+            self._build(index)
+
+    def __len__(self) -> int:
+        return len(self.run_cells)
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Build
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    def _rows_cols(self, lats: numpy.ndarray | float,
+                   lons: numpy.ndarray | float) -> tuple[numpy.ndarray, numpy.ndarray]:
+        return numpy.floor(numpy.asarray(lats, dtype=float) / self.lat_step).astype(numpy.int64), \
+            numpy.floor(numpy.asarray(lons, dtype=float) / self.lon_step).astype(numpy.int64)
+
+    def _build(self, index: dict[str, Any]) -> None:
+        # ----------------------------------------------------------- #
+        # Every segment of every live route in the store
+        # ----------------------------------------------------------- #
+        gpx_ids = []
+        seg_ranges = []
+        for gpx_id, (offset, length, _, _) in index['routes'].items():
+            if length > 1:
+                gpx_ids.append((offset, int(gpx_id)))
+                seg_ranges.append(numpy.arange(offset, offset + length - 1, dtype=numpy.int64))
+        if not seg_ranges:
+            return
+        segments = numpy.concatenate(seg_ranges)
+
+        # ----------------------------------------------------------- #
+        # Cells covered by the bounding box of each segment
+        # ----------------------------------------------------------- #
+        rows_a, cols_a = self._rows_cols(self.lats[segments], self.lons[segments])
+        rows_b, cols_b = self._rows_cols(self.lats[segments + 1], self.lons[segments + 1])
+        min_rows, min_cols = numpy.minimum(rows_a, rows_b), numpy.minimum(cols_a, cols_b)
+        widths = numpy.abs(cols_a - cols_b) + 1
+        counts = (numpy.abs(rows_a - rows_b) + 1) * widths
+
+        # Nearly every segment sits in one cell, the odd long one gets repeated for each cell it might cross
+        repeat = numpy.repeat(numpy.arange(len(segments)), counts)
+        step = numpy.arange(len(repeat)) - numpy.repeat(numpy.cumsum(counts) - counts, counts)
+        cells = (min_rows[repeat] + step // widths[repeat]) * (1 << 32) + \
+            (min_cols[repeat] + step % widths[repeat]) + CELL_COL_OFFSET
+        segments = segments[repeat]
+
+        # ----------------------------------------------------------- #
+        # Collapse consecutive segments in the same cell into runs
+        # ----------------------------------------------------------- #
+        order = numpy.lexsort((segments, cells))
+        cells, segments = cells[order], segments[order]
+        new_run = numpy.ones(len(cells), dtype=bool)
+        new_run[1:] = (cells[1:] != cells[:-1]) | (segments[1:] != segments[:-1] + 1)
+        starts = numpy.flatnonzero(new_run)
+        ends = numpy.append(starts[1:], len(cells)) - 1
+
+        self.run_cells = cells[starts]
+        self.run_starts = segments[starts]
+        self.run_ends = segments[ends]
+
+        # Which route each run belongs to
+        gpx_ids.sort()
+        route_offsets = numpy.array([offset for offset, _ in gpx_ids], dtype=numpy.int64)
+        route_ids = numpy.array([gpx_id for _, gpx_id in gpx_ids], dtype=numpy.int64)
+        self.run_gpx_ids = route_ids[numpy.searchsorted(route_offsets, self.run_starts, side='right') - 1]
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Query helpers
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    def _segments_for_runs(self, runs: numpy.ndarray) -> tuple[numpy.ndarray, numpy.ndarray]:
+        """
+        :param runs:                    Positions into the run arrays
+        :return:                        (segment numbers, gpx_id of each segment)
+        """
+        lengths = self.run_ends[runs] - self.run_starts[runs] + 1
+        repeat = numpy.repeat(runs, lengths)
+        step = numpy.arange(len(repeat)) - numpy.repeat(numpy.cumsum(lengths) - lengths, lengths)
+        return self.run_starts[repeat] + step, self.run_gpx_ids[repeat]
+
+    def _distances_km(self, segments: numpy.ndarray, lat: float, lon: float) -> numpy.ndarray:
+        """
+        Distance from a point to each segment. We project onto a flat plane centred on the point, which is
+        well under 1% out within MAX_SEARCH_RADIUS_KM.
+        :param segments:                Segment numbers
+        :param lat:                     Latitude of the point
+        :param lon:                     Longitude of the point
+        :return:                        Array of distances in km
+        """
+        x_scale = KM_PER_DEGREE * math.cos(math.radians(lat))
+        ax = (self.lons[segments].astype(float) - lon) * x_scale
+        ay = (self.lats[segments].astype(float) - lat) * KM_PER_DEGREE
+        bx = (self.lons[segments + 1].astype(float) - lon) * x_scale
+        by = (self.lats[segments + 1].astype(float) - lat) * KM_PER_DEGREE
+
+        # Closest point on each segment to the origin
+        dx, dy = bx - ax, by - ay
+        length_sq = dx * dx + dy * dy
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            t = numpy.where(length_sq > 0, -(ax * dx + ay * dy) / length_sq, 0)
+        t = numpy.clip(t, 0, 1)
+        return numpy.hypot(ax + t * dx, ay + t * dy)
+
+    @staticmethod
+    def _closest_per_route(gpx_ids: numpy.ndarray, dist_km: numpy.ndarray) -> list[tuple[int, float]]:
+        if len(gpx_ids) == 0:
+            return []
+        unique_ids, inverse = numpy.unique(gpx_ids, return_inverse=True)
+        closest = numpy.full(len(unique_ids), numpy.inf)
+        numpy.minimum.at(closest, inverse, dist_km)
+        order = numpy.argsort(closest, kind='stable')
+        return [(int(unique_ids[i]), float(closest[i])) for i in order]
+
+    # ---------------------------------------------------------------------------------------------------------- #
+    # Queries
+    # ---------------------------------------------------------------------------------------------------------- #
+
+    def routes_near(self, lat: float, lon: float, radius_km: float) -> list[tuple[int, float]]:
+        """
+        Every route which passes within radius_km of a point.
+        :param lat:                     Latitude of the point
+        :param lon:                     Longitude of the point
+        :param radius_km:               How close the route has to get
+        :return:                        List of (gpx_id, closest approach in km), closest first
+        """
+        if len(self) == 0:
+            return []
+
+        # Cells within radius_km of the point, cells are at least SEGMENT_CELL_KM in both directions
+        row, col = self._rows_cols(lat, lon)
+        ring = max(1, math.ceil(radius_km / SEGMENT_CELL_KM))
+        d_rows, d_cols = numpy.meshgrid(numpy.arange(-ring, ring + 1), numpy.arange(-ring, ring + 1))
+        wanted = numpy.sort(((row + d_rows) * (1 << 32) + (col + d_cols) + CELL_COL_OFFSET).ravel())
+
+        # Runs in those cells
+        firsts = numpy.searchsorted(self.run_cells, wanted, side='left')
+        lasts = numpy.searchsorted(self.run_cells, wanted, side='right')
+        runs = numpy.concatenate([numpy.arange(first, last) for first, last in zip(firsts, lasts) if last > first]
+                                 or [numpy.zeros(0, dtype=numpy.int64)])
+        if len(runs) == 0:
+            return []
+
+        segments, gpx_ids = self._segments_for_runs(runs)
+        dist_km = self._distances_km(segments, lat, lon)
+        close = dist_km <= radius_km
+        return self._closest_per_route(gpx_ids[close], dist_km[close])
+
+    def routes_in_box(self, min_lat: float, max_lat: float, min_lon: float, max_lon: float) -> list[tuple[int, float]]:
+        """
+        Every route which crosses a bounding box, ranked by how close it gets to the middle of the box.
+        :param min_lat:                 South edge
+        :param max_lat:                 North edge
+        :param min_lon:                 West edge
+        :param max_lon:                 East edge
+        :return:                        List of (gpx_id, km from the middle of the box), closest first
+        """
+        if len(self) == 0:
+            return []
+
+        # Runs whose cell overlaps the box
+        min_row, min_col = self._rows_cols(min_lat, min_lon)
+        max_row, max_col = self._rows_cols(max_lat, max_lon)
+        rows = self.run_cells >> 32
+        cols = (self.run_cells & 0xFFFFFFFF) - CELL_COL_OFFSET
+        runs = numpy.flatnonzero((rows >= min_row) & (rows <= max_row) & (cols >= min_col) & (cols <= max_col))
+        if len(runs) == 0:
+            return []
+        segments, gpx_ids = self._segments_for_runs(runs)
+
+        # ----------------------------------------------------------- #
+        # Clip each segment against the box (Liang-Barsky)
+        # ----------------------------------------------------------- #
+        t_low = numpy.zeros(len(segments))
+        t_high = numpy.ones(len(segments))
+        for start, end, low, high in ((self.lats[segments], self.lats[segments + 1], min_lat, max_lat),
+                                      (self.lons[segments], self.lons[segments + 1], min_lon, max_lon)):
+            start = start.astype(float)
+            delta = end.astype(float) - start
+            with numpy.errstate(invalid='ignore', divide='ignore'):
+                t1 = (low - start) / delta
+                t2 = (high - start) / delta
+            # Segments parallel to this edge are either always inside the slab or never
+            inside = (start >= low) & (start <= high)
+            flat = delta == 0
+            t_low = numpy.maximum(t_low, numpy.where(flat, numpy.where(inside, -numpy.inf, numpy.inf),
+                                                     numpy.minimum(t1, t2)))
+            t_high = numpy.minimum(t_high, numpy.where(flat, numpy.where(inside, numpy.inf, -numpy.inf),
+                                                       numpy.maximum(t1, t2)))
+        crosses = t_low <= t_high
+
+        centre_lat = (min_lat + max_lat) / 2
+        centre_lon = (min_lon + max_lon) / 2
+        return self._closest_per_route(gpx_ids[crosses],
+                                       self._distances_km(segments[crosses], centre_lat, centre_lon))
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+def route_segment_index() -> RouteSegmentIndex:
+    """
+    Return this worker's segment index, rebuilding it whenever the route store has changed. Only routes in the
+    store are indexed, running python -m core.subs_gpx_reanalyse adds any old routes which are missing.
+    :return:                            Up to date index
+    """
+    global _segment_index, _segment_index_source
+
+    # The store hands back the same index dict until another process changes it
+    index, data = open_route_store()
+
+    with _segment_index_lock:
+        if _segment_index is not None and _segment_index_source is index:
+            return _segment_index
+
+        _segment_index = RouteSegmentIndex(index, data)
+        _segment_index_source = index
+        app.logger.debug(f"route_segment_index(): Indexed {len(index['routes'])} routes "
+                         f"into {len(_segment_index)} runs.")
+        return _segment_index
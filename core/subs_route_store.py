@@ -0,0 +1,283 @@
+import fcntl
+import json
+import os
+import re
+import threading
+from typing import Any, Iterator
+import numpy
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import app, GPX_UPLOAD_FOLDER_ABS
+from core.subs_gpx_cache import GpxTrack, gpx_track
+from core.subs_gpx_storage import gpx_stat
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# All the routes live in one file of float32 rows, one row per point, with these columns
+STORE_COLUMNS = ("lat", "lon", "elevation", "dist_km")
+STORE_DTYPE = numpy.float32
+ROW_BYTES = len(STORE_COLUMNS) * numpy.dtype(STORE_DTYPE).itemsize
+
+# Index of where each route is in the data file, eg
+# {"data": "route_store_3.f32", "rows": 123456, "routes": {"42": [offset, length, mtime_ns, size]}}
+STORE_INDEX_FILENAME = os.path.join(GPX_UPLOAD_FOLDER_ABS, "route_store.json")
+STORE_LOCK_FILENAME = os.path.join(GPX_UPLOAD_FOLDER_ABS, "route_store.lock")
+
+# Edited / deleted routes leave dead rows behind, once they outnumber the live ones we rewrite the file
+STORE_COMPACT_MIN_ROWS = 100_000
+
+GPX_FILENAME_PATTERN = re.compile(r"gpx_(\d+)\.gpx$")
+
+# Data files are numbered, each compaction writes the next one
+STORE_DATA_PATTERN = re.compile(r"route_store_(\d+)\.f32$")
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Variables
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Each worker keeps the index and memmap open until another process changes the index
+_store_state: dict[str, Any] = {'version': None, 'index': None, 'data': None}
+_store_state_lock = threading.Lock()
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+def route_store_id(gpx_filename: str) -> int | None:
+    """
+    :param gpx_filename:                GPX filename eg "/.../gpx_42.gpx"
+    :return:                            gpx_id eg 42, or None if it's not one of our files
+    """
+    match = GPX_FILENAME_PATTERN.search(os.path.basename(gpx_filename))
+    return int(match.group(1)) if match else None
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Reading
+# -------------------------------------------------------------------------------------------------------------- #
+
+def _empty_index() -> dict[str, Any]:
+    return {'data': "route_store_0.f32", 'rows': 0, 'routes': {}}
+
+
+def _read_index() -> dict[str, Any]:
+    try:
+        with open(STORE_INDEX_FILENAME, 'r') as file_ref:
+            index: dict[str, Any] = json.load(file_ref)
+            return index
+    except FileNotFoundError:
+        return _empty_index()
+
+
+def open_route_store() -> tuple[dict[str, Any], numpy.memmap | None]:
+    """
+    Current index and a read only memmap of the data file. Every worker maps the same file, so the points are
+    shared through the page cache rather than copied into each process. The same index dict is returned until
+    another process changes the store, so callers can use it to tell when to rebuild anything derived from it.
+    :return:                            (index, memmap or None if the store is empty)
+    """
+    # The index is always replaced with os.replace(), so a new inode means a new index
+    try:
+        stat = os.stat(STORE_INDEX_FILENAME)
+        version = (stat.st_ino, stat.st_mtime_ns)
+    except OSError:
+        return _empty_index(), None
+
+    with _store_state_lock:
+        if _store_state['version'] == version:
+            return _store_state['index'], _store_state['data']
+
+        try:
+            index = _read_index()
+            data = None
+            if index['rows'] > 0:
+                data = numpy.memmap(os.path.join(GPX_UPLOAD_FOLDER_ABS, index['data']), dtype=STORE_DTYPE,
+                                    mode='r', shape=(index['rows'], len(STORE_COLUMNS)))
+        except Exception as e:
+            app.logger.error(f"open_route_store(): Failed to open route store, error code was '{e.args}'.")
+            return _empty_index(), None
+
+        _store_state['version'] = version
+        _store_state['index'] = index
+        _store_state['data'] = data
+        return index, data
+
+
+def _track_from_rows(rows: numpy.ndarray) -> GpxTrack:
+    columns = rows.astype(float)
+    return GpxTrack(numpy.ascontiguousarray(columns[:, 0]),
+                    numpy.ascontiguousarray(columns[:, 1]),
+                    numpy.ascontiguousarray(columns[:, 2]),
+                    numpy.ascontiguousarray(columns[:, 3]))
+
+
+def stored_track(gpx_id: int, gpx_filename: str) -> GpxTrack | None:
+    """
+    Points for a route from the store, falling back to parsing the GPX file (and adding it to the store) if
+    the route isn't in the store yet or the file has changed since it was stored.
+    NB lat / lon are float32 in the store, so good to ~0.5 m, which is plenty for bulk jobs like cafe matching.
+    :param gpx_id:                      ID of the route
+    :param gpx_filename:                GPX filename (only the basename is used)
+    :return:                            GpxTrack or None if the GPX file is missing
+    """
+    stat = gpx_stat(gpx_filename)
+    if not stat:
+        return None
+
+    index, data = open_route_store()
+    entry = index['routes'].get(str(gpx_id))
+    if entry and data is not None and \
+            entry[2] == stat.st_mtime_ns and \
+            entry[3] == stat.st_size:
+        offset, length = entry[0], entry[1]
+        return _track_from_rows(data[offset:offset + length])
+
+    # Not there (or out of date), so do it the slow way and remember it for next time
+    track = gpx_track(gpx_filename)
+    if track and len(track) > 0:
+        store_route(gpx_id, gpx_filename, track)
+    return track
+
+
+def all_stored_tracks() -> Iterator[tuple[int, GpxTrack]]:
+    """
+    Every route in the store, without touching any GPX files. Doesn't check the routes are up to date, use
+    stored_track() for that.
+    :return:                            Iterator of (gpx_id, GpxTrack)
+    """
+    index, data = open_route_store()
+    if data is None:
+        return
+    for gpx_id, (offset, length, _, _) in index['routes'].items():
+        yield int(gpx_id), _track_from_rows(data[offset:offset + length])
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Writing
+# -------------------------------------------------------------------------------------------------------------- #
+
+def _write_index(index: dict[str, Any]) -> None:
+    tmp_filename = f"{STORE_INDEX_FILENAME}.tmp"
+    with open(tmp_filename, 'w') as file_ref:
+        json.dump(index, file_ref)
+    os.replace(tmp_filename, STORE_INDEX_FILENAME)
+
+
+def _compact(index: dict[str, Any]) -> dict[str, Any]:
+    """
+    Copy just the live routes into a new data file. Workers with the old file mapped carry on reading it
+    until they notice the new index, Linux keeps the old file around until they let go of it.
+    :param index:                       Current index
+    :return:                            New index
+    """
+    old_filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, index['data'])
+
+    # Should always be one of ours, but if not just start numbering again
+    match = STORE_DATA_PATTERN.search(index['data'])
+    generation = int(match.group(1)) + 1 if match else 1
+    new_index: dict[str, Any] = {'data': f"route_store_{generation}.f32", 'rows': 0, 'routes': {}}
+
+    old_data = numpy.memmap(old_filename, dtype=STORE_DTYPE, mode='r', shape=(index['rows'], len(STORE_COLUMNS)))
+    with open(os.path.join(GPX_UPLOAD_FOLDER_ABS, new_index['data']), 'wb') as file_ref:
+        for gpx_id, (offset, length, mtime_ns, size) in index['routes'].items():
+            file_ref.write(numpy.ascontiguousarray(old_data[offset:offset + length]).tobytes())
+            new_index['routes'][gpx_id] = [new_index['rows'], length, mtime_ns, size]
+            new_index['rows'] += length
+    del old_data
+
+    _write_index(new_index)
+    os.remove(old_filename)
+    app.logger.debug(f"_compact(): Route store compacted from {index['rows']} to {new_index['rows']} rows.")
+    return new_index
+
+
+def store_route(gpx_id: int, gpx_filename: str, track: GpxTrack) -> bool:
+    """
+    Add (or replace) a route in the store. The new points are appended to the data file and the index updated,
+    so nothing already mapped by another worker moves.
+    :param gpx_id:                      ID of the route
+    :param gpx_filename:                GPX filename, we record its mtime / size so we can tell if it changes
+    :param track:                       The route's points
+    :return:                            True if it worked
+    """
+    rows = numpy.column_stack([track.lat, track.lon, track.elevation, track.dist_km]).astype(STORE_DTYPE)
+
+    stat = gpx_stat(gpx_filename)
+    if not stat:
+        app.logger.error(f"store_route(): Missing GPX file for gpx_id = '{gpx_id}'.")
+        return False
+
+    try:
+        with open(STORE_LOCK_FILENAME, 'w') as lock_ref:
+            fcntl.flock(lock_ref, fcntl.LOCK_EX)
+
+            index = _read_index()
+            data_filename = os.path.join(GPX_UPLOAD_FOLDER_ABS, index['data'])
+
+            with open(data_filename, 'ab') as file_ref:
+                # Throw away anything a crashed writer left after the last indexed row
+                file_ref.truncate(index['rows'] * ROW_BYTES)
+                file_ref.write(rows.tobytes())
+
+            index['routes'][str(gpx_id)] = [index['rows'], len(rows), stat.st_mtime_ns, stat.st_size]
+            index['rows'] += len(rows)
+
+            live_rows = sum(entry[1] for entry in index['routes'].values())
+            if index['rows'] > STORE_COMPACT_MIN_ROWS and index['rows'] > 2 * live_rows:
+                _compact(index)
+            else:
+                _write_index(index)
+            return True
+
+    except Exception as e:
+        app.logger.error(f"store_route(): Failed to store gpx_id = '{gpx_id}', error code was '{e.args}'.")
+        return False
+
+
+def refresh_stored_route(gpx_filename: str, track: GpxTrack | None = None) -> bool:
+    """
+    Update the store after a GPX file has been written. Called when a route is uploaded or edited.
+    :param gpx_filename:                GPX filename eg "/.../gpx_42.gpx"
+    :param track:                       The route's points, if we already have them
+    :return:                            True if it worked
+    """
+    gpx_id = route_store_id(gpx_filename)
+    if gpx_id is None:
+        return False
+    if track is None:
+        track = gpx_track(gpx_filename)
+    if not track or len(track) == 0:
+        return False
+    return store_route(gpx_id, gpx_filename, track)
+
+
+def remove_stored_route(gpx_id: int) -> bool:
+    """
+    Drop a route from the index, its rows get reclaimed the next time the store is compacted.
+    :param gpx_id:                      ID of the route
+    :return:                            True if it worked
+    """
+    try:
+        with open(STORE_LOCK_FILENAME, 'w') as lock_ref:
+            fcntl.flock(lock_ref, fcntl.LOCK_EX)
+            index = _read_index()
+            if index['routes'].pop(str(gpx_id), None):
+                _write_index(index)
+            return True
+
+    except Exception as e:
+        app.logger.error(f"remove_stored_route(): Failed to remove gpx_id = '{gpx_id}', error code was '{e.args}'.")
+        return False
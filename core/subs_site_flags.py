@@ -0,0 +1,143 @@
+import threading
+import time
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app from __init__.py
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core import GLOBAL_FLASH
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import our database classes and associated forms, decorators etc
+# -------------------------------------------------------------------------------------------------------------- #
+
+from core.database.repositories.site_flag_repository import SiteFlagRepository
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Flag names
+FLAG_MAPS_ENABLED = "maps_enabled"
+FLAG_MAPS_BOOST = "maps_boost"
+FLAG_GLOBAL_FLASH = "global_flash"
+
+# How long a worker trusts its copy of the flags before asking the dB if anything has changed, so a change made
+# by one worker is seen by all of them within this long
+SITE_FLAGS_TTL_SECS = 1
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Variables
+# -------------------------------------------------------------------------------------------------------------- #
+
+# This worker's copy of every flag, and the version it came from
+site_flags: dict[str, str] = {}
+site_flags_version: int | None = None
+site_flags_checked: float = 0
+site_flags_lock = threading.Lock()
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Functions
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+# NB Flags used to live in files (map_status.txt) or module variables (maps_boost, GLOBAL_FLASH). A file was
+# opened on every map page, and a module variable only exists in the gunicorn worker which set it. Now they're
+# in the dB, and each worker keeps a copy which costs nothing to read.
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Our copy of the flags
+# -------------------------------------------------------------------------------------------------------------- #
+
+def current_site_flags() -> dict[str, str]:
+    """
+    Every flag, at most SITE_FLAGS_TTL_SECS old. Once that's up we only ask the dB for the latest version number,
+    and only reload the flags themselves if it's changed. If the dB is unreachable we carry on with what we have.
+    NB The lock is only held to read / swap our copy, never across a query, so a slow dB can't hold up every
+    other thread in the worker.
+    :return:                            {name: value}
+    """
+    global site_flags, site_flags_version, site_flags_checked
+
+    with site_flags_lock:
+        if time.time() - site_flags_checked < SITE_FLAGS_TTL_SECS:
+            return site_flags
+
+        # Set first, so only this thread asks the dB, and a dB outage costs one query a second, not one per page
+        site_flags_checked = time.time()
+        known_version = site_flags_version
+
+    version = SiteFlagRepository.latest_version()
+    flags = None
+    if version is not None and \
+            version != known_version:
+        # NB If a flag changed between the two queries, we'll just reload again next time
+        flags = SiteFlagRepository.all_flags()
+
+    with site_flags_lock:
+        # Versions only go up, so never swap in an older copy than another thread has just loaded
+        if flags is not None and \
+                version is not None and \
+                (site_flags_version is None or version > site_flags_version):
+            site_flags = flags
+            site_flags_version = version
+
+        return site_flags
+
+
+def site_flag(name: str, default: str | None = None) -> str | None:
+    """
+    :param name:                        eg FLAG_MAPS_ENABLED
+    :param default:                     What to return if the flag has never been set
+    :return:                            The flag's value
+    """
+    return current_site_flags().get(name, default)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Change a flag
+# -------------------------------------------------------------------------------------------------------------- #
+
+def set_site_flag(name: str, value: str) -> bool:
+    """
+    Every worker (including this one) sees the new value within SITE_FLAGS_TTL_SECS.
+    :param name:                        eg FLAG_MAPS_ENABLED
+    :param value:                       New value
+    :return:                            True if it worked
+    """
+    global site_flags_checked
+
+    result = SiteFlagRepository.set_flag(name, value)
+
+    # Re-check on our next read, so whoever made the change sees it straight away
+    with site_flags_lock:
+        site_flags_checked = 0
+
+    return result
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Message shown on the home and weekend pages
+# -------------------------------------------------------------------------------------------------------------- #
+
+def global_flash() -> str | None:
+    """
+    :return:                            Message to flash() to everyone, or None (an empty flag also means none)
+    """
+    return site_flag(FLAG_GLOBAL_FLASH, GLOBAL_FLASH) or None
+
+
+def set_global_flash(message: str | None) -> bool:
+    """
+    :param message:                     Message to show, or None to stop showing one
+    :return:                            True if it worked
+    """
+    return set_site_flag(FLAG_GLOBAL_FLASH, message or "")
@@ -69,7 +69,7 @@ async function initCafeMap() {
     });
 }
 
-initCafeMap();
+/* NB Nothing draws the map until they tap on the picture of it, see map_deferred.html */
 
 
 /* ----------------------------------------------------------------------------------------------------
@@ -83,6 +83,7 @@ async function initGpxMap() {
     /* Request needed libraries */
     const { Map, InfoWindow } = await google.maps.importLibrary("maps");
     const { AdvancedMarkerElement, PinElement } = await google.maps.importLibrary("marker",);
+    await google.maps.importLibrary("geometry");
 
     /* Define the map view */
     const map = new Map(document.getElementById("gpx_map"), {
@@ -100,7 +101,7 @@ async function initGpxMap() {
 
         /* Define our polyline */
         const flightPath{{loop.index}} = new google.maps.Polyline({
-            path: {{ polyline['polyline'] }},
+            path: google.maps.geometry.encoding.decodePath({{ polyline['polyline'] | tojson }}),
             geodesic: true,
             strokeColor: "{{ polyline['color'] }}",
             strokeOpacity: 1.0,
@@ -131,6 +132,11 @@ async function initGpxMap() {
 
     {% endfor %}
 
+    /* All the other routes in the club */
+    {% with heatmap_layer = "all" %}
+        {% include "heatmap_overlay.js" %}
+    {% endwith %}
+
     /* This is our set of cafes */
     const cafes = {{ cafes | tojson }}
 
@@ -164,7 +170,7 @@ async function initGpxMap() {
     });
 }
 
-initGpxMap();
+/* NB Nothing draws the map until they tap on the picture of it, see map_deferred.html */
 
 
 /* ----------------------------------------------------------------------------------------------------
@@ -0,0 +1,9 @@
+        /* Every public route in the club, drawn from tiles built on the server, as there are far too many to
+           draw as polylines. Expects 'map' and 'heatmap_layer' ("all" or "gravel"). */
+        map.overlayMapTypes.push(new google.maps.ImageMapType({
+            getTileUrl: (coord, zoom) => "{{ url_for('gpx_heatmap_tile', layer=heatmap_layer) | safe }}"
+                                         + "&zoom=" + zoom + "&x=" + coord.x + "&y=" + coord.y,
+            tileSize: new google.maps.Size(256, 256),
+            opacity: 0.7,
+            name: "Heatmap",
+        }));
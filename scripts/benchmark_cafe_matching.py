@@ -0,0 +1,103 @@
+import os
+import time
+import mpu
+import numpy
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import app etc from core
+# -------------------------------------------------------------------------------------------------------------- #
+
+# Run from the top of the repo with: python -m scripts.benchmark_cafe_matching
+from core import app, GPX_UPLOAD_FOLDER_ABS
+from core.database.repositories.cafe_repository import CafeRepository
+from core.subs_gpx import MIN_DIST_TO_CAFE_KM
+from core.subs_gpx_cache import GpxTrack, parse_gpx_track
+from core.subs_gpx_matching import closest_approach_to_cafes, NO_MATCH_KM
+from core.subs_gpx_storage import GPX_COMPRESSED_SUFFIX
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Old scalar version, which the vectorised one has to agree with
+# -------------------------------------------------------------------------------------------------------------- #
+
+def closest_approach_to_cafes_scalar(track: GpxTrack, cafe_lats: list[float],
+                                     cafe_lons: list[float]) -> tuple[list[float], list[float]]:
+    min_dist_km: list[float] = [NO_MATCH_KM] * len(cafe_lats)
+    dist_along_route_km: list[float] = [0] * len(cafe_lats)
+
+    last_lat = track.lat[0]
+    last_lon = track.lon[0]
+    dist_along_km: float = 0
+
+    for lat, lon in zip(track.lat.tolist(), track.lon.tolist()):
+        dist_along_km += mpu.haversine_distance((last_lat, last_lon), (lat, lon))
+        for cafe_index in range(len(cafe_lats)):
+            dist_to_cafe_km = mpu.haversine_distance((cafe_lats[cafe_index], cafe_lons[cafe_index]), (lat, lon))
+            if dist_to_cafe_km < min_dist_km[cafe_index]:
+                min_dist_km[cafe_index] = dist_to_cafe_km
+                dist_along_route_km[cafe_index] = dist_along_km
+        last_lat = lat
+        last_lon = lon
+
+    return min_dist_km, dist_along_route_km
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Benchmark scalar vs vectorised matching
+# -------------------------------------------------------------------------------------------------------------- #
+
+def benchmark_cafe_matching(threshold_km: float = MIN_DIST_TO_CAFE_KM) -> None:
+    """
+    Run both versions of the matcher over every GPX file in GPX_UPLOAD_FOLDER_ABS against all the cafes in the
+    dB, check they agree on which cafes are within threshold_km and print the timings.
+    :param threshold_km:                How close a route has to get to a cafe
+    :return:                            n/a
+    """
+    with app.app_context():
+        cafes = CafeRepository.all_cafes()
+    cafe_lats = [cafe.lat for cafe in cafes]
+    cafe_lons = [cafe.lon for cafe in cafes]
+
+    total_scalar_s: float = 0
+    total_vector_s: float = 0
+
+    for filename in sorted(os.listdir(GPX_UPLOAD_FOLDER_ABS)):
+        if filename.endswith(GPX_COMPRESSED_SUFFIX):
+            filename = filename[:-len(GPX_COMPRESSED_SUFFIX)]
+        if not filename.endswith(".gpx"):
+            continue
+        track = parse_gpx_track(filename)
+        if len(track) == 0:
+            continue
+
+        start_time = time.perf_counter()
+        scalar_km, scalar_along_km = closest_approach_to_cafes_scalar(track, cafe_lats, cafe_lons)
+        scalar_s = time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        vector_km, vector_along_km = closest_approach_to_cafes(track, cafe_lats, cafe_lons)
+        vector_s = time.perf_counter() - start_time
+
+        # Both must agree on which cafes are passed and by how much
+        scalar_km_array = numpy.array(scalar_km)
+        scalar_along_km_array = numpy.array(scalar_along_km)
+        passed = scalar_km_array <= threshold_km
+        agree = numpy.array_equal(passed, vector_km <= threshold_km) and \
+            numpy.allclose(scalar_km_array[passed], vector_km[passed]) and \
+            numpy.allclose(scalar_along_km_array[passed], vector_along_km[passed])
+
+        print(f"{filename}: {len(track)} points x {len(cafes)} cafes, scalar {round(scalar_s * 1000, 1)} ms, "
+              f"vectorised {round(vector_s * 1000, 1)} ms, {passed.sum()} cafes passed, "
+              f"{'OK' if agree else 'MISMATCH'}")
+
+        total_scalar_s += scalar_s
+        total_vector_s += vector_s
+
+    if total_vector_s > 0:
+        print(f"Total: scalar {round(total_scalar_s, 2)} s, vectorised {round(total_vector_s, 2)} s, "
+              f"speed up x{round(total_scalar_s / total_vector_s, 1)}")
+
+
+if __name__ == "__main__":
+    benchmark_cafe_matching()
@@ -0,0 +1,177 @@
+import importlib.util
+import multiprocessing
+import os
+import xml.etree.ElementTree as ElementTree
+
+import pytest
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import subs_file_lock on its own
+# -------------------------------------------------------------------------------------------------------------- #
+
+# NB "import core.subs_file_lock" would run core/__init__.py, which needs the whole app (Flask, the dB etc).
+# subs_file_lock doesn't import anything from core, so just load the file.
+SUBS_FILE_LOCK = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              "core", "subs_file_lock.py")
+
+spec = importlib.util.spec_from_file_location("subs_file_lock", SUBS_FILE_LOCK)
+subs_file_lock = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(subs_file_lock)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Constants
+# -------------------------------------------------------------------------------------------------------------- #
+
+NUM_WORKERS = 8
+EDITS_PER_WORKER = 25
+
+# Enough points that every crop leaves some behind
+NUM_POINTS = NUM_WORKERS * EDITS_PER_WORKER + 10
+
+GPX_NAMESPACE = "http://www.topografix.com/GPX/1/1"
+NS = {"gpx": GPX_NAMESPACE}
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Helpers
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+def gpx_xml(name: str, points: list[tuple[str, str]]) -> str:
+    trkpts = "".join(f'<trkpt lat="{lat}" lon="{lon}"><ele>10.0</ele></trkpt>' for lat, lon in points)
+    return (f'<?xml version="1.0" encoding="UTF-8"?>'
+            f'<gpx xmlns="{GPX_NAMESPACE}" version="1.1" creator="ELSR website">'
+            f'<trk><name>{name}</name><trkseg>{trkpts}</trkseg></trk></gpx>')
+
+
+def read_gpx(filename: str) -> tuple[str, list[tuple[str, str]]]:
+    """
+    :return:                            (route name, [(lat, lon), ...]), raises if the file doesn't parse
+    """
+    root = ElementTree.parse(filename).getroot()
+    name = root.find("gpx:trk/gpx:name", NS).text or ""
+    points = [(point.get("lat"), point.get("lon")) for point in root.iterfind("gpx:trk/gpx:trkseg/gpx:trkpt", NS)]
+    return name, points
+
+
+def edit_worker(filename: str, worker: int, results) -> None:
+    """
+    Alternate cropping the first point and renaming the route, the same read-edit-replace a cut or rename does
+    in the app, holding the lock across all three steps.
+    """
+    for edit in range(EDITS_PER_WORKER):
+        with subs_file_lock.file_lock(filename):
+            name, points = read_gpx(filename)
+            if edit % 2 == 0:
+                # Cut the start, remember which point we removed
+                removed = points.pop(0)
+                subs_file_lock.replace_file(filename, gpx_xml(name, points))
+                results.put(("cut", worker, edit, removed))
+            else:
+                # Rename, by adding our tag to the end of the name
+                subs_file_lock.replace_file(filename, gpx_xml(f"{name} w{worker}e{edit}", points))
+                results.put(("rename", worker, edit, None))
+
+
+def reader_worker(filename: str, stop, failures) -> None:
+    """
+    Read the file without taking the lock, as a page view does, it must always be a whole file.
+    """
+    while not stop.is_set():
+        try:
+            read_gpx(filename)
+        except Exception as e:
+            failures.put(repr(e))
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# Tests
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+# -------------------------------------------------------------------------------------------------------------- #
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="file_lock() uses fcntl")
+def test_concurrent_cut_and_rename(tmp_path):
+    filename = str(tmp_path / "gpx_42.gpx")
+    original_points = [(f"52.{index:06d}", f"0.{index:06d}") for index in range(NUM_POINTS)]
+    subs_file_lock.replace_file(filename, gpx_xml("Route", original_points))
+
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    failures = context.Queue()
+    stop = context.Event()
+
+    reader = context.Process(target=reader_worker, args=(filename, stop, failures))
+    reader.start()
+
+    editors = [context.Process(target=edit_worker, args=(filename, worker, results))
+               for worker in range(NUM_WORKERS)]
+    for editor in editors:
+        editor.start()
+
+    # NB Drain the queue before join(), otherwise a worker can block on a full pipe
+    edits = [results.get(timeout=60) for _ in range(NUM_WORKERS * EDITS_PER_WORKER)]
+
+    for editor in editors:
+        editor.join(timeout=60)
+        assert editor.exitcode == 0
+
+    stop.set()
+    reader.join(timeout=60)
+    assert reader.exitcode == 0
+
+    # ----------------------------------------------------------- #
+    # The file always parsed, even mid edit
+    # ----------------------------------------------------------- #
+    reader_failures = []
+    while not failures.empty():
+        reader_failures.append(failures.get())
+    assert reader_failures == []
+
+    # ----------------------------------------------------------- #
+    # No edit was lost
+    # ----------------------------------------------------------- #
+    name, points = read_gpx(filename)
+    cuts = [edit for edit in edits if edit[0] == "cut"]
+    renames = [edit for edit in edits if edit[0] == "rename"]
+
+    # Each cut removed the then first point, so between them they removed the start of the route, once each
+    assert points == original_points[len(cuts):]
+    assert sorted(edit[3] for edit in cuts) == original_points[:len(cuts)]
+
+    # ----------------------------------------------------------- #
+    # Or interleaved
+    # ----------------------------------------------------------- #
+    # Every rename is in the name exactly once, in the order they were made
+    tags = name.split()[1:]
+    assert sorted(tags) == sorted(f"w{edit[1]}e{edit[2]}" for edit in renames)
+    for worker in range(NUM_WORKERS):
+        mine = [int(tag.split("e")[1]) for tag in tags if tag.startswith(f"w{worker}e")]
+        assert mine == sorted(mine)
+
+    # ----------------------------------------------------------- #
+    # Nothing left behind
+    # ----------------------------------------------------------- #
+    assert sorted(os.listdir(tmp_path)) == ["gpx_42.gpx", f"gpx_42.gpx{subs_file_lock.LOCK_SUFFIX}"]
+
+
+def test_replace_file_failure_leaves_original(tmp_path):
+    filename = str(tmp_path / "gpx_42.gpx")
+    subs_file_lock.replace_file(filename, gpx_xml("Route", [("52.0", "0.1")]))
+
+    # Neither str nor bytes, so the write fails after the temp file has been created
+    class NotWritable:
+        pass
+
+    with pytest.raises(Exception):
+        subs_file_lock.replace_file(filename, NotWritable())
+
+    assert read_gpx(filename) == ("Route", [("52.0", "0.1")])
+    assert os.listdir(tmp_path) == ["gpx_42.gpx"]
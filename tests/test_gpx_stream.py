@@ -0,0 +1,43 @@
+import importlib.util
+import io
+import os
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Import subs_gpx_stream on its own
+# -------------------------------------------------------------------------------------------------------------- #
+
+# NB "import core.subs_gpx_stream" would run core/__init__.py, which needs the whole app (Flask, the dB etc).
+SUBS_GPX_STREAM = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                               "core", "subs_gpx_stream.py")
+
+spec = importlib.util.spec_from_file_location("subs_gpx_stream", SUBS_GPX_STREAM)
+subs_gpx_stream = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(subs_gpx_stream)
+
+
+# -------------------------------------------------------------------------------------------------------------- #
+# Tests
+# -------------------------------------------------------------------------------------------------------------- #
+
+def test_only_track_points_are_returned():
+    gpx = ('<?xml version="1.0" encoding="UTF-8"?>'
+           '<gpx xmlns="http://www.topografix.com/GPX/1/1" version="1.1">'
+           '<!-- comment -->'
+           '<wpt lat="1.0" lon="1.0"><ele>99</ele><name>Cafe</name></wpt>'
+           '<rte><rtept lat="2.0" lon="2.0"><ele>99</ele></rtept></rte>'
+           '<trk><trkseg>'
+           '<trkpt lat="52.1" lon="0.1"><ele>10.5</ele><extensions><hr>120</hr></extensions></trkpt>'
+           '<trkpt lat="52.2" lon="0.2"><extensions><ele>99</ele></extensions></trkpt>'
+           '</trkseg><trkseg>'
+           '<trkpt lat="52.3" lon="0.3"><ele> </ele></trkpt>'
+           '</trkseg></trk>'
+           '<extensions><anything lat="3.0" lon="3.0"/></extensions>'
+           '</gpx>').encode()
+
+    assert list(subs_gpx_stream.iter_track_points(io.BytesIO(gpx))) == [
+        (0, 52.1, 0.1, 10.5),
+        # NB findtext() only looks at direct children, so an <ele> buried in extensions doesn't count
+        (0, 52.2, 0.2, None),
+        (1, 52.3, 0.3, None),
+    ]